@@ -1,204 +1,760 @@
 import logging
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from configparser import ConfigParser
 import time
 from datetime import date
 
-from errorhandler import ErrorHandler
 
 from redcap_invitae import Redcap
-from r4 import R4
-from redox import RedoxInvitaeAPI
-from emailer import Emailer
+from r4 import R4, MetreeCache
+from redox import RedoxUnavailableError, RedoxOutcomeUnknownError
+from emailer import AlertHandler, Emailer
+from log_setup import log_context, setup_logging, update_log_context, with_log_context
+from metrics import METRICS
+from journal import SubmissionJournal, resume_from_journal
+from order_archive import OrderArchive
+from order_status import OrderStatusPoller
 from utils import (
     convert_emerge_race_to_redox_race, 
     convert_emerge_race_to_invitae_ancestry, 
     map_redcap_sex_to_redox_sex, 
     get_invitae_primary_indication, 
     describe_patient_history, 
-    generate_family_history
+    generate_family_history,
+    derive_aoe_batch
     )
 
-if __name__ == "__main__":
-    # Setup logging
-    error_handler = ErrorHandler(logging.WARNING)
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler('redox.log')
-    fh.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-    fh.setFormatter(formatter)
-    ch.setFormatter(formatter)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+logger = logging.getLogger(__name__)
 
-    logger.info('Begin Invitae Redox batch script')
 
-    # Read config file
-    parser = ConfigParser(inline_comment_prefixes=['#'])
-    parser.read('./redox-api.config')
+def process_participant(p, redcap, r4, redox, development, aoe=None, journal=None, writeback=True):
+    '''
+    Places a new Invitae order for one participant and records the outcome in local REDCap:
+    fetches MeTree from R4, builds and sends the Redox order, then writes the order status back.
+
+    Params
+    ------
+    p: Dict of participant information from Redcap.pull_info_for_new_order
+    redcap: Redcap
+    r4: R4
+    redox: RedoxInvitaeAPI (authenticated)
+    development: True to mark orders as test orders
+    aoe: [Optional] (Redox race, Invitae ancestry, primary indication, patient history) already derived for this
+         participant, e.g., by derive_aoe_batch. Derived from p if not provided.
+    journal: [Optional] SubmissionJournal recording the order's progress, so an interrupted batch can resume
+    writeback: False to leave REDCap unchanged, e.g., in a dry run
+
+    Return
+    ------
+    True if the order was successfully submitted, False if it failed, or None if Redox was unavailable. When Redox
+    is unavailable, the participant stays marked as ready for order, so the order is retried on the next run.
+    When Redox may have received the order but didn't confirm it, False is returned and the order is not sent again
+    until it's checked: the journal keeps it as unconfirmed, or without a journal, the participant is no longer
+    marked as ready for order.
+    '''
+    order_id = redcap.get_new_order_id()
+    local_id = p[Redcap.FIELD_RECORD_ID]
+    update_log_context(order_id=order_id, stage='build')
+    if journal is not None:
+        journal.allocated(local_id, order_id)
+    r4_record_id = p[Redcap.FIELD_R4_RECORD_ID]
+    logger.debug(f'Processing participant CUIMC {local_id}, R4 {r4_record_id}')
+
+    order_log = p[Redcap.FIELD_ORDER_LOG]
+    if order_log:
+        # Add a visual separator
+        order_log += '==========================\n'
+
+    # Map sex, race, and ancestry data from eMERGE to Redox / Invitae values
+    sex = map_redcap_sex_to_redox_sex(p[Redcap.FIELD_SEX])
+    if aoe is not None:
+        redox_race, invitae_ancestry, primary_indication, patient_history = aoe
+    else:
+        redox_race = convert_emerge_race_to_redox_race(p)
+        invitae_ancestry = convert_emerge_race_to_invitae_ancestry(p)
+
+        # Invitae AOE questions get primary indication and description of health history from baseline survey data
+        primary_indication = get_invitae_primary_indication(p)
+        patient_history = describe_patient_history(p)
+    # Mark patient as affected / symptomatic when patient history is not empty
+    affected_symptomatic = 'Yes' if patient_history else 'No'
+
+    # Get family health history from MeTree
+    # Get MeTree JSON from R4
+    update_log_context(stage='metree')
+    metree = r4.get_metree_json(r4_record_id)
+    if metree:
+        family_history, family_count = generate_family_history(metree)
+        has_family_history = 'Yes' if family_count > 0 else 'No'
+    else:
+        has_family_history = 'No'
+        family_history = ''
+
+    if journal is not None:
+        journal.built(local_id, order_id)
+    update_log_context(stage='redox')
+    try:
+        success, msg = redox.put_new_order(patient_id=p[Redcap.FIELD_LAB_ID],
+                                    patient_name_first=p[Redcap.FIELD_NAME_FIRST],
+                                    patient_name_last=p[Redcap.FIELD_NAME_LAST],
+                                    patient_dob=p[Redcap.FIELD_DOB],
+                                    patient_sex=sex,
+                                    patient_redox_race=redox_race,
+                                    patient_invitae_ancestry=invitae_ancestry,
+                                    order_id=order_id,
+                                    prim_ind=primary_indication, 
+                                    is_ind_aff=affected_symptomatic, 
+                                    pat_hist=patient_history,
+                                    has_fam_hist=has_family_history, 
+                                    fam_hist=family_history,
+                                    test=development)
+    except RedoxUnavailableError as e:
+        # Temporary problem. Leave the participant ready for order and only note the attempt in the order log.
+        logger.warning(f'Order for CUIMC {local_id} deferred: {e}')
+        order_log += f'Order ID {order_id} attempt deferred on {date.today().isoformat()}: Redox unavailable. ' \
+                     'The order will be retried.\n'
+        if journal is not None:
+            journal.deferred(local_id, order_id)
+        if writeback:
+            redcap.update_order_status(record_id=local_id, order_log=order_log)
+        return None
+    except RedoxOutcomeUnknownError as e:
+        # The order may have been placed. It's left for someone to check instead of being sent again.
+        logger.error(f'Order {order_id} for CUIMC {local_id} was sent, but Redox did not confirm it: {e}. '
+                     'Check whether Invitae received it before ordering again.')
+        order_log += f'Order ID {order_id} sent on {date.today().isoformat()}, but not confirmed by Redox. ' \
+                     'Check whether Invitae received it before ordering again.\n'
+        if writeback:
+            if journal is not None:
+                # The journal keeps the order as BUILT (unconfirmed), so it's skipped until released
+                redcap.update_order_status(record_id=local_id, order_log=order_log)
+            else:
+                redcap.update_order_status(record_id=local_id, order_new=Redcap.YesNo.NO, order_id=order_id,
+                                           order_log=order_log)
+        return False
+
+    if not writeback:
+        # Dry run: REDCap is left as it was
+        return success
+
+    # Record status
+    update_log_context(stage='writeback')
+    datestr = date.today().isoformat()
+    if success:
+        order_log += f'Order ID {order_id} successfully submitted on {datestr}:\n{msg}\n'
+        status = dict(order_status=Redcap.OrderStatus.SUBMITTED, form_complete=Redcap.FormComplete.UNVERIFIED)
+    else:
+        order_log += f'Order ID {order_id} attempt failed on {datestr}.\n'
+        status = dict(order_status=Redcap.OrderStatus.FAILED, form_complete=Redcap.FormComplete.INCOMPLETE)
+    status.update(order_new=Redcap.YesNo.NO, order_date=datestr, order_id=order_id, order_log=order_log)
+    if journal is not None:
+        # Kept until REDCap confirms the writeback, so it can be replayed if the batch is interrupted
+        journal.posted(local_id, order_id, Redcap.build_order_status_record(local_id, **status))
+    redcap.update_order_status(record_id=local_id, **status)
+
+    return success
+
+
+def place_new_orders(participant_info, redcap, r4, redox, development, workers=1, prefetch_workers=4, chunk_size=100,
+                     journal=None, skip_record_ids=None, stop_event=None, writeback=True):
+    '''
+    Places new orders for all participants. With workers > 1, participants are processed concurrently
+    by a bounded pool of threads. Order IDs are handed out by Redcap.get_new_order_id, which is thread-safe,
+    and each participant's REDCap writeback only touches that participant's record.
+
+    Participants are taken chunk_size at a time, so participant_info can be a generator 
+    (e.g., Redcap.iter_info_for_new_order) and is never held in memory all at once. For each chunk, MeTree files
+    are downloaded in parallel and race, ancestry, and AOE answers are derived together before orders are placed.
+
+    Params
+    ------
+    participant_info: Iterable of dicts of participant information from Redcap
+    redcap: Redcap
+    r4: R4
+    redox: RedoxInvitaeAPI (authenticated)
+    development: True to mark orders as test orders
+    workers: Number of participants processed concurrently
+    prefetch_workers: Number of concurrent MeTree downloads
+    chunk_size: Number of participants prepared together
+    journal: [Optional] SubmissionJournal (see process_participant)
+    skip_record_ids: [Optional] Record IDs not to order, e.g., from resume_from_journal
+    stop_event: [Optional] threading.Event. Once set, no more participants are taken and the remaining ones are
+                left for the next run
+    writeback: False to leave REDCap unchanged (see process_participant)
+
+    Return
+    ------
+    Number of successfully submitted orders
+    '''
+    def _process(p, p_aoe):
+        if not redox.available or (stop_event is not None and stop_event.is_set()):
+            # Redox outage or shutting down: leave the remaining participants for the next run
+            METRICS.inc('orders_total', outcome='deferred')
+            return None
+        with METRICS.timer('participant') as t, log_context(participant=p[Redcap.FIELD_RECORD_ID]):
+            try:
+                success = process_participant(p, redcap, r4, redox, development, aoe=p_aoe, journal=journal,
+                                              writeback=writeback)
+            except Exception:
+                logger.exception(f'Unexpected error while processing CUIMC {p[Redcap.FIELD_RECORD_ID]}')
+                success = False
+            if not success:
+                t.fail()
+        METRICS.inc('orders_total', outcome={True: 'submitted', False: 'failed', None: 'deferred'}[success])
+        return success
+
+    n_success = 0
+    n_deferred = 0
+    n_total = 0
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='order') if workers > 1 else None
+    try:
+        iterator = iter(participant_info)
+        if skip_record_ids:
+            iterator = (p for p in iterator if str(p[Redcap.FIELD_RECORD_ID]) not in skip_record_ids)
+        while stop_event is None or not stop_event.is_set():
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                break
+
+            # Download MeTree files for the chunk up front
+            r4.prefetch_metree([p[Redcap.FIELD_R4_RECORD_ID] for p in chunk], max_workers=prefetch_workers)
+            # Race, ancestry, and AOE answers for the whole chunk at once
+            with METRICS.timer('aoe_batch') as t:
+                try:
+                    aoe = list(zip(*derive_aoe_batch(chunk)))
+                except Exception:
+                    # A malformed record: derive each participant's answers separately (see process_participant),
+                    # so only that participant fails
+                    t.fail()
+                    logger.exception('Unable to derive AOE answers for the chunk. Deriving them for each participant.')
+                    aoe = [None] * len(chunk)
+
+            if executor is None:
+                results = [_process(p, p_aoe) for p, p_aoe in zip(chunk, aoe)]
+            else:
+                results = list(executor.map(with_log_context(_process), chunk, aoe))
+            # MeTree files of participants that were not ordered (e.g., deferred) are not kept
+            r4.clear_prefetched([p[Redcap.FIELD_R4_RECORD_ID] for p in chunk])
+            n_success += sum(1 for x in results if x)
+            n_deferred += sum(1 for x in results if x is None)
+            n_total += len(results)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # Write out any order status updates still waiting in the writeback buffer
+        with METRICS.timer('redcap_flush'):
+            redcap.flush_order_status()
+
+    if n_total == 0:
+        logger.info('No new orders are needed')
+    else:
+        logger.info(f'{n_success} of {n_total} new orders submitted successfully')
+        if n_deferred:
+            logger.warning(f'{n_deferred} orders deferred because Redox was unavailable or the batch was stopped. '
+                           'They will be retried on the next run.')
+    return n_success
+
+
+def check_order_statuses(redcap, poller, get_redox, development, stop_event=None):
+    '''
+    Asks Redox about submitted orders that are due for a status check (see OrderStatusPoller) and records status
+    changes in REDCap
+
+    Params
+    ------
+    redcap: Redcap
+    poller: OrderStatusPoller
+    get_redox: Function returning an authenticated RedoxInvitaeAPI, or None if Redox can't be reached. Only called
+               if an order is due.
+    development: True to mark queries as test messages
+    stop_event: [Optional] threading.Event. Once set, no more queries are sent.
+
+    Return
+    ------
+    Dict with the number of orders queried, orders whose status changed, and failed queries
+    '''
+    with METRICS.timer('order_status_due'):
+        due = poller.due(redcap.pull_info_for_query_order())
+    if not due:
+        logger.info('No order statuses need to be checked')
+        return {'orders_queried': 0, 'status_changes': 0, 'failed_queries': 0}
+    redox = get_redox()
+    if redox is None:
+        return {'orders_queried': 0, 'status_changes': 0, 'failed_queries': 0}
+    try:
+        return poller.poll(redox, due, stop_event=stop_event, test=development)
+    finally:
+        with METRICS.timer('redcap_flush'):
+            redcap.flush_order_status()
+
+
+def write_metrics(prometheus_file=None, json_file=None):
+    '''
+    Exports the run's metrics (see metrics.METRICS)
+
+    Params
+    ------
+    prometheus_file: [Optional] Prometheus textfile, e.g., in the node_exporter textfile collector directory
+    json_file: [Optional] JSON summary with counts and latency percentiles
+    '''
+    try:
+        if prometheus_file:
+            METRICS.write_prometheus(prometheus_file)
+        if json_file:
+            METRICS.write_json(json_file)
+    except OSError as e:
+        logger.error(f'Unable to write metrics: {e}')
+
+
+def redox_client_options(parser, workers=1):
+    '''
+    Params
+    ------
+    parser: ConfigParser with the configuration
+    workers: Number of participants processed concurrently with the client
+
+    Return
+    ------
+    Dict of RedoxClient options from [REDOX], other than the URL and credentials
+    '''
+    return dict(pool_maxsize=max(parser.getint('REDOX', 'POOL_MAXSIZE', fallback=10), workers),
+                token_cache_path=parser.get('REDOX', 'TOKEN_CACHE_FILE', fallback='') or None,
+                refresh_margin_sec=parser.getint('REDOX', 'TOKEN_REFRESH_MARGIN_SECONDS', fallback=300),
+                rate_limit_per_sec=parser.getfloat('REDOX', 'RATE_LIMIT_PER_SECOND', fallback=0),
+                rate_limit_burst=parser.getint('REDOX', 'RATE_LIMIT_BURST', fallback=0) or None,
+                max_retries=parser.getint('REDOX', 'MAX_RETRIES', fallback=3),
+                backoff_base_sec=parser.getfloat('REDOX', 'BACKOFF_BASE_SECONDS', fallback=1),
+                backoff_max_sec=parser.getfloat('REDOX', 'BACKOFF_MAX_SECONDS', fallback=60),
+                circuit_failure_threshold=parser.getint('REDOX', 'CIRCUIT_FAILURE_THRESHOLD', fallback=5),
+                circuit_reset_sec=parser.getint('REDOX', 'CIRCUIT_RESET_SECONDS', fallback=60))
+
+
+def configure_logging(parser):
+    '''
+    Sets up logging as configured in [LOGGING]. Records are written to the console and the log file by a
+    background thread.
+
+    Return
+    ------
+    log_setup.LoggingPipeline. Call stop before exiting.
+    '''
+    return setup_logging(file_path=parser.get('LOGGING', 'FILE', fallback='redox.log') or None,
+                         file_level=parser.get('LOGGING', 'FILE_LEVEL', fallback='DEBUG').upper(),
+                         console_level=parser.get('LOGGING', 'CONSOLE_LEVEL', fallback='DEBUG').upper(),
+                         file_format=parser.get('LOGGING', 'FILE_FORMAT', fallback='text').lower(),
+                         max_bytes=int(parser.getfloat('LOGGING', 'MAX_MEGABYTES', fallback=0) * 1024 ** 2),
+                         backup_count=parser.getint('LOGGING', 'BACKUP_COUNT', fallback=10),
+                         compress=parser.getboolean('LOGGING', 'COMPRESS', fallback=True))
+
+
+def start_alerts(parser):
+    '''
+    Emails warnings and errors to the developers, as configured in [EMAIL]. Emails are queued and sent in digests
+    from a background thread, so email problems don't hold up orders.
+
+    Return
+    ------
+    (Emailer, AlertHandler added to the root logger). Remove the handler and stop the emailer before exiting.
+    '''
+    email_to = parser.get('EMAIL', 'TO_ADDRS')
+    email_to = [e.strip() for e in email_to.split(';') if e.strip()]  # split emails by ; and get rid of empty
+    emailer = Emailer(parser.get('EMAIL', 'SMTP_HOST'), parser.get('EMAIL', 'SMTP_PORT'),
+                      parser.get('EMAIL', 'FROM_ADDR'), email_to,
+                      digest_window_sec=parser.getfloat('EMAIL', 'DIGEST_MINUTES', fallback=15) * 60,
+                      dedup_window_sec=parser.getfloat('EMAIL', 'DEDUP_HOURS', fallback=24) * 3600,
+                      max_items=parser.getint('EMAIL', 'MAX_ITEMS', fallback=50)).start()
+    alert_handler = AlertHandler(emailer, 'Invitae Redox API issue')
+    logging.getLogger().addHandler(alert_handler)
+    return emailer, alert_handler
+
+
+def parse_args(argv=None):
+    '''
+    Params
+    ------
+    argv: [Optional] Command line arguments. Defaults to sys.argv[1:]
+
+    Return
+    ------
+    argparse.Namespace of the batch options (see run)
+    '''
+    arg_parser = ArgumentParser(description='Place new Invitae orders through Redox for participants marked as ready in REDCap')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Number of participants to process concurrently (default: 1)')
+    arg_parser.add_argument('--verify-mirror', action='store_true',
+                            help='Compare the local REDCap mirror with a full export and rebuild it if they differ')
+    arg_parser.add_argument('--sync-order-ids', action='store_true',
+                            help="Check today's order IDs in REDCap before allocating new ones from ORDER_ID_STORE")
+    arg_parser.add_argument('--journal-release', nargs='*', metavar='RECORD_ID',
+                            help='Allow orders that were interrupted while being sent to Redox to be placed again '
+                                 '(all of them, or only these records). Check with Invitae first that they were not received.')
+    arg_parser.add_argument('--daemon', action='store_true',
+                            help='Keep running and check for new orders every INTERVAL_SECONDS (see [DAEMON] in the config)')
+    arg_parser.add_argument('--interval', type=int,
+                            help='With --daemon, seconds between checks for new orders (overrides INTERVAL_SECONDS)')
+    arg_parser.add_argument('--dry-run', metavar='ARCHIVE_FILE',
+                            help='Write new orders to this NDJSON archive (.gz to compress) instead of sending them '
+                                 'to Redox (overrides [DRY_RUN] ARCHIVE_FILE)')
+    arg_parser.add_argument('--config', default='./redox-api.config',
+                            help='Configuration file (default: ./redox-api.config)')
+    return arg_parser.parse_args(argv)
+
+
+def run(parser, args, redox_client=None):
+    '''
+    Places new orders for all participants marked as ready in the REDCap project configured in parser, then checks
+    the status of submitted orders, or keeps doing so with args.daemon
+
+    Params
+    ------
+    parser: ConfigParser with the configuration (see redox-api.config)
+    args: Options from parse_args
+    redox_client: [Optional] redox.client.RedoxClient shared with other runs, e.g., of other sites (see
+                  multi_site.py). When set, the connection options in [REDOX] are not used.
+    '''
+    logger = logging.getLogger()
+
     # Development environment configuraiton
     development = parser.getboolean('GENERAL', 'DEVELOPMENT')
     # REDCap
     redcap_api_endpoint = parser.get('REDCAP', 'LOCAL_REDCAP_URL')
     redcap_api_token = parser.get('REDCAP', 'LOCAL_REDCAP_API_KEY')
+    redcap_mirror_file = parser.get('REDCAP', 'MIRROR_FILE', fallback='') or None
+    redcap_mirror_overlap_sec = parser.getint('REDCAP', 'MIRROR_OVERLAP_SECONDS', fallback=300)
+    redcap_server_timezone = parser.get('REDCAP', 'SERVER_TIMEZONE', fallback='') or None
+    redcap_order_id_store = parser.get('REDCAP', 'ORDER_ID_STORE', fallback='') or None
+    redcap_order_id_block_size = parser.getint('REDCAP', 'ORDER_ID_BLOCK_SIZE', fallback=1)
+    redcap_export_page_size = parser.getint('REDCAP', 'EXPORT_PAGE_SIZE', fallback=500)
+    redcap_writeback_chunk_size = parser.getint('REDCAP', 'WRITEBACK_CHUNK_SIZE', fallback=1)
+    redcap_writeback_flush_sec = parser.getint('REDCAP', 'WRITEBACK_FLUSH_SECONDS', fallback=30)
+    redcap_order_id_prefix = parser.get('REDCAP', 'ORDER_ID_PREFIX', fallback='') or None
+    # Project field names that differ from Redcap.FIELD_* (Redcap.FIELD_* name = name in the project)
+    redcap_field_map = dict(parser.items('FIELD_MAP')) if parser.has_section('FIELD_MAP') else None
+    # Submission journal
+    journal_file = parser.get('JOURNAL', 'FILE', fallback='') or None
+    journal_retention_days = parser.getint('JOURNAL', 'RETENTION_DAYS', fallback=30)
     # R4
     r4_api_endpoint = parser.get('R4', 'R4_URL')
     r4_api_token = parser.get('R4', 'R4_API_KEY')    
+    r4_prefetch_workers = parser.getint('R4', 'METREE_PREFETCH_WORKERS', fallback=4)
+    metree_cache_dir = parser.get('R4', 'METREE_CACHE_DIR', fallback='') or None
+    metree_cache_max_mb = parser.getint('R4', 'METREE_CACHE_MAX_MB', fallback=100)
+    metree_cache_max_age_hours = parser.getint('R4', 'METREE_CACHE_MAX_AGE_HOURS', fallback=24)
+    metree_cache_missing_max_age_min = parser.getint('R4', 'METREE_CACHE_MISSING_MAX_AGE_MINUTES', fallback=60)
     # Redox
-    redox_api_base_url = parser.get('REDOX', 'BASE_URL')
-    redox_api_key =  parser.get('REDOX', 'REDOX_API_KEY')
-    redox_api_secret = parser.get('REDOX', 'REDOX_API_SECRET')
-    query_wait_sec = parser.getint('REDOX', 'WAIT_BEFORE_ORDER_QUERY_SECONDS', fallback=0)
-    # Email
-    email_host = parser.get('EMAIL', 'SMTP_HOST')
-    email_port = parser.get('EMAIL', 'SMTP_PORT')
-    email_from = parser.get('EMAIL', 'FROM_ADDR')
-    email_to = parser.get('EMAIL', 'TO_ADDRS')
-    email_to = [e.strip() for e in email_to.split(';') if e.strip()]  # split emails by ; and get rid of empty
-
-    # Emailer to notify dev of failures
-    emailer = Emailer(email_host, email_port, email_from, email_to)
-
-    # Redcap configuration
-    redcap = Redcap(redcap_api_endpoint, redcap_api_token)
-
-    # R4 configuration
-    r4 = R4(r4_api_endpoint, r4_api_token)
-
-    # While we're developing the script, force double check of which projects we're working on
-    CHECK_BEFORE_RUNNING = development
-    redcap_project_title = redcap.project.export_project_info()['project_title']
-    r4_project_title = r4.export_project_info()['project_title']
-    if CHECK_BEFORE_RUNNING:
-        msg = f'Working on\nRedcap project: {redcap_project_title}\nR4 project: {r4_project_title}.\nEnter the "YeS" to continue:\n'
-        if input(msg) != "YeS":
-            print('Exiting')
-            exit()    
-
-    # Redox configuration and authentication
-    redox = RedoxInvitaeAPI(redox_api_base_url, redox_api_key, redox_api_secret)
-    if not redox.authenticate():
-        msg = 'Unable to authenticate with Redox. Exiting without processing any orders.'
-        logger.error(msg)
-        emailer.sendmail('Invitae Redox API issue', msg)
-        exit()
-
-    # Place new orders with Invitae
-    participant_info = redcap.pull_info_for_new_order()
-    if not participant_info:
-        logger.info('No new orders are needed')
+    if redox_client is None:
+        redox_api_base_url = parser.get('REDOX', 'BASE_URL')
+        redox_api_key =  parser.get('REDOX', 'REDOX_API_KEY')
+        redox_api_secret = parser.get('REDOX', 'REDOX_API_SECRET')
     else:
-        # Currently in development. Show what information has been collecetd and verify before continuing to send data out
-        logger.debug('The following participant data have been collected for placing new orders:')
-        logger.debug('; '.join(f"{p[Redcap.FIELD_RECORD_ID]}: {p[Redcap.FIELD_NAME_FIRST]} {p[Redcap.FIELD_NAME_LAST]}" for p in participant_info))
-        if CHECK_BEFORE_RUNNING and (input('Enter "yes" to continue: ') != 'yes'):
-            logger.debug('Exiting script prior to sending Redox orders.')
-            exit()
-
-        for p in participant_info:
-            order_id = redcap.get_new_order_id()
-            local_id = p[Redcap.FIELD_RECORD_ID]
-            r4_record_id = p[Redcap.FIELD_R4_RECORD_ID]
-            logger.debug(f'Processing participant CUIMC {local_id}, R4 {r4_record_id}')
-            
-            order_log = p[Redcap.FIELD_ORDER_LOG]
-            if order_log:
-                # Add a visual separator
-                order_log += '==========================\n'
-            
-            # Map sex, race, and ancestry data from eMERGE to Redox / Invitae values
-            sex = map_redcap_sex_to_redox_sex(p[Redcap.FIELD_SEX])
-            redox_race = convert_emerge_race_to_redox_race(p)
-            invitae_ancestry = convert_emerge_race_to_invitae_ancestry(p)
-
-            # Invitae AOE questions get primary indication and description of health history from baseline survey data
-            primary_indication = get_invitae_primary_indication(p)
-            patient_history = describe_patient_history(p)
-            # Mark patient as affected / symptomatic when patient history is not empty
-            affected_symptomatic = 'Yes' if patient_history else 'No'
-
-            # Get family health history from MeTree
-            # Get MeTree JSON from R4
-            metree = r4.get_metree_json(r4_record_id)
-            if metree:
-                family_history, family_count = generate_family_history(metree)
-                has_family_history = 'Yes' if family_count > 0 else 'No'
-            else:
-                has_family_history = 'No'
-                family_history = ''
-
-            success, msg = redox.put_new_order(patient_id=p[Redcap.FIELD_LAB_ID],
-                                        patient_name_first=p[Redcap.FIELD_NAME_FIRST],
-                                        patient_name_last=p[Redcap.FIELD_NAME_LAST],
-                                        patient_dob=p[Redcap.FIELD_DOB],
-                                        patient_sex=sex,
-                                        patient_redox_race=redox_race,
-                                        patient_invitae_ancestry=invitae_ancestry,
-                                        order_id=order_id,
-                                        prim_ind=primary_indication, 
-                                        is_ind_aff=affected_symptomatic, 
-                                        pat_hist=patient_history,
-                                        has_fam_hist=has_family_history, 
-                                        fam_hist=family_history,
-                                        test=development)
-            
-            # Record status
-            datestr = date.today().isoformat()
-            if success:
-                order_log += f'Order ID {order_id} successfully submitted on {datestr}:\n{msg}\n'
-                redcap.update_order_status(record_id=local_id,
-                                        order_new=Redcap.YesNo.NO,
-                                        order_status=Redcap.OrderStatus.SUBMITTED,
-                                        order_date=datestr,
-                                        order_id=order_id,
-                                        order_log=order_log,
-                                        form_complete=Redcap.FormComplete.UNVERIFIED)
+        redox_api_base_url = redox_client.api_base_url
+        redox_api_key = redox_client.api_key
+        redox_api_secret = redox_client.client_secret
+    redox_destination_id = parser.get('REDOX', 'DESTINATION_ID', fallback='') or None
+    redox_destinations = [{'ID': redox_destination_id,
+                           'Name': parser.get('REDOX', 'DESTINATION_NAME', fallback='') or redox_destination_id}] \
+        if redox_destination_id else None
+    redox_facility_code = parser.get('REDOX', 'FACILITY_CODE', fallback='') or None
+    query_wait_sec = parser.getint('REDOX', 'WAIT_BEFORE_ORDER_QUERY_SECONDS', fallback=0)
+    # Order status checks
+    query_enabled = parser.getboolean('ORDER_QUERY', 'ENABLED', fallback=False)
+    query_store_file = parser.get('ORDER_QUERY', 'STORE_FILE', fallback='') or None
+    query_batch_size = parser.getint('ORDER_QUERY', 'BATCH_SIZE', fallback=50)
+    query_min_interval_min = parser.getfloat('ORDER_QUERY', 'MIN_INTERVAL_MINUTES', fallback=15)
+    query_max_interval_hours = parser.getfloat('ORDER_QUERY', 'MAX_INTERVAL_HOURS', fallback=24)
+    query_age_fraction = parser.getfloat('ORDER_QUERY', 'AGE_FRACTION', fallback=0.1)
+    redox_options = redox_client_options(parser, workers=args.workers)
+    # Dry run
+    dry_run_archive = args.dry_run or parser.get('DRY_RUN', 'ARCHIVE_FILE', fallback='') or None
+    dry_run_writeback = parser.getboolean('DRY_RUN', 'WRITEBACK', fallback=False)
+    dry_run_compress_level = parser.getint('DRY_RUN', 'COMPRESS_LEVEL', fallback=1)
+    # Metrics
+    metrics_prometheus_file = parser.get('METRICS', 'PROMETHEUS_FILE', fallback='') or None
+    metrics_json_file = parser.get('METRICS', 'JSON_FILE', fallback='') or None
+    # Daemon mode
+    daemon_interval_sec = args.interval or parser.getint('DAEMON', 'INTERVAL_SECONDS', fallback=60)
+    daemon_status_host = parser.get('DAEMON', 'STATUS_HOST', fallback='127.0.0.1')
+    daemon_status_port = parser.getint('DAEMON', 'STATUS_PORT', fallback=0)
+    daemon_health_max_age_sec = parser.getint('DAEMON', 'HEALTH_MAX_AGE_SECONDS', fallback=0) or None
+    # REDCap Data Entry Trigger receiver (daemon mode)
+    trigger_host = parser.get('TRIGGER', 'HOST', fallback='127.0.0.1')
+    trigger_port = parser.getint('TRIGGER', 'PORT', fallback=0)
+    trigger_token = parser.get('TRIGGER', 'TOKEN', fallback='') or None
+    trigger_project_id = parser.get('TRIGGER', 'PROJECT_ID', fallback='') or None
+    # Redox results webhook receiver (daemon mode)
+    webhook_host = parser.get('WEBHOOK', 'HOST', fallback='127.0.0.1')
+    webhook_port = parser.getint('WEBHOOK', 'PORT', fallback=0)
+    webhook_token = parser.get('WEBHOOK', 'VERIFICATION_TOKEN', fallback='') or None
+    webhook_queue_file = parser.get('WEBHOOK', 'QUEUE_FILE', fallback='') or None
+    webhook_batch_size = parser.getint('WEBHOOK', 'BATCH_SIZE', fallback=500)
+    webhook_coalesce_sec = parser.getfloat('WEBHOOK', 'COALESCE_SECONDS', fallback=5)
+    run_start = time.time()
+    # Runs of multi_site.py share the metrics registry, and multi_site.py records the start and duration of the run
+    run_gauges = redox_client is None
+    if run_gauges:
+        METRICS.set('run_start_timestamp_seconds', run_start)
+    archive = None
+    # Order statuses are written to REDCap, unless this is a dry run without WRITEBACK
+    writeback = not dry_run_archive or dry_run_writeback
+    try:
+        # Redcap configuration
+        redcap = Redcap(redcap_api_endpoint, redcap_api_token,
+                        mirror_path=redcap_mirror_file, mirror_overlap_sec=redcap_mirror_overlap_sec,
+                        mirror_server_timezone=redcap_server_timezone,
+                        order_id_store=redcap_order_id_store, order_id_block_size=redcap_order_id_block_size,
+                        export_page_size=redcap_export_page_size, field_map=redcap_field_map,
+                        order_id_prefix=redcap_order_id_prefix,
+                        # Rehearsals don't use up order IDs, unless the orders are written to REDCap
+                        order_id_store_readonly=not writeback)
+        if args.verify_mirror:
+            if redcap.mirror is None:
+                logger.warning('--verify-mirror was given, but MIRROR_FILE is not configured')
             else:
-                order_log += f'Order ID {order_id} attempt failed on {datestr}.\n'
-                redcap.update_order_status(record_id=local_id,
-                                        order_new=Redcap.YesNo.NO,
-                                        order_status=Redcap.OrderStatus.FAILED,
-                                        order_date=datestr,
-                                        order_id=order_id,
-                                        order_log=order_log,
-                                        form_complete=Redcap.FormComplete.INCOMPLETE)
-
-    ##################################################################################
-    # Invitae currently does not support order status checks. Code below commented out
-    ################################################################################## 
-
-    # # Give Invitae a little time before querying for order status
-    # if query_wait_sec > 0:
-    #     time.sleep(query_wait_sec)
-
-    # # Check the status of pending orders
-    # participant_info = redcap.pull_info_for_query_order()
-    # if not participant_info:
-    #     logger.info('No order statuses need to be checked')
-    # else:
-    #     # Currently in development. Show what information has been collecetd and verify before continuing to send data out
-    #     logger.debug('The following participant data have been collected for checking order status:')
-    #     logger.debug(participant_info)
-    #     if input('Enter "yes" to continue: ') != 'yes':
-    #         logger.debug('Exiting script prior to checking Redox order statuses.')
-    #         exit()
-
-    #     for p in participant_info:
-    #         response = redox.query_order(patient_id=p[Redcap.FIELD_LAB_ID])
-    #         if not response:
-    #             next
-
-    #         current_status = p[Redcap.FIELD_ORDER_STATUS]
-
-    #         # Fake status update for testing
-    #         if current_status == '2':
-    #             new_status = Redcap.OrderStatus.RECEIVED
-    #         elif current_status == '3':
-    #             new_status =Redcap.OrderStatus.COMPLETED
-    #         redcap.update_order_status(record_id=p[Redcap.FIELD_RECORD_ID],
-    #                                 order_status=new_status)
-
-    if error_handler.fired:
-        emailer.sendmail('Invitae Redox API issue', 'An issue occurred in the Invitae Redox script. Please check the logs.')
+                redcap.verify_mirror(repair=True)
+        if args.sync_order_ids:
+            redcap.sync_order_ids()
+        if redcap_writeback_chunk_size > 1:
+            redcap.enable_writeback_buffer(chunk_size=redcap_writeback_chunk_size,
+                                           flush_interval_sec=redcap_writeback_flush_sec)
+
+        # Submission journal: finish the REDCap writebacks of an interrupted batch before placing new orders
+        journal = None
+        skip_record_ids = None
+        if journal_file and not writeback:
+            logger.info('Dry run without REDCap writeback: the submission journal is not used')
+        elif journal_file:
+            journal = SubmissionJournal(journal_file, record_id_field=Redcap.FIELD_RECORD_ID)
+            redcap.add_writeback_listener(journal.written_back)
+            if args.journal_release is not None:
+                n_released = journal.release(args.journal_release or None)
+                logger.info(f'Journal: released {n_released} unconfirmed orders')
+            journal.prune(journal_retention_days)
+            skip_record_ids = resume_from_journal(journal, redcap)
+        elif args.journal_release is not None:
+            logger.warning('--journal-release was given, but the JOURNAL FILE is not configured')
+
+        # R4 configuration
+        metree_cache = None
+        if metree_cache_dir:
+            metree_cache = MetreeCache(metree_cache_dir, max_bytes=metree_cache_max_mb * 1024 * 1024,
+                                       max_age_sec=metree_cache_max_age_hours * 3600,
+                                       missing_max_age_sec=metree_cache_missing_max_age_min * 60)
+        r4 = R4(r4_api_endpoint, r4_api_token, metree_cache=metree_cache)
+
+        # While we're developing the script, force double check of which projects we're working on
+        CHECK_BEFORE_RUNNING = development
+        if args.daemon and CHECK_BEFORE_RUNNING:
+            logger.error('--daemon cannot be used with DEVELOPMENT = True, which asks for confirmation before sending orders')
+            return
+        if args.daemon and not writeback:
+            logger.error('--daemon cannot be used for a dry run without WRITEBACK, which would order the same '
+                         'participants each cycle')
+            return
+        if CHECK_BEFORE_RUNNING:
+            # Project info is only needed for this check
+            redcap_project_title = redcap.project.export_project_info()['project_title']
+            r4_project_title = r4.export_project_info()['project_title']
+            msg = f'Working on\nRedcap project: {redcap_project_title}\nR4 project: {r4_project_title}.\nEnter the "YeS" to continue:\n'
+            if input(msg) != "YeS":
+                print('Exiting')
+                return
+
+        def connect_redox():
+            # Redox configuration and authentication. RedoxInvitaeAPI is imported here, so runs with nothing to
+            # order don't load it.
+            from redox import RedoxInvitaeAPI
+            redox = RedoxInvitaeAPI(redox_api_base_url, redox_api_key, redox_api_secret, client=redox_client,
+                                    archive=archive, destinations=redox_destinations,
+                                    facility_code=redox_facility_code, **redox_options)
+            if archive is not None:
+                # Dry run: nothing is sent to Redox
+                return redox
+            if not redox.authenticate():
+                msg = 'Unable to authenticate with Redox. Exiting without processing any orders.'
+                logger.error(msg)
+                return None
+            return redox
+
+        poller = None
+        if query_enabled and dry_run_archive:
+            logger.info('Dry run: order statuses are not checked')
+        elif query_enabled:
+            poller = OrderStatusPoller(redcap, store_path=query_store_file, batch_size=query_batch_size,
+                                       first_query_delay_sec=query_wait_sec,
+                                       min_interval_sec=query_min_interval_min * 60,
+                                       max_interval_sec=query_max_interval_hours * 3600,
+                                       age_fraction=query_age_fraction)
+
+        if dry_run_archive:
+            archive = OrderArchive(dry_run_archive, compress_level=dry_run_compress_level)
+            logger.info(f'Dry run: new orders are written to {dry_run_archive} instead of being sent to Redox'
+                        + ('' if writeback else ', and REDCap is not updated'))
+
+        if args.daemon:
+            # Daemon servers are only imported in daemon mode, to keep cron runs starting fast
+            from daemon import OrderDaemon
+            from trigger import TriggerQueue, TriggerServer
+            from results_webhook import ResultsQueue, ResultsReconciler, WebhookServer
+
+            # Connect once and keep the connection warm
+            redox = connect_redox()
+            if redox is None:
+                return
+            trigger_queue = TriggerQueue()
+            # Each unconfirmed order is reported once, not every cycle
+            reported_unconfirmed = set()
+
+            def order(participant_info, stop_event):
+                skip_record_ids = None
+                if journal is not None:
+                    journal.prune(journal_retention_days)
+                    skip_record_ids = resume_from_journal(journal, redcap, reported=reported_unconfirmed)
+                # MeTree files may have changed since the last cycle. The MeTree cache has its own expiration.
+                r4.clear_prefetched()
+                n_success = place_new_orders(participant_info, redcap, r4, redox, development,
+                                             workers=args.workers, prefetch_workers=r4_prefetch_workers,
+                                             chunk_size=redcap_export_page_size, journal=journal,
+                                             skip_record_ids=skip_record_ids, stop_event=stop_event,
+                                             writeback=writeback)
+                # Metrics accumulate over the life of the daemon
+                if run_gauges:
+                    METRICS.set('run_duration_seconds', time.time() - run_start)
+                write_metrics(metrics_prometheus_file, metrics_json_file)
+                return n_success
+
+            def sweep(stop_event):
+                # All participants ready for order, including any queued by triggers
+                trigger_queue.drain()
+                result = {'orders_submitted': order(redcap.iter_info_for_new_order(), stop_event)}
+                if poller is not None:
+                    result.update(check_order_statuses(redcap, poller, lambda: redox, development, stop_event))
+                return result
+
+            def order_triggered(stop_event):
+                record_ids = trigger_queue.drain()
+                if not record_ids:
+                    return {'orders_submitted': 0, 'records_checked': 0}
+                logger.info(f'Checking {len(record_ids)} records from Data Entry Triggers')
+                return {'orders_submitted': order(redcap.iter_info_for_records(record_ids), stop_event),
+                        'records_checked': len(record_ids)}
+
+            # Order statuses pushed by Redox are applied to REDCap in the background
+            results_queue = None
+            reconciler = None
+            webhook_server = None
+            if webhook_port:
+                if not webhook_token:
+                    logger.warning('The Redox results webhook has no VERIFICATION_TOKEN. Messages from any host are accepted.')
+                if not webhook_queue_file:
+                    logger.warning('The Redox results webhook has no QUEUE_FILE. Queued messages are lost if the daemon stops.')
+                results_queue = ResultsQueue(webhook_queue_file)
+                reconciler = ResultsReconciler(results_queue, redcap, batch_size=webhook_batch_size,
+                                               coalesce_sec=webhook_coalesce_sec).start()
+                webhook_server = WebhookServer(results_queue, host=webhook_host, port=webhook_port,
+                                               verification_token=webhook_token, on_message=reconciler.wake).start()
+
+            def status_info():
+                info = {'redox_available': redox.available, 'triggers_queued': len(trigger_queue)}
+                if results_queue is not None:
+                    info['webhook_messages_queued'] = len(results_queue)
+                return info
+
+            daemon = OrderDaemon(sweep, interval_sec=daemon_interval_sec, status_host=daemon_status_host,
+                                 status_port=daemon_status_port, health_max_age_sec=daemon_health_max_age_sec,
+                                 status_info=status_info, wake_cycle=order_triggered)
+            trigger_server = None
+            if trigger_port:
+                trigger_server = TriggerServer(trigger_queue, host=trigger_host, port=trigger_port,
+                                               token=trigger_token, project_id=trigger_project_id,
+                                               on_trigger=daemon.wake).start()
+            try:
+                daemon.run()
+            finally:
+                if trigger_server is not None:
+                    trigger_server.stop()
+                if webhook_server is not None:
+                    # Stop receiving, then apply what's already queued
+                    webhook_server.stop()
+                    reconciler.stop()
+                    reconciler.apply_pending()
+                    results_queue.close()
+            return
+
+        # Place new orders with Invitae
+        if CHECK_BEFORE_RUNNING:
+            participant_info = redcap.pull_info_for_new_order()
+            if participant_info:
+                # Currently in development. Show what information has been collecetd and verify before continuing to send data out
+                logger.debug('The following participant data have been collected for placing new orders:')
+                logger.debug('; '.join(f"{p[Redcap.FIELD_RECORD_ID]}: {p[Redcap.FIELD_NAME_FIRST]} {p[Redcap.FIELD_NAME_LAST]}" for p in participant_info))
+                if input('Enter "yes" to continue: ') != 'yes':
+                    logger.debug('Exiting script prior to sending Redox orders.')
+                    return
+        else:
+            # Stream participants from REDCap page by page
+            participant_info = redcap.iter_info_for_new_order()
+
+        # Only connect to Redox when there is something to order or to check
+        redox = None
+
+        def get_redox():
+            nonlocal redox
+            if redox is None:
+                redox = connect_redox()
+            return redox
+
+        participant_info = iter(participant_info)
+        first = next(participant_info, None)
+        if first is None:
+            logger.info('No new orders are needed')
+        else:
+            if get_redox() is None:
+                return
+            place_new_orders(chain([first], participant_info), redcap, r4, redox, development, workers=args.workers,
+                             prefetch_workers=r4_prefetch_workers, chunk_size=redcap_export_page_size,
+                             journal=journal, skip_record_ids=skip_record_ids, writeback=writeback)
+
+        # Check the status of submitted orders that are due for a check
+        if poller is not None:
+            check_order_statuses(redcap, poller, get_redox, development)
+    finally:
+        if archive is not None:
+            archive.close()
+        if run_gauges:
+            METRICS.set('run_duration_seconds', time.time() - run_start)
+        write_metrics(metrics_prometheus_file, metrics_json_file)
+
+
+
+def main(argv=None):
+    '''
+    Batch entry point: places new orders for all participants marked as ready in REDCap
+
+    Params
+    ------
+    argv: [Optional] Command line arguments. Defaults to sys.argv[1:]
+    '''
+    args = parse_args(argv)
+
+    # Read config file
+    parser = ConfigParser(inline_comment_prefixes=['#'])
+    parser.read(args.config)
+
+    logging_pipeline = configure_logging(parser)
+    logger = logging.getLogger()
+    logger.info('Begin Invitae Redox batch script')
+
+    emailer, alert_handler = start_alerts(parser)
+    try:
+        run(parser, args)
+    finally:
+        # Send the remaining alerts
+        logger.removeHandler(alert_handler)
+        emailer.stop()
+        logging_pipeline.stop()
+
+
+if __name__ == "__main__":
+    main()
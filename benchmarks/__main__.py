@@ -0,0 +1,110 @@
+''' Runs all benchmarks, saves the results as JSON, and compares them with a stored baseline
+
+Run from the repository root:
+    python -m benchmarks                   # run and compare with benchmarks/baseline.json if it exists
+    python -m benchmarks --save-baseline   # run and store the results as the new baseline
+
+Exits with status 1 if any benchmark is slower than the baseline by more than the threshold.
+'''
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+
+from . import bench_aoe, bench_redcap, bench_startup, bench_template, bench_utils
+from .common import format_time
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(_DIR, 'results.json')
+
+
+def run_all(scale=1.0):
+    '''
+    Params
+    ------
+    scale: Multiplier for synthetic cohort sizes
+
+    Return
+    ------
+    Dict of benchmark name: seconds per operation
+    '''
+    results = dict()
+    for title, func in [('utils.py mapping functions and family history', lambda: bench_utils.run(int(10000 * scale))),
+                        ('AOE derivation', lambda: bench_aoe.run(int(100000 * scale))),
+                        ('New order payload construction', bench_template.run),
+                        ('Redcap.pull_info_for_new_order', lambda: bench_redcap.run(int(20000 * scale))),
+                        ('batch_order.py cold start', bench_startup.run)]:
+        print(f'\n== {title} ==')
+        results.update(func())
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compares results with baseline results
+
+    Return
+    ------
+    List of names of benchmarks slower than baseline by more than threshold (fraction)
+    '''
+    regressions = list()
+    print(f'\n== Comparison with baseline ({baseline["meta"]["timestamp"]}) ==')
+    for name, t in results.items():
+        t_base = baseline['results'].get(name)
+        if t_base is None:
+            print(f'{name:72s} {format_time(t):>10s}  (new)')
+            continue
+        change = t / t_base - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:72s} {format_time(t):>10s}  {change:+7.1%}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Order-building benchmarks')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Where to write results (JSON)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results to compare with (JSON)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown relative to baseline reported as a regression (default: 0.2 = 20%%)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for synthetic cohort sizes')
+    args = parser.parse_args(argv)
+
+    results = run_all(args.scale)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'scale': args.scale,
+            'unit': 'seconds per operation',
+        },
+        'results': results,
+    }
+    output = DEFAULT_BASELINE if args.save_baseline else args.output
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline['meta'].get('scale') != args.scale:
+        print(f'Warning: baseline was run with scale {baseline["meta"].get("scale")}')
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f'\n{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
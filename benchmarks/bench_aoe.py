@@ -0,0 +1,42 @@
+''' Per-record vs batch derivation of AOE values (race, ancestry, primary indication, patient history)
+
+Run from the repository root: python -m benchmarks.bench_aoe [n_participants]
+'''
+import sys
+
+from utils import (
+    convert_emerge_race_to_redox_race,
+    convert_emerge_race_to_invitae_ancestry,
+    get_invitae_primary_indication,
+    describe_patient_history,
+    derive_aoe_batch
+    )
+
+from .common import measure, quiet_logging, format_time
+from .synthetic import synthetic_cohort
+
+
+def per_record(cohort):
+    return ([convert_emerge_race_to_redox_race(r) for r in cohort],
+            [convert_emerge_race_to_invitae_ancestry(r) for r in cohort],
+            [get_invitae_primary_indication(r) for r in cohort],
+            [describe_patient_history(r) for r in cohort])
+
+
+def run(n=100000):
+    quiet_logging()
+    cohort = synthetic_cohort(n)
+    # Also a warmup: the first call of derive_aoe_batch imports numpy
+    if tuple(derive_aoe_batch(cohort)) != per_record(cohort):
+        raise AssertionError('derive_aoe_batch output differs from the per-record functions')
+    t_per_record = measure(lambda: per_record(cohort), number=1, repeat=3)
+    t_batch = measure(lambda: derive_aoe_batch(cohort), number=1, repeat=3)
+
+    print(f'{n} participants (outputs identical)')
+    print(f'{"per-record functions":40s} {format_time(t_per_record)}')
+    print(f'{"derive_aoe_batch":40s} {format_time(t_batch)}')
+    return {'aoe: per-record': t_per_record / n, 'aoe: batch': t_batch / n}
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
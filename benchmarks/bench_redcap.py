@@ -0,0 +1,61 @@
+''' Cost of selecting participants for new orders in Redcap.pull_info_for_new_order, against a stubbed Project
+
+Run from the repository root: python -m benchmarks.bench_redcap [n_participants]
+'''
+import os
+import sys
+import tempfile
+
+from redcap_invitae import Redcap
+from redcap_mirror import RedcapMirror
+
+from .common import measure, quiet_logging, format_time
+from .stubs import StubProject
+from .synthetic import synthetic_cohort
+
+
+def _stubbed_redcap(project, mirror_path=None):
+    redcap = Redcap('http://localhost/api/', '0' * 32)
+    redcap.project = project
+    if mirror_path:
+        redcap.mirror = RedcapMirror(project, mirror_path,
+                                     fields=Redcap._FIELDS_MIRROR,
+                                     forms=[Redcap._FORM_INVITAE_ORDER],
+                                     field_record_id=Redcap.FIELD_RECORD_ID,
+                                     field_order_ready=Redcap.FIELD_ORDER_READY,
+                                     field_order_status=Redcap.FIELD_ORDER_STATUS,
+                                     field_order_id=Redcap.FIELD_ORDER_ID)
+    return redcap
+
+
+def run(n=20000):
+    quiet_logging()
+    cohort = synthetic_cohort(n)
+    project = StubProject(cohort, record_id_field=Redcap.FIELD_RECORD_ID)
+
+    redcap = _stubbed_redcap(project)
+    n_eligible = len(redcap.pull_info_for_new_order())
+    results = {
+        'pull_info_for_new_order: per project record': measure(redcap.pull_info_for_new_order) / n,
+        'pull_info_for_new_order: per eligible record':
+            measure(redcap.pull_info_for_new_order) / max(1, n_eligible),
+        'Redcap._check_new_order_eligibility': measure(lambda: [Redcap._check_new_order_eligibility(r)
+                                                                for r in cohort]) / n,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mirrored = _stubbed_redcap(project, os.path.join(tmp_dir, 'mirror.sqlite3'))
+        # Initial full export. Later pulls within Redcap._MIRROR_MIN_SYNC_INTERVAL_SEC only query the mirror.
+        mirrored.pull_info_for_new_order()
+        results['pull_info_for_new_order (mirror): per project record'] = \
+            measure(mirrored.pull_info_for_new_order) / n
+        mirrored.mirror.close()
+
+    print(f'{n} participants, {n_eligible} eligible')
+    for name, t in results.items():
+        print(f'{name:52s} {format_time(t)}')
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
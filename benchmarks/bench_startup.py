@@ -0,0 +1,61 @@
+''' Cold-start cost of batch_order.py: imports and a run with nothing to order, each in a fresh interpreter
+
+The no-op run goes against the local stand-ins in loadtest.standin, with no participants marked as ready.
+
+Run from the repository root: python -m benchmarks.bench_startup
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest.driver import write_config
+from loadtest.standin import StandinServer
+
+from .common import format_time
+from .synthetic import synthetic_cohort
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_process(code, cwd=None, repeat=5):
+    ''' Best wall time in seconds of running code in a new Python interpreter '''
+    env = dict(os.environ, PYTHONPATH=_ROOT)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=cwd or _ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def noop_run(repeat=5):
+    ''' Best wall time of batch_order.main when no participant is ready for order '''
+    participants = synthetic_cohort(200, seed=0, ready_fraction=0.0)
+    options = argparse.Namespace(workers=1, refresh_margin=0, client_rate_limit=0, max_retries=0, backoff_base=0.1,
+                                 page_size=500, writeback_chunk_size=50, prefetch_workers=4, metrics_dir=None)
+    with StandinServer(participants) as server, tempfile.TemporaryDirectory() as workdir:
+        config_path = os.path.join(workdir, 'redox-api.config')
+        write_config(config_path, server, workdir, options)
+        return measure_process(f'import batch_order; batch_order.main(["--config", {config_path!r}])',
+                               cwd=workdir, repeat=repeat)
+
+
+def run():
+    results = {
+        'startup: python interpreter': measure_process('pass'),
+        'startup: import batch_order': measure_process('import batch_order'),
+        'startup: import batch_order + order models': measure_process(
+            'import batch_order, redox.invitae, redox.model.order_new'),
+        'startup: no-op run (nothing to order)': noop_run(),
+    }
+    for name, t in results.items():
+        print(f'{name:48s} {format_time(t)}')
+    return results
+
+
+if __name__ == '__main__':
+    run()
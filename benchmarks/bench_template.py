@@ -0,0 +1,115 @@
+''' Per-order cost of building a new order message from new_order_template.json
+
+Run from the repository root: python -m benchmarks.bench_template
+'''
+from datetime import datetime
+from importlib import resources
+from unittest import mock
+
+from redox import invitae, json_templates
+from redox.invitae import RedoxInvitaeAPI, _new_order_template, _NEW_ORDER_WRITABLE
+from redox.model.order_new import Model as OrderNew
+
+from .common import measure, quiet_logging, format_time
+
+
+def parse_template():
+    ''' Previous approach: read and validate the template for every order '''
+    template = resources.files(json_templates).joinpath('new_order_template.json').read_text()
+    return OrderNew.parse_raw(template)
+
+
+def copy_template():
+    ''' Cached template: full copy of the template validated once '''
+    return _new_order_template.new()
+
+
+def copy_on_write_template():
+    ''' Cached template: copy of only the parts put_new_order fills in '''
+    return _new_order_template.new(*_NEW_ORDER_WRITABLE)
+
+
+ORDERS = [
+    dict(patient_id='L1', patient_name_first='Peter', patient_name_last='Parker',
+         patient_dob='1992-03-14', patient_sex='Male', patient_redox_race='White',
+         patient_invitae_ancestry=['White/Caucasian'], order_id='COLUMBIA_ORDER_20220701_001',
+         prim_ind='Other', is_ind_aff='Yes', pat_hist='Current conditions: asthma.',
+         has_fam_hist='Yes', fam_hist='MOTHER: breast cancer (age 45).', test=True),
+    dict(patient_id='L2', patient_name_first='Zoë', patient_name_last='O\'Brien "MJ"',
+         patient_dob='1990-01-01', patient_sex='Female', patient_redox_race='Other Race',
+         patient_invitae_ancestry=[], order_id='COLUMBIA_ORDER_20220701_002',
+         prim_ind='Other', is_ind_aff='No', pat_hist='', has_fam_hist='No', fam_hist='', test=False),
+]
+
+
+def build_order(api):
+    return api.put_new_order(**ORDERS[0])
+
+
+def build_order_model(patient_id, patient_name_first, patient_name_last, patient_dob, patient_sex,
+                      patient_redox_race, patient_invitae_ancestry, order_id, prim_ind, is_ind_aff, pat_hist,
+                      has_fam_hist, fam_hist, test=False, datetime_iso='2022-07-01T12:00:00.123Z'):
+    ''' Previous approach: fill in a copy of the pydantic model and serialize it with json(exclude_unset=True) '''
+    message = _new_order_template.new(*_NEW_ORDER_WRITABLE)
+    message.Meta.EventDateTime = datetime_iso
+    message.Meta.Test = test
+    message.Patient.Identifiers[0].ID = patient_id
+    demogs = message.Patient.Demographics
+    demogs.FirstName = patient_name_first
+    demogs.LastName = patient_name_last
+    demogs.DOB = patient_dob
+    demogs.Sex = patient_sex
+    demogs.Race = patient_redox_race
+    order = message.Order
+    order.ID = order_id
+    order.TransactionDateTime = datetime_iso
+    clinical_info = order.ClinicalInfo
+    clinical_info.append({"Code": "prim_ind", "Description": "Primary Indication", "Value": prim_ind})
+    clinical_info.append({"Code": "is_ind_aff", "Description": "Is the patient affected or symptomatic?",
+                          "Value": is_ind_aff})
+    if pat_hist:
+        clinical_info.append({"Code": "pat_hist", "Description": "Describe patient history, incl. age of diagnosis",
+                              "Value": pat_hist})
+    clinical_info.append({"Code": "has_fam_hist", "Description": "Family history of disease?", "Value": has_fam_hist})
+    if fam_hist:
+        clinical_info.append({"Code": "fam_hist", "Description": "Describe family history, incl. age(s) of diagnosis",
+                              "Value": fam_hist})
+    if patient_invitae_ancestry:
+        clinical_info.append({"Code": "pat_anc", "Description": "Patient Ancestry",
+                              "Value": '|'.join(patient_invitae_ancestry)})
+    return message.json(exclude_unset=True)
+
+
+class _FixedDatetime(datetime):
+    @classmethod
+    def utcnow(cls):
+        return datetime(2022, 7, 1, 12, 0, 0, 123456)
+
+
+def check_identical(api):
+    ''' Raises AssertionError unless put_new_order gives the same JSON as the previous approach '''
+    with mock.patch.object(invitae, 'datetime', _FixedDatetime):
+        for order in ORDERS:
+            _, j = api.put_new_order(**order)
+            expected = build_order_model(**order)
+            assert j == expected, f'put_new_order output differs from the model JSON:\n{j}\n{expected}'
+
+
+def run():
+    quiet_logging()
+    api = RedoxInvitaeAPI('http://localhost/', 'key', 'secret')
+    check_identical(api)
+    results = {
+        'template: read + parse_raw': measure(parse_template),
+        'template: cached full copy': measure(copy_template),
+        'template: cached copy-on-write': measure(copy_on_write_template),
+        'put_new_order: model + json(exclude_unset=True)': measure(lambda: build_order_model(**ORDERS[0])),
+        'put_new_order (SEND_REDOX=False)': measure(lambda: build_order(api)),
+    }
+    for name, t in results.items():
+        print(f'{name:48s} {format_time(t)}')
+    return results
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,56 @@
+''' Per-participant cost of the mapping functions in utils.py and of generate_family_history
+
+Run from the repository root: python -m benchmarks.bench_utils
+'''
+import json
+
+from utils import (
+    convert_emerge_race_to_redox_race,
+    convert_emerge_race_to_invitae_ancestry,
+    map_redcap_sex_to_redox_sex,
+    get_invitae_primary_indication,
+    describe_patient_history,
+    generate_family_history
+    )
+
+from .common import measure, quiet_logging, format_time
+from .synthetic import synthetic_cohort, synthetic_pedigree
+
+# Pedigree sizes: a typical family and a very large one
+PEDIGREE_SIZES = {'small': 6, 'large': 5000}
+
+
+def _per_record(func, records):
+    def _run():
+        for r in records:
+            func(r)
+    return _run
+
+
+def run(n=10000):
+    quiet_logging()
+    cohort = synthetic_cohort(n)
+    sexes = [r['sex_at_birth'] for r in cohort]
+    results = {
+        'utils: convert_emerge_race_to_redox_race': measure(_per_record(convert_emerge_race_to_redox_race, cohort)) / n,
+        'utils: convert_emerge_race_to_invitae_ancestry':
+            measure(_per_record(convert_emerge_race_to_invitae_ancestry, cohort)) / n,
+        'utils: map_redcap_sex_to_redox_sex': measure(_per_record(map_redcap_sex_to_redox_sex, sexes)) / n,
+        'utils: get_invitae_primary_indication': measure(_per_record(get_invitae_primary_indication, cohort)) / n,
+        'utils: describe_patient_history': measure(_per_record(describe_patient_history, cohort)) / n,
+    }
+    for size_name, n_members in PEDIGREE_SIZES.items():
+        pedigree = synthetic_pedigree(n_members)
+        pedigree_str = json.dumps(pedigree)
+        results[f'generate_family_history: {size_name} ({n_members} members)'] = \
+            measure(lambda: generate_family_history(pedigree))
+        results[f'generate_family_history: {size_name} ({n_members} members), JSON string'] = \
+            measure(lambda: generate_family_history(pedigree_str))
+
+    for name, t in results.items():
+        print(f'{name:72s} {format_time(t)}')
+    return results
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,30 @@
+import logging
+import timeit
+
+
+def measure(func, number=None, repeat=5):
+    ''' Times func and returns the best per-call time in seconds across repeats
+
+    Params
+    ------
+    func: Callable with no arguments
+    number: Calls per repeat. If None, chosen automatically so each repeat takes at least 0.2 seconds
+    repeat: Number of repeats
+    '''
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def quiet_logging():
+    ''' Silences logging so that log I/O isn't part of the measurement '''
+    logging.disable(logging.CRITICAL)
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f} us'
+    elif seconds < 1:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds:.2f} s'
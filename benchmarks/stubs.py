@@ -0,0 +1,29 @@
+''' In-memory stand-ins for external services, so benchmarks measure only local processing '''
+import re
+
+_FILTER_EQUALS = re.compile(r"\[(\w+)\]\s*=\s*'([^']*)'")
+
+
+class StubProject:
+    ''' Implements the parts of PyCap's Project used by Redcap against a list of records
+
+    filter_logic supports simple "[field] = 'value'" conditions joined by "and".
+    '''
+    def __init__(self, records, record_id_field='cuimc_id'):
+        self.record_id_field = record_id_field
+        self.records = {r[record_id_field]: r for r in records}
+
+    def export_records(self, records=None, fields=None, forms=None, filter_logic=None, **kwargs):
+        conditions = _FILTER_EQUALS.findall(filter_logic) if filter_logic else []
+        if records is not None:
+            selected = (self.records[x] for x in records if x in self.records)
+        else:
+            selected = self.records.values()
+        return [dict(r) for r in selected if all(r.get(f) == v for f, v in conditions)]
+
+    def import_records(self, to_import, return_content='count', **kwargs):
+        for r in to_import:
+            self.records.setdefault(r[self.record_id_field], {}).update(r)
+        if return_content == 'ids':
+            return [r[self.record_id_field] for r in to_import]
+        return {'count': len(to_import)}
@@ -0,0 +1,79 @@
+''' Synthetic participants and pedigrees for benchmarks, scaled up from test_data.json '''
+import json
+import os
+import random
+
+from redcap_invitae import Redcap
+
+_TEST_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data.json')
+
+_METREE_RELATIONS = ['MOTHER', 'FATHER', 'SISTER', 'BROTHER', 'DAUGHTER', 'SON', 'MATERNAL_GRANDMOTHER',
+                     'MATERNAL_GRANDFATHER', 'PATERNAL_GRANDMOTHER', 'PATERNAL_GRANDFATHER', 'MATERNAL_AUNT',
+                     'PATERNAL_UNCLE', 'MATERNAL_COUSIN', 'NIECE', 'NEPHEW']
+_METREE_CONDITIONS = ['breast_cancer', 'ovarian_cancer', 'prostate_cancer', 'colon_cancer', 'heart_attack',
+                      'high_cholesterol', 'diabetes', 'stroke', 'other']
+
+
+def load_test_participants():
+    with open(_TEST_DATA, 'r') as f:
+        return json.load(f)
+
+
+def synthetic_cohort(n, seed=0, ready_fraction=0.05):
+    '''
+    Participants based on the test participants in test_data.json, with unique IDs and random race, Ashkenazi,
+    personal health history, and order readiness values. About 20% of participants use REDCap label format
+    ('Checked' / 'Unchecked') instead of raw values for checkboxes.
+
+    Params
+    ------
+    n: Number of participants
+    seed: Random seed, so cohorts are reproducible
+    ready_fraction: Fraction of participants marked as ready for order
+    '''
+    rng = random.Random(seed)
+    templates = load_test_participants()
+    checkbox_fields = [f + '___1' for f in Redcap.FIELDS_BPHH]
+    cohort = []
+    for i in range(n):
+        record = dict(templates[i % len(templates)])
+        record[Redcap.FIELD_RECORD_ID] = str(i + 1)
+        record[Redcap.FIELD_R4_RECORD_ID] = f'R{i + 1}'
+        record[Redcap.FIELD_LAB_ID] = f'L{i + 1}'
+
+        checked, unchecked = ('1', '0') if rng.random() < 0.8 else ('Checked', 'Unchecked')
+        for j in range(1, 10):
+            record[f'race_at_enrollment___{j}'] = checked if rng.random() < 0.15 else unchecked
+        record[Redcap.FIELD_ASHKENAZI] = rng.choice(['', '0', '1', 'Yes', 'No'])
+        for f in checkbox_fields:
+            record[f] = checked if rng.random() < 0.08 else unchecked
+
+        record[Redcap.FIELD_ORDER_READY] = '1' if rng.random() < ready_fraction else '0'
+        record[Redcap.FIELD_SAMPLE_RECEIVED] = '1' if rng.random() < 0.95 else '0'
+        record[Redcap.FIELD_SAMPLE_REPLACE] = '1' if rng.random() < 0.02 else '0'
+        record[Redcap.FIELD_WITHDRAWAL] = '1' if rng.random() < 0.01 else '0'
+        record[Redcap.FIELD_ORDER_STATUS] = ''
+        record[Redcap.FIELD_ORDER_ID] = ''
+        record[Redcap.FIELD_ORDER_LOG] = ''
+        cohort.append(record)
+    return cohort
+
+
+def synthetic_pedigree(n_members, seed=0):
+    '''
+    MeTree JSON data (list of dicts) for a participant and n_members - 1 relatives
+    '''
+    rng = random.Random(seed)
+    pedigree = []
+    for i in range(n_members):
+        conditions = []
+        for _ in range(rng.choice([0, 0, 1, 1, 2, 3])):
+            condition_id = rng.choice(_METREE_CONDITIONS)
+            meta = {'other': 'migraines'} if condition_id == 'other' else {}
+            conditions.append({'id': condition_id, 'age': rng.choice([None, rng.randint(20, 90)]), 'meta': meta})
+        pedigree.append({
+            'relation': 'SELF' if i == 0 else rng.choice(_METREE_RELATIONS),
+            'conditions': conditions,
+            'medicalHistory': rng.choice(['', 'healthy', 'unknown']),
+        })
+    return pedigree
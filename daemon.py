@@ -0,0 +1,203 @@
+''' Daemon mode: runs the order batch on an interval in one long-running process
+
+REDCap, R4, and Redox clients (HTTP connections, Redox access token, order ID block, MeTree cache) stay warm between
+cycles. SIGTERM and SIGINT stop the daemon gracefully: the cycle in progress stops taking new participants,
+finishes the ones already started, and flushes REDCap writebacks before the process exits.
+
+An optional status server answers:
+    GET /health   200 "ok" while cycles are completing, otherwise 503
+    GET /status   JSON with the state of the daemon and its last cycle
+    GET /metrics  Run metrics in the Prometheus text format (see metrics.METRICS)
+'''
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import signal
+import threading
+import time
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class OrderDaemon:
+    ''' Calls cycle every interval_sec until stopped
+
+    cycle is called with a threading.Event that is set when the daemon is asked to stop, so long cycles can end
+    early. It may return a dict of results, which is shown in /status. An exception ends the cycle, not the daemon.
+
+    wake() runs wake_cycle (or cycle) right away, e.g., to order records queued by a REDCap Data Entry Trigger.
+    Cycles never overlap, and cycles started by wake() don't move the schedule of the regular cycles.
+    '''
+    def __init__(self, cycle, interval_sec=60, status_host='127.0.0.1', status_port=0, health_max_age_sec=None,
+                 status_info=None, wake_cycle=None):
+        '''
+        Params
+        ------
+        cycle: Function run each cycle, called with the stop event
+        interval_sec: Time from the start of one cycle to the start of the next
+        status_host, status_port: Address of the status server. No status server if status_port is 0 or None
+        health_max_age_sec: /health fails when no cycle has completed for this long. Defaults to 3 intervals
+                            plus a minute
+        status_info: [Optional] Function returning a dict of extra information for /status
+        wake_cycle: [Optional] Function run instead of cycle when the daemon is woken up by wake()
+        '''
+        self.cycle = cycle
+        self.wake_cycle = wake_cycle or cycle
+        self.interval_sec = interval_sec
+        self.health_max_age_sec = health_max_age_sec or 3 * interval_sec + 60
+        self.status_info = status_info
+        self.stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            'state': 'starting',
+            'started_at': None,
+            'cycles': 0,
+            'failed_cycles': 0,
+            'consecutive_failures': 0,
+            'last_cycle_start': None,
+            'last_cycle_duration_sec': None,
+            'last_cycle_error': None,
+            'last_cycle_result': None,
+            'last_success': None,
+            'next_cycle': None,
+        }
+        self._last_success_monotonic = None
+        self._started_monotonic = None
+        self._server = None
+        self._server_thread = None
+        if status_port:
+            self._server = ThreadingHTTPServer((status_host, status_port), _make_handler(self))
+            self._server.daemon_threads = True
+
+    @property
+    def status_address(self):
+        ''' (host, port) of the status server, or None '''
+        return self._server.server_address[:2] if self._server is not None else None
+
+    def stop(self, *args):
+        ''' Asks the daemon to stop after the current cycle. Can be used as a signal handler. '''
+        if not self.stop_event.is_set():
+            logger.info('Stopping the order daemon')
+        self.stop_event.set()
+        self._wake_event.set()
+
+    def wake(self):
+        ''' Starts the next cycle right away instead of waiting for the interval '''
+        self._wake_event.set()
+
+    def _set_status(self, **kwargs):
+        with self._lock:
+            self._status.update(kwargs)
+
+    def status(self):
+        ''' Dict describing the state of the daemon and its last cycle '''
+        with self._lock:
+            status = dict(self._status)
+        status['healthy'] = self.healthy()
+        status['interval_sec'] = self.interval_sec
+        if self.status_info is not None:
+            status.update(self.status_info())
+        return status
+
+    def healthy(self):
+        ''' True if the daemon is running and a cycle has completed recently (or it is within its first cycles) '''
+        with self._lock:
+            state = self._status['state']
+        if state not in ('running', 'waiting'):
+            return False
+        now = time.monotonic()
+        last = self._last_success_monotonic if self._last_success_monotonic is not None else self._started_monotonic
+        return now - last <= self.health_max_age_sec
+
+    def _run_cycle(self, cycle, stage):
+        start = time.monotonic()
+        self._set_status(state='running', last_cycle_start=datetime.now().isoformat(timespec='seconds'))
+        try:
+            with METRICS.timer(stage):
+                result = cycle(self.stop_event)
+        except Exception as e:
+            logger.exception('Order daemon cycle failed')
+            with self._lock:
+                self._status['failed_cycles'] += 1
+                self._status['consecutive_failures'] += 1
+                self._status['last_cycle_error'] = f'{type(e).__name__}: {e}'
+        else:
+            self._last_success_monotonic = time.monotonic()
+            with self._lock:
+                self._status['consecutive_failures'] = 0
+                self._status['last_cycle_error'] = None
+                self._status['last_cycle_result'] = result
+                self._status['last_success'] = datetime.now().isoformat(timespec='seconds')
+        finally:
+            with self._lock:
+                self._status['cycles'] += 1
+                self._status['last_cycle_duration_sec'] = round(time.monotonic() - start, 3)
+
+    def run(self):
+        ''' Runs cycles until stop is called or SIGTERM / SIGINT is received '''
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._started_monotonic = time.monotonic()
+        self._set_status(state='waiting', started_at=datetime.now().isoformat(timespec='seconds'))
+        if self._server is not None:
+            self._server_thread = threading.Thread(target=self._server.serve_forever, name='status', daemon=True)
+            self._server_thread.start()
+            host, port = self.status_address
+            logger.info(f'Order daemon status server listening on http://{host}:{port}/')
+
+        logger.info(f'Order daemon started. Checking for new orders every {self.interval_sec}s')
+        next_run = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                wait = next_run - time.monotonic()
+                if wait > 0:
+                    self._set_status(state='waiting', next_cycle=datetime.fromtimestamp(time.time() + wait)
+                                     .isoformat(timespec='seconds'))
+                    self._wake_event.wait(wait)
+                    if self.stop_event.is_set():
+                        break
+                self._wake_event.clear()
+                if time.monotonic() >= next_run:
+                    next_run = time.monotonic() + self.interval_sec
+                    self._run_cycle(self.cycle, 'daemon_cycle')
+                else:
+                    self._run_cycle(self.wake_cycle, 'daemon_wake_cycle')
+        finally:
+            self._set_status(state='stopped', next_cycle=None)
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            logger.info('Order daemon stopped')
+
+
+def _make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(f'Status server: {self.address_string()} {format % args}')
+
+        def _send(self, status, body, content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8') if isinstance(body, str) else json.dumps(body, indent=2).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?')[0].rstrip('/')
+            if path == '/health':
+                healthy = daemon.healthy()
+                self._send(200 if healthy else 503, 'ok\n' if healthy else 'unhealthy\n', 'text/plain')
+            elif path == '/status':
+                self._send(200, daemon.status())
+            elif path == '/metrics':
+                self._send(200, METRICS.to_prometheus(), 'text/plain; version=0.0.4')
+            else:
+                self._send(404, {'error': 'Not found'})
+    return Handler
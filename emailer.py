@@ -1,35 +1,294 @@
+''' Email notifications to the developers
+
+Emailer.sendmail sends right away on the calling thread. After Emailer.start, messages are instead queued and sent by
+a background thread over one reused SMTP connection, so slow or failing mail delivery doesn't hold up orders:
+    The first messages with a subject are sent within a few seconds. Further messages with that subject within
+    digest_window_sec are combined into one digest email at the end of the window, with a count for each distinct
+    message. Messages that only differ by numbers, e.g., the same failure for different participants, are grouped.
+    A message identical to one sent within dedup_window_sec is only counted, not sent again.
+    Failed deliveries are retried a few times, then dropped and logged.
+
+AlertHandler sends log records (warnings and errors by default) through an Emailer, so each problem of a run shows
+up in the digest instead of a generic "check the logs" email.
+'''
+from collections import OrderedDict
 import logging
+import re
 import smtplib
-import sys
+import threading
+import time
 
 _MESSAGE_FORMAT = """Subject: {subject}
 
 {body}
 """
 
+_NUMBERS = re.compile(r'\d+')
+# Messages listed for each group of similar messages in a digest
+_EXAMPLES = 5
+# The first email of a subject waits this long, so a burst of messages goes out as one email
+_GATHER_SEC = 5
+
 logger = logging.getLogger(__name__)
 
 class Emailer():
-    def __init__(self, host='localhost', port=25, from_addr=None, to_addrs=None):
+    def __init__(self, host='localhost', port=25, from_addr=None, to_addrs=None, digest_window_sec=900,
+                 dedup_window_sec=86400, max_items=50, timeout_sec=30, idle_timeout_sec=60, max_attempts=3):
+        '''
+        Params
+        ------
+        host, port: SMTP server
+        from_addr, to_addrs: Default from address and list of to addresses
+        digest_window_sec: After start, messages with the same subject are sent at most once per window
+        dedup_window_sec: After start, a message identical to one sent this recently is only counted
+        max_items: Max distinct messages listed in a digest
+        timeout_sec: SMTP connection timeout
+        idle_timeout_sec: The SMTP connection is closed after this long without messages
+        max_attempts: Attempts to deliver each email before it is dropped
+        '''
         self._host = host
         self._port = port
         # Default from and to email addresses
         self._from_addr = from_addr
         self._to_addrs = to_addrs
+        self.digest_window_sec = digest_window_sec
+        self.dedup_window_sec = dedup_window_sec
+        self.max_items = max_items
+        self.timeout_sec = timeout_sec
+        self.idle_timeout_sec = idle_timeout_sec
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+        # subject: {'items': OrderedDict(body: count), 'due': send time, 'from_addr', 'to_addrs'}
+        self._pending = dict()
+        self._last_sent = dict()  # subject: time of the last email
+        self._recent = dict()  # (subject, body): time last sent
+        self._outbox = []  # [(from_addr, to_addrs, subject, body, attempts)]
+        self._smtp = None
+        self._smtp_used = 0
+        self._config_error_logged = False
+
+    def _configured(self, from_addr, to_addrs):
+        if not from_addr or not to_addrs or not self._host or not self._port:
+            # Logged once, not for every alert
+            if not self._config_error_logged:
+                logger.error('Incorrect email configuration')
+                self._config_error_logged = True
+            return False
+        return True
 
     def sendmail(self, subject, body, from_addr=None, to_addrs=None):
+        '''
+        Sends an email. After start, the email is queued (see Emailer) and this returns right away.
+        '''
         if not from_addr:
             from_addr = self._from_addr
         if not to_addrs:
             to_addrs = self._to_addrs
 
-        if not from_addr or not to_addrs or not self._host or not self._port:
-            logging.error('Incorrect email configuration')
+        if not self._configured(from_addr, to_addrs):
             return
 
-        with smtplib.SMTP(self._host, self._port) as smtp_obj:
+        if self._thread is None:
+            try:
+                with smtplib.SMTP(self._host, self._port, timeout=self.timeout_sec) as smtp_obj:
+                    message = _MESSAGE_FORMAT.format(subject=subject, body=body)
+                    smtp_obj.sendmail(from_addr, to_addrs, message)
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error(f'Error sending email: {e}')
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get(subject)
+            if pending is None:
+                # Send after a few seconds, or at the end of the digest window if this subject was emailed recently
+                last = self._last_sent.get(subject)
+                due = now + _GATHER_SEC if last is None else max(now + _GATHER_SEC, last + self.digest_window_sec)
+                pending = self._pending[subject] = {'items': OrderedDict(), 'due': due,
+                                                    'from_addr': from_addr, 'to_addrs': to_addrs}
+            pending['items'][body] = pending['items'].get(body, 0) + 1
+            self._wake.notify()
+
+    def _digest(self, subject, items, now):
+        ''' Body of the email for the queued messages of a subject, or None if they were all sent recently '''
+        new = [(body, count) for body, count in items.items()
+               if now - self._recent.get((subject, body), -self.dedup_window_sec - 1) > self.dedup_window_sec]
+        n_repeated = sum(count for body, count in items.items()
+                         if now - self._recent.get((subject, body), -self.dedup_window_sec - 1) <= self.dedup_window_sec)
+        if not new:
+            return None
+        for body, _ in new:
+            self._recent[(subject, body)] = now
+        if len(new) == 1 and new[0][1] == 1 and not n_repeated:
+            return new[0][0]
+
+        # Messages that only differ by numbers (e.g., the same failure for different participants) are grouped
+        groups = OrderedDict()
+        for body, count in new:
+            groups.setdefault(_NUMBERS.sub('#', body), []).append((body, count))
+        total = sum(count for _, count in new)
+        lines = [f'{total} messages ({len(new)} distinct):', '']
+        n_listed = n_groups = 0
+        for pattern, bodies in groups.items():
+            if n_listed >= self.max_items:
+                break
+            n_groups += 1
+            if len(bodies) == 1:
+                body, count = bodies[0]
+                lines.append(f'[{count}x] {body}' if count > 1 else body)
+                n_listed += 1
+                continue
+            lines.append(f'[{sum(count for _, count in bodies)}x, {len(bodies)} distinct] {pattern}')
+            examples = bodies[:min(_EXAMPLES, self.max_items - n_listed)]
+            for body, count in examples:
+                lines.append(f'    [{count}x] {body}' if count > 1 else f'    {body}')
+            if len(bodies) > len(examples):
+                lines.append(f'    ... and {len(bodies) - len(examples)} more')
+            n_listed += len(examples)
+        if len(groups) > n_groups:
+            lines.append(f'... and {len(groups) - n_groups} more kinds of messages')
+        if n_repeated:
+            lines += ['', f'{n_repeated} repeats of messages already sent in the last '
+                          f'{self.dedup_window_sec / 3600:g} hours are not listed']
+        return '\n'.join(lines)
+
+    def _take_due(self, now):
+        ''' Moves digests that are due to the outbox. Returns the time the next digest is due, or None '''
+        next_due = None
+        for subject in list(self._pending):
+            pending = self._pending[subject]
+            if pending['due'] <= now or self._stopping:
+                del self._pending[subject]
+                self._last_sent[subject] = now
+                body = self._digest(subject, pending['items'], now)
+                if body is not None:
+                    self._outbox.append((pending['from_addr'], pending['to_addrs'], subject, body, 0))
+            elif next_due is None or pending['due'] < next_due:
+                next_due = pending['due']
+        # Forget messages older than the dedup window
+        self._recent = {k: t for k, t in self._recent.items() if now - t <= self.dedup_window_sec}
+        return next_due
+
+    def _connection(self):
+        if self._smtp is not None:
             try:
-                message = _MESSAGE_FORMAT.format(subject=subject, body=body)
-                smtp_obj.sendmail(from_addr, to_addrs, message)
-            except smtplib.SMTPException:
-                logging.error(f'Error sending email: {sys.exc_info()[0]}')
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close_connection()
+        self._smtp = smtplib.SMTP(self._host, self._port, timeout=self.timeout_sec)
+        return self._smtp
+
+    def _close_connection(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def _deliver(self, from_addr, to_addrs, subject, body):
+        message = _MESSAGE_FORMAT.format(subject=subject, body=body)
+        self._connection().sendmail(from_addr, to_addrs, message)
+        self._smtp_used = time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    now = time.monotonic()
+                    next_due = self._take_due(now)
+                    if self._outbox or (self._stopping and not self._pending):
+                        break
+                    timeout = None if next_due is None else next_due - now
+                    if self._smtp is not None:
+                        idle_left = self._smtp_used + self.idle_timeout_sec - now
+                        if idle_left <= 0:
+                            break
+                        timeout = idle_left if timeout is None else min(timeout, idle_left)
+                    self._wake.wait(timeout)
+                outbox, self._outbox = self._outbox, []
+                stopping = self._stopping
+
+            retry = []
+            for from_addr, to_addrs, subject, body, attempts in outbox:
+                try:
+                    self._deliver(from_addr, to_addrs, subject, body)
+                except (smtplib.SMTPException, OSError) as e:
+                    self._close_connection()
+                    if attempts + 1 < self.max_attempts and not stopping:
+                        retry.append((from_addr, to_addrs, subject, body, attempts + 1))
+                    else:
+                        logger.error(f'Error sending email "{subject}": {e}. Email dropped.')
+            if not outbox and self._smtp is not None and time.monotonic() - self._smtp_used >= self.idle_timeout_sec:
+                self._close_connection()
+
+            if retry:
+                with self._lock:
+                    self._outbox = retry + self._outbox
+                    if not self._stopping:
+                        # Back off before trying again
+                        self._wake.wait(min(60, 5 * retry[0][4]))
+            elif stopping:
+                with self._lock:
+                    if not self._outbox and not self._pending:
+                        break
+        self._close_connection()
+
+    def start(self):
+        ''' Queues messages from now on and sends them from a background thread (see Emailer) '''
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='emailer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout_sec=60):
+        ''' Sends all queued messages, including digests not yet due, and stops the background thread '''
+        if self._thread is None:
+            return
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+        self._thread.join(timeout_sec)
+        if self._thread.is_alive():
+            logger.error('Timed out sending queued emails')
+        self._thread = None
+
+
+class AlertHandler(logging.Handler):
+    ''' Logging handler that emails log records through an Emailer, e.g., as digests after Emailer.start '''
+    def __init__(self, emailer, subject, level=logging.WARNING, max_length=300):
+        '''
+        Params
+        ------
+        emailer: Emailer
+        subject: Subject of the emails
+        level: Lowest level emailed
+        max_length: Messages are cut to this many characters, so order details (e.g., names in order logs) are
+                    not emailed
+        '''
+        super().__init__(level)
+        self.emailer = emailer
+        self.subject = subject
+        self.max_length = max_length
+
+    def emit(self, record):
+        # Problems sending email are only logged, or they would be emailed again
+        if record.name == logger.name:
+            return
+        try:
+            message = record.getMessage().splitlines()[0] if record.getMessage() else ''
+            if len(message) > self.max_length:
+                message = message[:self.max_length] + '...'
+            # Site of multi-site runs (see log_setup.log_context)
+            site = getattr(record, 'site', None)
+            source = f'{record.name} [{site}]' if site else record.name
+            self.emailer.sendmail(self.subject, f'{record.levelname} {source}: {message}')
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionJournal:
+    ''' Append-only local journal of each order's progress, so an interrupted batch can resume
+
+    Each order moves through these states, recorded as events in a SQLite database in WAL mode:
+        ALLOCATED    order ID allocated for the participant
+        BUILT        order information gathered; the order is about to be sent to Redox
+        POSTED       Redox responded (accepted or rejected). The REDCap order status update is stored with the event.
+        WRITTEN_BACK the order status update was imported to REDCap
+    DEFERRED means the order was not placed (Redox unavailable) and the participant can be ordered again.
+    RELEASED is recorded when an unconfirmed order (see unconfirmed) is cleared by hand.
+
+    On restart, POSTED orders still waiting for their REDCap writeback are written back in bulk, and those
+    participants are skipped. Orders left in BUILT were interrupted while being sent, or sent without Redox confirming
+    them (see RedoxOutcomeUnknownError), so it's unknown whether Redox received them. They are skipped until checked
+    and released, to avoid ordering twice.
+    '''
+    ALLOCATED = 'allocated'
+    BUILT = 'built'
+    POSTED = 'posted'
+    WRITTEN_BACK = 'written_back'
+    DEFERRED = 'deferred'
+    RELEASED = 'released'
+
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id TEXT NOT NULL,
+            order_id TEXT,
+            state TEXT NOT NULL,
+            data TEXT,
+            created_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_record ON events(record_id, seq);
+    '''
+    # Latest event of each record
+    _LATEST = '''
+        SELECT e.record_id, e.order_id, e.state, e.data, e.created_at FROM events e
+        JOIN (SELECT record_id, MAX(seq) AS seq FROM events GROUP BY record_id) latest ON e.seq = latest.seq
+    '''
+
+    def __init__(self, path, record_id_field='cuimc_id'):
+        '''
+        Params
+        ------
+        path: SQLite file
+        record_id_field: Record ID field of the order status updates (see Redcap.FIELD_RECORD_ID)
+        '''
+        self.path = path
+        self.record_id_field = record_id_field
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode, NORMAL keeps committed events through a crash of this process
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SubmissionJournal._SCHEMA)
+
+    def _append(self, record_id, order_id, state, data=None):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO events (record_id, order_id, state, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                               (str(record_id), order_id, state, json.dumps(data) if data is not None else None,
+                                datetime.now().isoformat(timespec='seconds')))
+
+    def _latest(self, states):
+        placeholders = ', '.join('?' for _ in states)
+        with self._lock:
+            return self._conn.execute(f'{SubmissionJournal._LATEST} WHERE e.state IN ({placeholders}) ORDER BY e.seq',
+                                      tuple(states)).fetchall()
+
+    def allocated(self, record_id, order_id):
+        self._append(record_id, order_id, SubmissionJournal.ALLOCATED)
+
+    def built(self, record_id, order_id):
+        self._append(record_id, order_id, SubmissionJournal.BUILT)
+
+    def posted(self, record_id, order_id, update):
+        '''
+        Params
+        ------
+        update: REDCap order status update to write back (see Redcap.build_order_status_record)
+        '''
+        self._append(record_id, order_id, SubmissionJournal.POSTED, update)
+
+    def deferred(self, record_id, order_id):
+        self._append(record_id, order_id, SubmissionJournal.DEFERRED)
+
+    def written_back(self, update):
+        '''
+        Records that an order status update was imported to REDCap. Can be used as a Redcap writeback listener.
+        Ignored unless the record's latest event is POSTED.
+
+        Params
+        ------
+        update: Order status update that was imported (dict with the record ID field)
+        '''
+        record_id = str(update[self.record_id_field])
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT order_id, state FROM events WHERE record_id = ? ORDER BY seq DESC LIMIT 1',
+                                     (record_id,)).fetchone()
+            if row is None or row[1] != SubmissionJournal.POSTED:
+                return
+            self._conn.execute('INSERT INTO events (record_id, order_id, state, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                               (record_id, row[0], SubmissionJournal.WRITTEN_BACK, None,
+                                datetime.now().isoformat(timespec='seconds')))
+
+    def pending_writebacks(self):
+        '''
+        Return
+        ------
+        List of order status updates for orders that were posted but not yet written back to REDCap
+        '''
+        return [json.loads(data) for _, _, _, data, _ in self._latest([SubmissionJournal.POSTED])]
+
+    def unconfirmed(self):
+        '''
+        Return
+        ------
+        List of (record ID, order ID, time) for orders interrupted while being sent to Redox or not confirmed by Redox
+        '''
+        return [(record_id, order_id, created_at)
+                for record_id, order_id, _, _, created_at in self._latest([SubmissionJournal.BUILT])]
+
+    def release(self, record_ids=None):
+        '''
+        Allows unconfirmed orders to be placed again, e.g., after checking with Invitae that they weren't received
+
+        Params
+        ------
+        record_ids: [Optional] Records to release. Defaults to all unconfirmed orders
+
+        Return
+        ------
+        Number of orders released
+        '''
+        unconfirmed = self.unconfirmed()
+        if record_ids is not None:
+            record_ids = set(str(x) for x in record_ids)
+            unconfirmed = [u for u in unconfirmed if u[0] in record_ids]
+        for record_id, order_id, _ in unconfirmed:
+            self._append(record_id, order_id, SubmissionJournal.RELEASED)
+        return len(unconfirmed)
+
+    def skip_record_ids(self):
+        '''
+        Return
+        ------
+        Set of record IDs that must not be ordered again yet: posted orders not yet written back to REDCap and
+        unconfirmed orders
+        '''
+        return set(record_id for record_id, *_ in self._latest([SubmissionJournal.POSTED, SubmissionJournal.BUILT]))
+
+    def prune(self, retention_days):
+        '''
+        Removes the events of records whose latest event is older than retention_days, unless the order still needs
+        attention (posted but not written back, or unconfirmed)
+
+        Return
+        ------
+        Number of events removed
+        '''
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(timespec='seconds')
+        with self._lock, self._conn:
+            cursor = self._conn.execute(f'''
+                DELETE FROM events WHERE record_id IN (
+                    SELECT e.record_id FROM ({SubmissionJournal._LATEST}) e
+                    WHERE e.created_at < ? AND e.state NOT IN (?, ?))
+                ''', (cutoff, SubmissionJournal.POSTED, SubmissionJournal.BUILT))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def resume_from_journal(journal, redcap, reported=None):
+    '''
+    Finishes the work of an interrupted batch: writes back order statuses of orders that were posted to Redox but
+    not recorded in REDCap, and reports orders interrupted while being sent
+
+    Params
+    ------
+    journal: SubmissionJournal
+    redcap: Redcap
+    reported: [Optional] Set of (record ID, order ID) of unconfirmed orders already reported, e.g., by an earlier
+              daemon cycle. Those are not reported again. Newly reported orders are added to it.
+
+    Return
+    ------
+    Set of record IDs to skip in this batch
+    '''
+    pending = journal.pending_writebacks()
+    if pending:
+        logger.info(f'Journal: writing back {len(pending)} order statuses from an interrupted batch')
+        results = redcap.write_order_status_records(pending)
+        n_failed = sum(1 for success in results.values() if not success)
+        if n_failed:
+            logger.error(f'Journal: {n_failed} order status writebacks failed again. '
+                         'Those participants are skipped until the writeback succeeds.')
+
+    for record_id, order_id, created_at in journal.unconfirmed():
+        if reported is not None:
+            if (record_id, order_id) in reported:
+                continue
+            reported.add((record_id, order_id))
+        logger.error(f'Journal: order {order_id} for CUIMC {record_id} was interrupted while being sent to Redox or '
+                     f'not confirmed by Redox ({created_at}). Check whether Invitae received it, then release it with '
+                     '--journal-release.')
+
+    return journal.skip_record_ids()
@@ -0,0 +1,255 @@
+''' Load driver: runs the batch entry point (batch_order.main) against the local stand-ins in loadtest.standin
+
+Generates synthetic participants (all marked as ready for order), starts the stand-ins, writes a configuration
+file pointing batch_order.py at them, and runs one batch. Reports throughput, per-participant latency
+percentiles, and response times per stand-in route.
+
+Run from the repository root, e.g.:
+    python -m loadtest.driver --participants 5000 --workers 8 --latency-ms 50 --error-rate 0.01
+'''
+from argparse import ArgumentParser
+from contextlib import redirect_stderr
+from configparser import ConfigParser
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import batch_order
+from metrics import METRICS
+import order_archive
+from redox import invitae
+from redcap_invitae import Redcap
+from benchmarks.synthetic import synthetic_cohort, synthetic_pedigree
+
+from .smtp_standin import SmtpStandin
+from .standin import StandinServer, ServiceOptions, percentiles
+
+
+def write_config(path, server, workdir, options):
+    ''' Writes a batch_order.py configuration file for the stand-ins '''
+    config = ConfigParser()
+    config['GENERAL'] = {'DEVELOPMENT': 'False'}
+    config['REDOX'] = {
+        'BASE_URL': server.redox_url,
+        'REDOX_API_KEY': 'loadtest-key',
+        'REDOX_API_SECRET': 'loadtest-secret',
+        'POOL_MAXSIZE': str(options.workers),
+        'TOKEN_REFRESH_MARGIN_SECONDS': str(options.refresh_margin),
+        'RATE_LIMIT_PER_SECOND': str(options.client_rate_limit),
+        'MAX_RETRIES': str(options.max_retries),
+        'BACKOFF_BASE_SECONDS': str(options.backoff_base),
+        'BACKOFF_MAX_SECONDS': '5',
+    }
+    config['REDCAP'] = {
+        'LOCAL_REDCAP_URL': server.redcap_url,
+        'LOCAL_REDCAP_API_KEY': 'A' * 32,
+        'EXPORT_PAGE_SIZE': str(options.page_size),
+        'WRITEBACK_CHUNK_SIZE': str(options.writeback_chunk_size),
+        'WRITEBACK_FLUSH_SECONDS': '30',
+        'ORDER_ID_STORE': os.path.join(workdir, 'order_ids.sqlite3'),
+        'ORDER_ID_BLOCK_SIZE': '100',
+    }
+    config['R4'] = {
+        'R4_URL': server.r4_url,
+        'R4_API_KEY': 'B' * 32,
+        'METREE_PREFETCH_WORKERS': str(options.prefetch_workers),
+    }
+    config['JOURNAL'] = {'FILE': os.path.join(workdir, 'journal.sqlite3')}
+    config['LOGGING'] = {'FILE_FORMAT': 'json'}
+    if getattr(options, 'dry_run', None):
+        config['DRY_RUN'] = {'ARCHIVE_FILE': options.dry_run}
+    if options.metrics_dir:
+        config['METRICS'] = {'PROMETHEUS_FILE': os.path.join(options.metrics_dir, 'loadtest.prom'),
+                             'JSON_FILE': os.path.join(options.metrics_dir, 'loadtest-metrics.json')}
+    smtp = getattr(options, 'smtp_server', None)
+    if smtp is not None:
+        config['EMAIL'] = {'SMTP_HOST': smtp.host, 'SMTP_PORT': str(smtp.port), 'FROM_ADDR': 'loadtest@localhost',
+                           'TO_ADDRS': 'dev@localhost', 'DIGEST_MINUTES': '15'}
+    else:
+        # No SMTP host: error notifications are logged instead of sent
+        config['EMAIL'] = {'SMTP_HOST': '', 'SMTP_PORT': '25', 'FROM_ADDR': '', 'TO_ADDRS': ''}
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def _timed(func, latencies, lock):
+    ''' Wraps process_participant to record the time spent on each participant '''
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run(options):
+    '''
+    Return
+    ------
+    Dict with the load test results
+    '''
+    participants = synthetic_cohort(options.participants, seed=options.seed, ready_fraction=1.0)
+    metree = {p[Redcap.FIELD_R4_RECORD_ID]: synthetic_pedigree(options.pedigree_size, seed=i)
+              for i, p in enumerate(participants) if i % 10}  # Every 10th participant has no MeTree file
+    # Participants that pass the safeguard checks in Redcap (some synthetic participants don't, e.g., by age)
+    logging.disable(logging.WARNING)
+    eligible_ids = [p[Redcap.FIELD_RECORD_ID] for p in participants if Redcap._check_new_order_eligibility(p)]
+    logging.disable(logging.NOTSET)
+    service_options = {service: ServiceOptions(latency_ms=options.latency_ms, error_rate=options.error_rate)
+                       for service in ('redox', 'redcap', 'r4')}
+    server = StandinServer(participants, metree, token_lifetime_sec=options.token_lifetime,
+                           redox_rate_limit=options.rate_limit, seed=options.seed, **service_options)
+    # Alert emails go to the SMTP stand-in
+    options.smtp_server = (SmtpStandin(latency_ms=getattr(options, 'smtp_latency_ms', 0)).start()
+                           if getattr(options, 'smtp', False) else None)
+
+    # Counts such as metree_missing_total are read from the registry after the run
+    METRICS.reset()
+    latencies = []
+    original = batch_order.process_participant
+    batch_order.process_participant = _timed(original, latencies, threading.Lock())
+    # Orders go to the Redox stand-in
+    send_redox = invitae.SEND_REDOX
+    invitae.SEND_REDOX = True
+    cwd = os.getcwd()
+    root_handlers = list(logging.getLogger().handlers)
+    try:
+        with server, tempfile.TemporaryDirectory() as workdir:
+            config_path = os.path.join(workdir, 'redox-api.config')
+            write_config(config_path, server, workdir, options)
+            # batch_order.py writes redox.log in the working directory
+            os.chdir(workdir)
+            console_path = os.path.join(workdir, 'console.log')
+            start = time.perf_counter()
+            with open(console_path, 'w') as console:
+                if options.verbose:
+                    batch_order.main(['--config', config_path, '--workers', str(options.workers)])
+                else:
+                    with redirect_stderr(console):
+                        batch_order.main(['--config', config_path, '--workers', str(options.workers)])
+            elapsed = time.perf_counter() - start
+            os.chdir(cwd)
+            if options.keep_logs:
+                for name in ('redox.log', 'console.log'):
+                    if os.path.exists(os.path.join(workdir, name)):
+                        os.replace(os.path.join(workdir, name), os.path.join(options.keep_logs, f'loadtest-{name}'))
+    finally:
+        os.chdir(cwd)
+        # Remove the log handlers added by batch_order.main
+        for handler in logging.getLogger().handlers[:]:
+            if handler not in root_handlers:
+                logging.getLogger().removeHandler(handler)
+                handler.close()
+        batch_order.process_participant = original
+        invitae.SEND_REDOX = send_redox
+        if options.smtp_server is not None:
+            options.smtp_server.stop()
+
+    statuses = [r.get(Redcap.FIELD_ORDER_STATUS) for r in server.redcap.records.values()]
+    order_ids = [r.get(Redcap.FIELD_ORDER_ID) for r in server.redcap.records.values() if r.get(Redcap.FIELD_ORDER_ID)]
+    n_submitted = statuses.count(Redcap.OrderStatus.SUBMITTED.value)
+    counters = METRICS.summary()['counters']
+    routes = server.stats.summary()
+    return {
+        'participants': options.participants,
+        'eligible': len(eligible_ids),
+        'workers': options.workers,
+        'elapsed_sec': elapsed,
+        'processed': len(latencies),
+        'submitted': n_submitted,
+        'failed': statuses.count(Redcap.OrderStatus.FAILED.value),
+        # Still marked as ready for order after the run, e.g., deferred because Redox was unavailable
+        'still_ready': sum(1 for x in eligible_ids
+                           if server.redcap.records[x].get(Redcap.FIELD_ORDER_READY) == Redcap.YesNo.YES.value),
+        'orders_received_by_redox': len(server.orders),
+        'orders_archived': len(order_archive.load_index(options.dry_run)) if options.dry_run else 0,
+        'duplicate_order_ids': len(order_ids) - len(set(order_ids)),
+        # MeTree file exports the R4 stand-in answered with REDCap's "no file" error, and how many the run counted
+        # as missing MeTree
+        'metree_files_absent': routes.get('r4:file:export', {}).get('status', {}).get('400', 0),
+        'metree_missing': sum(x['value'] for x in counters.get('metree_missing_total', [])),
+        'emails_sent': len(options.smtp_server.messages) if options.smtp_server else 0,
+        'smtp_connections': options.smtp_server.connections if options.smtp_server else 0,
+        'throughput_per_sec': len(latencies) / elapsed if elapsed else 0,
+        'participant_latency_sec': percentiles(latencies),
+        'routes': routes,
+    }
+
+
+def print_report(results):
+    print(f'{results["participants"]} participants ({results["eligible"]} eligible), {results["workers"]} workers: '
+          f'{results["elapsed_sec"]:.2f} s, {results["throughput_per_sec"]:.1f} participants/s')
+    print(f'Submitted: {results["submitted"]}  Failed: {results["failed"]}  '
+          f'Still ready for order: {results["still_ready"]}  '
+          f'Orders received by Redox: {results["orders_received_by_redox"]}  '
+          f'Duplicate order IDs: {results["duplicate_order_ids"]}'
+          + (f'  Orders archived (dry run): {results["orders_archived"]}' if results['orders_archived'] else ''))
+    print(f'MeTree missing: {results["metree_missing"]} (R4 answers without a MeTree file: '
+          f'{results["metree_files_absent"]})')
+    if results['metree_missing'] < results['metree_files_absent']:
+        print('WARNING: records without a MeTree file were not counted as missing MeTree')
+    if results['smtp_connections']:
+        print(f'Alert emails: {results["emails_sent"]} over {results["smtp_connections"]} SMTP connections')
+    latency = results['participant_latency_sec']
+    print('Participant latency (ms): ' + '  '.join(f'{k} {v * 1000:.1f}' for k, v in latency.items()))
+    print(f'\n{"Route":32s} {"Count":>7s} {"p50 ms":>8s} {"p95 ms":>8s} {"p99 ms":>8s}  Status')
+    for route, r in results['routes'].items():
+        print(f'{route:32s} {r["count"]:7d} {r["p50"] * 1000:8.1f} {r["p95"] * 1000:8.1f} {r["p99"] * 1000:8.1f}  '
+              + ', '.join(f'{k}: {v}' for k, v in sorted(r['status'].items())))
+
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description='Runs batch_order.py against local Redox, REDCap, and R4 stand-ins')
+    arg_parser.add_argument('--participants', type=int, default=2000, help='Number of synthetic participants')
+    arg_parser.add_argument('--workers', type=int, default=8, help='batch_order.py --workers')
+    arg_parser.add_argument('--prefetch-workers', type=int, default=4, help='METREE_PREFETCH_WORKERS')
+    arg_parser.add_argument('--page-size', type=int, default=500, help='EXPORT_PAGE_SIZE')
+    arg_parser.add_argument('--writeback-chunk-size', type=int, default=50, help='WRITEBACK_CHUNK_SIZE')
+    arg_parser.add_argument('--pedigree-size', type=int, default=12, help='Family members per MeTree file')
+    arg_parser.add_argument('--latency-ms', type=float, default=20, help='Mean added response time of each service')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    arg_parser.add_argument('--rate-limit', type=int, default=0,
+                            help='Redox order requests per second before 429 responses (0 = no limit)')
+    arg_parser.add_argument('--client-rate-limit', type=float, default=0,
+                            help='RATE_LIMIT_PER_SECOND of the batch (0 = no client-side limit)')
+    arg_parser.add_argument('--max-retries', type=int, default=3, help='MAX_RETRIES of the batch')
+    arg_parser.add_argument('--backoff-base', type=float, default=0.1, help='BACKOFF_BASE_SECONDS of the batch')
+    arg_parser.add_argument('--token-lifetime', type=int, default=3600, help='Redox access token lifetime (seconds)')
+    arg_parser.add_argument('--refresh-margin', type=int, default=0, help='TOKEN_REFRESH_MARGIN_SECONDS')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    arg_parser.add_argument('--output', help='Write results to this JSON file')
+    arg_parser.add_argument('--keep-logs', metavar='DIR', help='Keep the batch logs in this directory')
+    arg_parser.add_argument('--metrics-dir', metavar='DIR', help='Write the batch metrics to this directory')
+    arg_parser.add_argument('--dry-run', metavar='ARCHIVE_FILE',
+                            help='Run the batch as a dry run, writing orders to this archive (see order_archive.py)')
+    arg_parser.add_argument('--smtp', action='store_true',
+                            help='Send alert emails to a local SMTP stand-in (see loadtest/smtp_standin.py)')
+    arg_parser.add_argument('--smtp-latency-ms', type=float, default=0,
+                            help='With --smtp, added delay of each SMTP reply')
+    arg_parser.add_argument('--verbose', action='store_true', help='Show the batch console log')
+    options = arg_parser.parse_args(argv)
+    if options.keep_logs:
+        options.keep_logs = os.path.abspath(options.keep_logs)
+    if options.output:
+        options.output = os.path.abspath(options.output)
+    if options.metrics_dir:
+        options.metrics_dir = os.path.abspath(options.metrics_dir)
+    if options.dry_run:
+        options.dry_run = os.path.abspath(options.dry_run)
+
+    results = run(options)
+    print_report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if results['processed'] == results['eligible'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+''' Local SMTP stand-in for emailer.Emailer
+
+Accepts mail on a local port and keeps the messages in memory instead of delivering them. Counts connections, so tests
+can check that queued emails share one SMTP connection, and can add latency or refuse messages to simulate a slow or
+failing mail server.
+
+Run on its own with:
+    python -m loadtest.smtp_standin --port 8025
+'''
+from argparse import ArgumentParser
+import email
+import socketserver
+import threading
+import time
+
+
+class SmtpStandin:
+    ''' Minimal SMTP server (HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT) that records the messages it receives '''
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, fail=False):
+        '''
+        Params
+        ------
+        host, port: Address to listen on. Port 0 picks a free port.
+        latency_ms: Added delay before each reply
+        fail: Refuse messages (451 reply to DATA) while True
+        '''
+        self.latency_ms = latency_ms
+        self.fail = fail
+        self.messages = []  # [{'from', 'to', 'subject', 'body', 'data'}]
+        self.connections = 0
+        self._lock = threading.Lock()
+        standin = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                if standin.latency_ms:
+                    time.sleep(standin.latency_ms / 1000)
+                self.wfile.write(f'{line}\r\n'.encode('ascii'))
+                self.wfile.flush()
+
+            def handle(self):
+                with standin._lock:
+                    standin.connections += 1
+                self.reply('220 smtp-standin ready')
+                mail_from, rcpt_to = None, []
+                for raw in self.rfile:
+                    line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+                    command = line[:4].upper()
+                    if command in ('HELO', 'EHLO'):
+                        self.reply('250 smtp-standin')
+                    elif command == 'MAIL':
+                        mail_from, rcpt_to = line.split(':', 1)[1].strip(), []
+                        self.reply('250 OK')
+                    elif command == 'RCPT':
+                        rcpt_to.append(line.split(':', 1)[1].strip())
+                        self.reply('250 OK')
+                    elif command == 'DATA':
+                        if standin.fail:
+                            self.reply('451 Requested action aborted')
+                            continue
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for raw_data in self.rfile:
+                            data_line = raw_data.decode('utf-8', 'replace').rstrip('\r\n')
+                            if data_line == '.':
+                                break
+                            data.append(data_line[1:] if data_line.startswith('..') else data_line)
+                        standin._record(mail_from, rcpt_to, '\n'.join(data))
+                        self.reply('250 OK')
+                    elif command == 'RSET':
+                        mail_from, rcpt_to = None, []
+                        self.reply('250 OK')
+                    elif command == 'NOOP':
+                        self.reply('250 OK')
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def _record(self, mail_from, rcpt_to, data):
+        message = email.message_from_string(data)
+        with self._lock:
+            self.messages.append({'from': mail_from, 'to': rcpt_to, 'subject': message['Subject'],
+                                  'body': message.get_payload(), 'data': data})
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='smtp-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description='Local SMTP stand-in that prints the emails it receives')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8025)
+    arg_parser.add_argument('--latency-ms', type=float, default=0, help='Added delay before each reply')
+    options = arg_parser.parse_args(argv)
+    with SmtpStandin(options.host, options.port, latency_ms=options.latency_ms) as server:
+        print(f'SMTP stand-in listening on {server.host}:{server.port}')
+        n_printed = 0
+        try:
+            while True:
+                time.sleep(0.5)
+                for message in server.messages[n_printed:]:
+                    print(f'--- {message["from"]} -> {", ".join(message["to"])} '
+                          f'({server.connections} connections so far)\n{message["data"]}\n')
+                n_printed = len(server.messages)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
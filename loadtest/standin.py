@@ -0,0 +1,480 @@
+''' Local stand-ins for Redox, REDCap, and R4, for end-to-end load testing of batch_order.py
+
+One HTTP server handles all three services:
+    http://<host>:<port>/redox/      Redox API (auth/authenticate, auth/refreshToken, endpoint for new orders and
+                                     order queries)
+    http://<host>:<port>/redcap/api/ Local REDCap API (records, metadata, project info)
+    http://<host>:<port>/r4/api/     R4 API (records, metadata, project info, MeTree file export)
+
+Each service has configurable latency and error rate. Redox access tokens expire after a configurable lifetime
+(requests with expired tokens get 401), and Redox order requests above a configurable rate get 429 with Retry-After.
+Orders received by Redox become Received, then Completed, after configurable times, as seen by Order Query messages.
+
+Run on its own from the repository root: python -m loadtest.standin --port 8080 --participants 1000
+'''
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import html
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+_FILTER_EQUALS = re.compile(r"\[(\w+)\]\s*=\s*'([^']*)'")
+_INDEXED_PARAM = re.compile(r'^(\w+)\[(\d+)\]$')
+
+
+class ServiceOptions:
+    ''' Simulated behavior of one service '''
+    def __init__(self, latency_ms=0, jitter=0.5, error_rate=0.0):
+        '''
+        Params
+        ------
+        latency_ms: Mean added response time
+        jitter: Response time varies uniformly by +/- this fraction of latency_ms
+        error_rate: Fraction of requests answered with HTTP 500
+        '''
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+
+class Stats:
+    ''' Response times and status codes per route '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = dict()
+
+    def record(self, route, status, duration_sec):
+        with self._lock:
+            self.requests.setdefault(route, []).append((status, duration_sec))
+
+    def summary(self):
+        '''
+        Return
+        ------
+        Dict of route: dict with count, counts by status code, and response time percentiles in seconds
+        '''
+        with self._lock:
+            requests = {route: list(values) for route, values in self.requests.items()}
+        summary = dict()
+        for route, values in sorted(requests.items()):
+            statuses = dict()
+            for status, _ in values:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            summary[route] = {'count': len(values), 'status': statuses,
+                              **percentiles([d for _, d in values])}
+        return summary
+
+
+def percentiles(values, points=(50, 90, 95, 99)):
+    ''' Nearest-rank percentiles (and max) of values, as a dict like {'p50': ..., 'max': ...} '''
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f'p{p}': values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))] for p in points}
+    result['max'] = values[-1]
+    return result
+
+
+class _Project:
+    ''' Records and metadata of one simulated REDCap project '''
+    def __init__(self, title, records, metadata, files=None):
+        '''
+        Params
+        ------
+        title: Project title
+        records: List of record dicts. The first metadata field is the record ID.
+        metadata: List of REDCap metadata dicts (field_name, form_name, field_type)
+        files: [Optional] Dict of (record ID, field name): file contents (bytes)
+        '''
+        self.title = title
+        self.metadata = metadata
+        self.def_field = metadata[0]['field_name']
+        self.records = {r[self.def_field]: r for r in records}
+        self.files = files or dict()
+        self._form_fields = dict()
+        for m in metadata:
+            self._form_fields.setdefault(m['form_name'], []).append(m['field_name'])
+        self._lock = threading.Lock()
+
+    def _export_fields(self, fields, forms):
+        ''' Export field names requested with fields and forms (checkbox fields expand to all options) '''
+        if not fields and not forms:
+            return None
+        names = set(fields)
+        for form in forms:
+            names.update(self._form_fields.get(form, []))
+            names.add(f'{form}_complete')
+        return names
+
+    def export_records(self, records=None, fields=(), forms=(), filter_logic=None):
+        conditions = _FILTER_EQUALS.findall(filter_logic) if filter_logic else []
+        names = self._export_fields(fields, forms)
+        with self._lock:
+            if records:
+                selected = [self.records[x] for x in records if x in self.records]
+            else:
+                selected = list(self.records.values())
+            selected = [r for r in selected if all(r.get(f) == v for f, v in conditions)]
+            if names is None:
+                return [dict(r) for r in selected]
+            return [{k: v for k, v in r.items() if k in names or k.split('___')[0] in names} for r in selected]
+
+    def import_records(self, records):
+        with self._lock:
+            for r in records:
+                self.records.setdefault(r[self.def_field], {self.def_field: r[self.def_field]}).update(r)
+        return [r[self.def_field] for r in records]
+
+
+class StandinServer:
+    ''' Redox, REDCap, and R4 stand-ins served from one ThreadingHTTPServer
+
+    REDCap holds the participants passed in. R4 holds one record per participant, with the given MeTree file
+    when there is one. Orders received by Redox are kept in orders (Redox order ID: order ID), and the order IDs
+    asked about by Order Query messages are counted in order_queries (order ID: number of queries).
+    '''
+    REDCAP_FORM_ORDER = 'specimen_reminders'
+    REDCAP_ORDER_FIELD_PREFIXES = ('invitae_redox_', 'sp_invitae_')
+    R4_FIELD_RECORD_ID = 'record_id'
+    R4_FIELD_METREE = 'metree_import_json_file'
+
+    def __init__(self, participants, metree=None, host='127.0.0.1', port=0, redox=None, redcap=None, r4=None,
+                 token_lifetime_sec=3600, redox_rate_limit=0, seed=None, redcap_record_id_field='cuimc_id',
+                 r4_record_id_field='record_id', order_received_sec=60, order_completed_sec=600):
+        '''
+        Params
+        ------
+        participants: List of local REDCap records
+        metree: [Optional] Dict of R4 record ID: MeTree JSON data (list of dicts)
+        host, port: Address to listen on. Port 0 picks a free port.
+        redox, redcap, r4: [Optional] ServiceOptions for each service
+        token_lifetime_sec: Lifetime of Redox access tokens
+        redox_rate_limit: Max Redox order requests per second before responding 429 (0 = no limit)
+        seed: [Optional] Random seed for latency and error injection
+        redcap_record_id_field: Record ID field of the local REDCap project
+        r4_record_id_field: Field of the local REDCap records holding the R4 record ID
+        order_received_sec, order_completed_sec: Time after an order is received by Redox before Order Query
+                                                 responses show it as Received, and as Completed
+        '''
+        self.options = {'redox': redox or ServiceOptions(), 'redcap': redcap or ServiceOptions(),
+                        'r4': r4 or ServiceOptions()}
+        self.token_lifetime = timedelta(seconds=token_lifetime_sec)
+        self.redox_rate_limit = redox_rate_limit
+        self.stats = Stats()
+        self.orders = dict()
+        self.order_queries = dict()
+        self.order_received_sec = order_received_sec
+        self.order_completed_sec = order_completed_sec
+        self._order_info = dict()  # order ID: (patient ID, time received)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = dict()  # access token: expiration
+        self._refresh_tokens = set()
+        self._rate_window = (0, 0)  # (second, requests in that second)
+
+        # Local REDCap project: order fields on the order form, everything else on a baseline form
+        fields = [redcap_record_id_field] + [f for f in (participants[0] if participants else [])
+                                             if f != redcap_record_id_field]
+        base_fields = list(dict.fromkeys(f.split('___')[0] for f in fields))
+        metadata = [{'field_name': f,
+                     'form_name': StandinServer.REDCAP_FORM_ORDER if f.startswith(StandinServer.REDCAP_ORDER_FIELD_PREFIXES)
+                     else 'baseline',
+                     'field_type': 'checkbox' if f + '___1' in fields else 'text'}
+                    for f in base_fields]
+        self.redcap = _Project('Load test local REDCap', [dict(p) for p in participants], metadata)
+
+        # R4 project: one record per participant, with MeTree files
+        metree = metree or dict()
+        r4_records = [{StandinServer.R4_FIELD_RECORD_ID: p[r4_record_id_field]} for p in participants]
+        r4_metadata = [{'field_name': StandinServer.R4_FIELD_RECORD_ID, 'form_name': 'enrollment', 'field_type': 'text'},
+                       {'field_name': StandinServer.R4_FIELD_METREE, 'form_name': 'metree', 'field_type': 'file'}]
+        files = {(record_id, StandinServer.R4_FIELD_METREE): json.dumps(data).encode('utf-8')
+                 for record_id, data in metree.items()}
+        self.r4 = _Project('Load test R4', r4_records, r4_metadata, files)
+
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def redox_url(self):
+        return self.base_url + 'redox/'
+
+    @property
+    def redcap_url(self):
+        return self.base_url + 'redcap/api/'
+
+    @property
+    def r4_url(self):
+        return self.base_url + 'r4/api/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Simulation helpers
+
+    def delay(self, service):
+        options = self.options[service]
+        if options.latency_ms:
+            with self._lock:
+                factor = 1 + self._rng.uniform(-options.jitter, options.jitter)
+            time.sleep(max(0, options.latency_ms * factor) / 1000)
+
+    def inject_error(self, service):
+        rate = self.options[service].error_rate
+        if not rate:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+    def throttled(self):
+        ''' True if this Redox request is over the rate limit '''
+        if not self.redox_rate_limit:
+            return False
+        second = int(time.monotonic())
+        with self._lock:
+            window, count = self._rate_window
+            if window != second:
+                window, count = second, 0
+            count += 1
+            self._rate_window = (window, count)
+        return count > self.redox_rate_limit
+
+    def issue_token(self):
+        now = datetime.now(timezone.utc)
+        token = {'accessToken': secrets.token_hex(16), 'refreshToken': secrets.token_hex(16),
+                 'expires': (now + self.token_lifetime).isoformat().replace('+00:00', 'Z')}
+        with self._lock:
+            self._tokens[token['accessToken']] = now + self.token_lifetime
+            self._refresh_tokens.add(token['refreshToken'])
+        return token
+
+    def use_refresh_token(self, refresh_token):
+        with self._lock:
+            if refresh_token not in self._refresh_tokens:
+                return False
+            self._refresh_tokens.discard(refresh_token)
+        return True
+
+    def order_status(self, order_id):
+        ''' Status of an order received by Redox, as reported to Order Query messages, or None if not received '''
+        with self._lock:
+            info = self._order_info.get(order_id)
+        if info is None:
+            return None
+        age = time.monotonic() - info[1]
+        if age >= self.order_completed_sec:
+            return 'Completed'
+        return 'Received' if age >= self.order_received_sec else 'Pending'
+
+    def status_message(self, order_id, status):
+        ''' Message Redox would push to a destination when the order's status changes, e.g., to results_webhook '''
+        with self._lock:
+            patient_id = self._order_info.get(order_id, (None, None))[0]
+        return {'Meta': {'DataModel': 'Order', 'EventType': 'Update', 'Errors': []},
+                'Order': {'ID': order_id, 'Status': status,
+                          'Patient': {'Identifiers': [{'ID': patient_id, 'IDType': 'participant_lab_id'}]}}}
+
+    def query_orders(self, query):
+        ''' Response to an Order Query message: orders of the queried patients, limited to the queried order IDs '''
+        patient_ids = set(identifier.get('ID') for patient in query.get('Patients') or []
+                          for identifier in patient.get('Identifiers') or [])
+        order_ids = set(query.get('OrderIDs') or [])
+        with self._lock:
+            matches = [(order_id, patient_id) for order_id, (patient_id, _) in self._order_info.items()
+                       if patient_id in patient_ids and (not order_ids or order_id in order_ids)]
+            for order_id in order_ids:
+                self.order_queries[order_id] = self.order_queries.get(order_id, 0) + 1
+        orders = [{'ID': order_id, 'Status': self.order_status(order_id),
+                   'Patient': {'Identifiers': [{'ID': patient_id, 'IDType': 'participant_lab_id'}]}}
+                  for order_id, patient_id in matches]
+        meta = dict(query.get('Meta') or {})
+        meta.update({'EventType': 'QueryResponse', 'Errors': []})
+        return {'Meta': meta, 'Orders': orders}
+
+    def token_valid(self, access_token):
+        with self._lock:
+            expires = self._tokens.get(access_token)
+        return expires is not None and datetime.now(timezone.utc) < expires
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type='application/json', headers=None):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+            return status
+
+        def do_POST(self):
+            start = time.perf_counter()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            path = urlsplit(self.path).path
+            service, _, rest = path.strip('/').partition('/')
+            route = f'{service}:{rest}'
+            params = dict()
+            try:
+                if service == 'redox':
+                    data = json.loads(body or b'{}')
+                    if (data.get('Meta') or {}).get('EventType') == 'Query':
+                        route += ':query'
+                    status = self._redox(rest, data)
+                elif service in ('redcap', 'r4'):
+                    params = parse_qs(body.decode('utf-8'), keep_blank_values=True)
+                    params = {k: v[0] for k, v in params.items()}
+                    route = f'{service}:{params.get("content")}'
+                    if params.get('content') == 'file' or params.get('content') == 'record':
+                        route += f':{params.get("action", "import" if "data" in params else "export")}'
+                    status = self._redcap(service, params)
+                else:
+                    status = self._send(404, {'error': 'Not found'})
+            except Exception as e:
+                if service in ('redcap', 'r4'):
+                    status = self._redcap_error(500, f'Stand-in error: {e}', params)
+                else:
+                    status = self._send(500, {'error': f'Stand-in error: {e}'})
+            server.stats.record(route, status, time.perf_counter() - start)
+
+        # Redox
+
+        def _redox(self, endpoint, data):
+            server.delay('redox')
+            if endpoint == 'auth/authenticate':
+                if not data.get('apiKey') or not data.get('secret'):
+                    return self._send(401, b'Invalid request', 'text/plain')
+                return self._send(200, server.issue_token())
+            elif endpoint == 'auth/refreshToken':
+                if not server.use_refresh_token(data.get('refreshToken')):
+                    return self._send(401, b'Invalid refresh token', 'text/plain')
+                return self._send(200, server.issue_token())
+            elif endpoint == 'endpoint':
+                authorization = self.headers.get('Authorization', '')
+                if not server.token_valid(authorization.replace('Bearer ', '', 1)):
+                    return self._send(401, b'Invalid access token', 'text/plain')
+                if server.throttled():
+                    return self._send(429, b'Too many requests', 'text/plain', headers={'Retry-After': '1'})
+                if server.inject_error('redox'):
+                    return self._send(500, b'Internal server error', 'text/plain')
+                if (data.get('Meta') or {}).get('EventType') == 'Query':
+                    return self._send(200, server.query_orders(data))
+                redox_id = secrets.token_hex(8)
+                order_id = (data.get('Order') or {}).get('ID')
+                patient_id = (((data.get('Patient') or {}).get('Identifiers') or [{}])[0]).get('ID')
+                with server._lock:
+                    server.orders[redox_id] = order_id
+                    server._order_info[order_id] = (patient_id, time.monotonic())
+                meta = dict(data.get('Meta') or {})
+                meta.update({'Errors': [], 'Message': {'ID': redox_id}})
+                return self._send(200, {'Meta': meta})
+            return self._send(404, b'Not found', 'text/plain')
+
+        # REDCap and R4
+
+        def _redcap_error(self, status, message, params):
+            # Like REDCap, errors are in the requested returnFormat (or format), XML by default. PyCap only
+            # recognizes XML errors for requests without a format, such as file exports.
+            if (params.get('returnFormat') or params.get('format')) == 'json':
+                return self._send(status, {'error': message})
+            return self._send(status, b'<?xml version="1.0" encoding="UTF-8" ?><hash><error>'
+                                      + html.escape(message).encode('utf-8') + b'</error></hash>', 'text/xml')
+
+        def _redcap(self, service, params):
+            server.delay(service)
+            project = server.redcap if service == 'redcap' else server.r4
+            if server.inject_error(service):
+                return self._redcap_error(500, 'Simulated REDCap error', params)
+
+            content = params.get('content')
+            if content == 'project':
+                return self._send(200, {'project_id': 1, 'project_title': project.title})
+            elif content == 'metadata':
+                return self._send(200, project.metadata)
+            elif content == 'formEventMapping':
+                return self._send(400, {'error': 'You cannot export form/event mappings for classic projects'})
+            elif content == 'record' and 'data' in params:
+                records = json.loads(params['data'])
+                ids = project.import_records(records)
+                if params.get('returnContent') == 'ids':
+                    return self._send(200, ids)
+                return self._send(200, {'count': len(ids)})
+            elif content == 'record':
+                indexed = dict()
+                for k, v in params.items():
+                    m = _INDEXED_PARAM.match(k)
+                    if m:
+                        indexed.setdefault(m.group(1), []).append((int(m.group(2)), v))
+                lists = {k: [v for _, v in sorted(values)] for k, values in indexed.items()}
+                records = project.export_records(records=lists.get('records'), fields=lists.get('fields', []),
+                                                 forms=lists.get('forms', []), filter_logic=params.get('filterLogic'))
+                return self._send(200, records)
+            elif content == 'file' and params.get('action') == 'export':
+                data = project.files.get((params.get('record'), params.get('field')))
+                if data is None:
+                    return self._redcap_error(400, 'There is no file to download for this record', params)
+                return self._send(200, data, 'application/json; name="metree.json"')
+            return self._send(400, {'error': f'Unsupported content: {content}'})
+
+    return Handler
+
+
+if __name__ == '__main__':
+    import sys
+    from benchmarks.synthetic import synthetic_cohort, synthetic_pedigree
+
+    arg_parser = ArgumentParser(description='Local Redox, REDCap, and R4 stand-ins for load testing')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--participants', type=int, default=1000, help='Number of synthetic participants')
+    arg_parser.add_argument('--latency-ms', type=float, default=50, help='Mean added response time for all services')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    arg_parser.add_argument('--token-lifetime', type=int, default=3600, help='Redox access token lifetime (seconds)')
+    arg_parser.add_argument('--rate-limit', type=int, default=0, help='Max Redox order requests per second (0 = none)')
+    args = arg_parser.parse_args()
+
+    participants = synthetic_cohort(args.participants, ready_fraction=1.0)
+    metree = {p['record_id']: synthetic_pedigree(8, seed=i) for i, p in enumerate(participants)}
+    options = ServiceOptions(latency_ms=args.latency_ms, error_rate=args.error_rate)
+    server = StandinServer(participants, metree, host=args.host, port=args.port, redox=options, redcap=options,
+                           r4=options, token_lifetime_sec=args.token_lifetime, redox_rate_limit=args.rate_limit)
+    print(f'Redox:  {server.redox_url}\nREDCap: {server.redcap_url}\nR4:     {server.r4_url}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
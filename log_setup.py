@@ -0,0 +1,179 @@
+''' Logging setup: log records are queued and written by a background thread
+
+Code logging (e.g., put_new_order logging each order message) only puts the record on a queue. A QueueListener
+thread formats the records and writes them to the console and the log file, so big batches aren't slowed down by log
+writes. The console and the file have separate levels. The file can be rotated by size, with old files compressed
+with gzip, and written as JSON lines:
+    {"time": "...", "level": "INFO", "logger": "...", "thread": "...", "message": "...",
+     "site": "...", "participant": "...", "order_id": "...", "stage": "..."}
+
+site, participant, order_id, and stage come from log_context, so records logged while an order is being placed carry
+them without changing each log call:
+    with log_context(participant=record_id):
+        update_log_context(order_id=order_id, stage='redox')
+        ...
+'''
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import gzip
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import shutil
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+# Fields from log_context added to each record
+CONTEXT_FIELDS = ('site', 'participant', 'order_id', 'stage')
+
+_context = ContextVar('log_context', default=None)
+
+
+@contextmanager
+def log_context(**fields):
+    ''' Adds fields (see CONTEXT_FIELDS) to the records logged in this block, on this thread '''
+    current = _context.get()
+    token = _context.set({**current, **fields} if current else dict(fields))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def update_log_context(**fields):
+    ''' Updates the fields of the enclosing log_context, e.g., the stage. Ignored outside of log_context. '''
+    current = _context.get()
+    if current is not None:
+        current.update(fields)
+
+
+def log_context_value(field):
+    ''' Value of a field of the current log_context, or None '''
+    current = _context.get()
+    return current.get(field) if current else None
+
+
+def with_log_context(func):
+    ''' Wraps func to run with the current log_context fields, e.g., on the threads of a ThreadPoolExecutor '''
+    fields = dict(_context.get() or {})
+
+    def wrapper(*args, **kwargs):
+        with log_context(**fields):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    ''' Copies the log_context fields to each record '''
+    def filter(self, record):
+        fields = _context.get()
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field) if fields else None)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats records as one JSON object per line, with the log_context fields '''
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # QueueHandler.prepare formats the record on the logging thread. Only resolve the message here and leave
+        # formatting, including tracebacks, to the listener. The queue stays in this process, so the record
+        # doesn't need to be pickled.
+        message = record.getMessage()
+        if record.args or not isinstance(record.msg, str):
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = message
+            record.args = None
+        return record
+
+
+def _gzip_namer(name):
+    return f'{name}.gz'
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class LoggingPipeline:
+    ''' Queue handler on the root logger and the listener writing the records. Returned by setup_logging. '''
+    def __init__(self, queue_handler, listener, handlers):
+        self.queue_handler = queue_handler
+        self.listener = listener
+        self.handlers = handlers
+
+    def stop(self):
+        ''' Writes the queued records and removes the handlers from the root logger '''
+        if self.listener is None:
+            return
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.listener = None
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(file_path='redox.log', file_level=logging.DEBUG, console_level=logging.DEBUG, file_format='text',
+                  max_bytes=0, backup_count=5, compress=True, queue_size=0):
+    '''
+    Params
+    ------
+    file_path: Log file. None for console logging only.
+    file_level, console_level: Lowest levels written to the log file and to the console
+    file_format: 'text' or 'json' (one JSON object per line, see JsonFormatter)
+    max_bytes: Size of the log file before it's rotated. 0 to never rotate.
+    backup_count: Number of rotated log files kept
+    compress: Compress rotated log files with gzip
+    queue_size: Max records waiting to be written (0 = no limit). When full, logging waits for the listener.
+
+    Return
+    ------
+    LoggingPipeline. Call stop to write the queued records before exiting.
+    '''
+    handlers = []
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers.append(console)
+    if file_path:
+        fh = RotatingFileHandler(file_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        if compress:
+            fh.namer = _gzip_namer
+            fh.rotator = _gzip_rotator
+        fh.setLevel(file_level)
+        fh.setFormatter(JsonFormatter() if file_format == 'json' else logging.Formatter(TEXT_FORMAT))
+        handlers.append(fh)
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.setLevel(min(h.level for h in handlers))
+    queue_handler.addFilter(ContextFilter())
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(queue_handler)
+    return LoggingPipeline(queue_handler, listener, handlers)
@@ -0,0 +1,272 @@
+''' Run metrics: timers and counters for each stage of the batch and each call to REDCap, R4, and Redox
+
+Metrics are kept in memory in a Metrics registry and exported at the end of a run as a Prometheus textfile
+(for the node_exporter textfile collector) and as a JSON summary. Redcap, R4, and RedoxInvitaeAPI record to the
+shared registry METRICS. Metrics recorded inside a log_context with a site (multi_site.py) get a site label.
+
+    with METRICS.timer('redox_post') as t:
+        response = post(...)
+        if response.status_code != 200:
+            t.fail()
+'''
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from log_setup import log_context_value
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_HELP = {
+    'stage_duration_seconds': 'Time spent in each stage or external call',
+    'stage_total': 'Stage or external call completions by outcome',
+    'http_requests_total': 'HTTP requests by service and status code',
+    'http_request_duration_seconds': 'HTTP response time by service',
+    'http_bytes_total': 'HTTP bytes sent and received by service',
+    'records_total': 'Records processed by each stage',
+    'orders_total': 'New order attempts by outcome',
+    'redox_outcome_unknown_total': 'Redox messages that may have been received but were not confirmed, by reason',
+    'metree_cache_total': 'MeTree cache lookups by result',
+    'metree_missing_total': 'Participants without a MeTree file in R4',
+    'triggers_total': 'REDCap Data Entry Trigger requests by result',
+    'order_status_changes_total': 'Order status changes recorded in REDCap, by new status and source',
+    'webhook_messages_total': 'Messages pushed by Redox to the results webhook, by result',
+    'site_run_duration_seconds': 'Duration of the run of each site (multi_site.py)',
+    'site_run_success': 'Whether the run of each site finished without an unexpected error (multi_site.py)',
+    'run_start_timestamp_seconds': 'Time the run started (Unix time)',
+    'run_duration_seconds': 'Duration of the run',
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        ''' Estimate of quantile q, interpolated within the bucket it falls in (like Prometheus histogram_quantile) '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if cumulative + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / n)
+            cumulative += n
+        return self.max
+
+
+class _Timing:
+    ''' Yielded by Metrics.timer. Call fail() to record the stage as failed without raising an exception. '''
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    ''' Thread-safe registry of counters, gauges, and histograms, keyed by name and labels '''
+    def __init__(self, prefix='invitae_redox', buckets=DEFAULT_BUCKETS):
+        '''
+        Params
+        ------
+        prefix: Prefix of exported metric names
+        buckets: Upper bounds (seconds) of the latency histogram buckets
+        '''
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    # log_context fields added as labels to all metrics recorded in that context, e.g., the site of multi_site.py runs
+    CONTEXT_LABELS = ('site',)
+
+    def _key(self, name, labels):
+        for field in Metrics.CONTEXT_LABELS:
+            if field not in labels:
+                value = log_context_value(field)
+                if value is not None:
+                    labels[field] = value
+        return (name, _label_key(labels))
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict()
+            self._gauges = dict()
+            self._histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        ''' Adds value to a counter '''
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        ''' Sets a gauge '''
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        ''' Adds an observation (e.g., seconds) to a histogram '''
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    def record(self, stage, seconds, failed=False, **labels):
+        ''' Records one completion of a stage that took seconds (see timer) '''
+        self.observe('stage_duration_seconds', seconds, stage=stage, **labels)
+        self.inc('stage_total', stage=stage, outcome='failure' if failed else 'success', **labels)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        '''
+        Times a stage or external call. Records its duration in stage_duration_seconds and counts it in stage_total
+        with outcome="success" or "failure". An exception, or calling fail() on the yielded object, marks it failed.
+        '''
+        timing = _Timing()
+        start = time.perf_counter()
+        try:
+            yield timing
+        except BaseException:
+            timing.failed = True
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, failed=timing.failed, **labels)
+
+    def http_hook(self, service):
+        '''
+        requests response hook recording request counts by status code, response times, and bytes sent and received
+
+        Params
+        ------
+        service: Service label, e.g., 'redox'
+        '''
+        def hook(response, *args, **kwargs):
+            body = response.request.body
+            sent = len(body) if isinstance(body, (bytes, str)) else 0
+            self.inc('http_requests_total', service=service, status=response.status_code)
+            self.observe('http_request_duration_seconds', response.elapsed.total_seconds(), service=service)
+            self.inc('http_bytes_total', sent, service=service, direction='sent')
+            self.inc('http_bytes_total', len(response.content), service=service, direction='received')
+            return response
+        return hook
+
+    def to_prometheus(self):
+        ''' Metrics in the Prometheus text exposition format '''
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: (list(h.counts), h.count, h.sum) for k, h in self._histograms.items()}
+
+        lines = []
+
+        def _header(name, metric_type):
+            full_name = f'{self.prefix}_{name}'
+            if name in _HELP:
+                lines.append(f'# HELP {full_name} {_HELP[name]}')
+            lines.append(f'# TYPE {full_name} {metric_type}')
+            return full_name
+
+        for metrics, metric_type in ((counters, 'counter'), (gauges, 'gauge')):
+            for name in sorted({name for name, _ in metrics}):
+                full_name = _header(name, metric_type)
+                for (n, key), value in sorted(metrics.items()):
+                    if n == name:
+                        lines.append(f'{full_name}{_format_labels(key)} {value}')
+
+        for name in sorted({name for name, _ in histograms}):
+            full_name = _header(name, 'histogram')
+            for (n, key), (counts, count, total) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{full_name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{full_name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{full_name}_count{_format_labels(key)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        Return
+        ------
+        Dict with counters and gauges (name -> list of {labels, value}) and histograms
+        (name -> list of {labels, count, sum, mean, min, max, p50, p90, p99})
+        '''
+        with self._lock:
+            summary = {'counters': dict(), 'gauges': dict(), 'histograms': dict()}
+            for section, metrics in (('counters', self._counters), ('gauges', self._gauges)):
+                for (name, key), value in sorted(metrics.items()):
+                    summary[section].setdefault(name, []).append({'labels': dict(key), 'value': value})
+            for (name, key), h in sorted(self._histograms.items()):
+                summary['histograms'].setdefault(name, []).append({
+                    'labels': dict(key),
+                    'count': h.count,
+                    'sum': h.sum,
+                    'mean': h.sum / h.count if h.count else None,
+                    'min': h.min,
+                    'max': h.max,
+                    'p50': h.quantile(0.5),
+                    'p90': h.quantile(0.9),
+                    'p99': h.quantile(0.99),
+                })
+        return summary
+
+    @staticmethod
+    def _write_atomic(path, text):
+        # The textfile collector may read the file at any time, so replace it in one step
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def write_prometheus(self, path):
+        Metrics._write_atomic(path, self.to_prometheus())
+
+    def write_json(self, path):
+        Metrics._write_atomic(path, json.dumps(self.summary(), indent=2))
+
+
+# Registry shared by Redcap, R4, and RedoxInvitaeAPI
+METRICS = Metrics()
@@ -0,0 +1,196 @@
+''' Multi-site runner: places new orders for several sites, each with its own REDCap project, in one process
+
+The sites file lists the sites and holds what they share:
+    [GENERAL]  # MAX_CONCURRENT_SITES, WORKERS
+    [REDOX]  # Redox connection used by all sites: one connection pool and access token
+    [LOGGING], [EMAIL], [METRICS]  # as in redox-api.config
+    [SITE:<name>]  # CONFIG: the site's configuration file (redox-api.config format)
+
+Each site's configuration has its own REDCap project and R4 settings, [FIELD_MAP] of REDCap field names that differ
+from Redcap.FIELD_*, ORDER_ID_PREFIX, and Redox DESTINATION_ID, as well as its own journal, mirror, and other files.
+Its [REDOX] connection options and its [LOGGING], [EMAIL], and [METRICS] sections are not used.
+
+Sites run concurrently on their own threads, each with its own Redcap and R4 clients, order IDs, journal, and
+order status checks, so a failing site doesn't stop the others. Log records are tagged with the site (see
+log_setup.log_context), and metrics are collected in the shared registry and written once all sites are done.
+
+    python multi_site.py --sites sites.config --workers 4
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import logging
+import os
+import sys
+import time
+
+import batch_order
+from log_setup import ContextFilter, log_context
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+SITE_SECTION_PREFIX = 'SITE:'
+# Site options that must differ between sites: (section, option)
+_UNSHARED_FILES = (('REDCAP', 'MIRROR_FILE'), ('JOURNAL', 'FILE'), ('ORDER_QUERY', 'STORE_FILE'),
+                   ('DRY_RUN', 'ARCHIVE_FILE'))
+# Sections of the site configurations that are taken from the sites file instead
+_SHARED_SECTIONS = ('LOGGING', 'EMAIL', 'METRICS')
+
+
+def _read_config(path):
+    parser = ConfigParser(inline_comment_prefixes=['#'])
+    if not parser.read(path):
+        raise ValueError(f'Configuration file {path} not found')
+    return parser
+
+
+def load_sites(sites_parser, sites_path, only=None):
+    '''
+    Params
+    ------
+    sites_parser: ConfigParser of the sites file
+    sites_path: Path of the sites file. CONFIG paths are relative to its directory.
+    only: [Optional] Names of the sites to load. By default, all sites.
+
+    Return
+    ------
+    Dict of site name: ConfigParser of the site's configuration
+
+    Raises
+    ------
+    ValueError if a site is missing or misconfigured, or if sites share an order ID prefix or a file that must be
+    separate for each site
+    '''
+    base_dir = os.path.dirname(os.path.abspath(sites_path))
+    sites = dict()
+    for section in sites_parser.sections():
+        if not section.startswith(SITE_SECTION_PREFIX):
+            continue
+        name = section[len(SITE_SECTION_PREFIX):].strip()
+        if only and name not in only:
+            continue
+        config_path = sites_parser.get(section, 'CONFIG', fallback='')
+        if not config_path:
+            raise ValueError(f'Site {name} has no CONFIG')
+        parser = _read_config(os.path.join(base_dir, config_path))
+        for shared_section in _SHARED_SECTIONS:
+            parser.remove_section(shared_section)
+        sites[name] = parser
+    missing = set(only or ()) - set(sites)
+    if missing:
+        raise ValueError(f'Sites not in the sites file: {", ".join(sorted(missing))}')
+
+    # Sites must not share order IDs or state files
+    prefixes = dict()
+    for name, parser in sites.items():
+        prefix = parser.get('REDCAP', 'ORDER_ID_PREFIX', fallback='') or None
+        if prefix in prefixes:
+            raise ValueError(f'Sites {prefixes[prefix]} and {name} have the same ORDER_ID_PREFIX ({prefix or "default"})')
+        prefixes[prefix] = name
+    for section, option in _UNSHARED_FILES:
+        paths = dict()
+        for name, parser in sites.items():
+            path = parser.get(section, option, fallback='')
+            if not path:
+                continue
+            path = os.path.abspath(path)
+            if path in paths:
+                raise ValueError(f'Sites {paths[path]} and {name} have the same {option} in [{section}] ({path})')
+            paths[path] = name
+    return sites
+
+
+def run_site(name, parser, args, redox_client):
+    '''
+    Runs the batch for one site (see batch_order.run). Errors are logged, not raised, so other sites carry on.
+
+    Return
+    ------
+    True if the run finished without an unexpected error
+    '''
+    start = time.perf_counter()
+    with log_context(site=name):
+        logger.info(f'Site {name}: begin')
+        try:
+            batch_order.run(parser, args, redox_client=redox_client)
+            success = True
+        except Exception:
+            logger.exception(f'Site {name}: unexpected error')
+            success = False
+        duration = time.perf_counter() - start
+        logger.info(f'Site {name}: {"done" if success else "failed"} in {duration:.1f} s')
+    METRICS.set('site_run_duration_seconds', duration, site=name)
+    METRICS.set('site_run_success', int(success), site=name)
+    return success
+
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description='Place new Invitae orders through Redox for several sites in one process')
+    arg_parser.add_argument('--sites', default='./sites.config', help='Sites file (default: ./sites.config)')
+    arg_parser.add_argument('--site', action='append', metavar='NAME', help='Only run this site (can be repeated)')
+    arg_parser.add_argument('--workers', type=int,
+                            help='Number of participants to process concurrently in each site (overrides WORKERS)')
+    arg_parser.add_argument('--dry-run', metavar='DIR',
+                            help='Write the new orders of each site to DIR/<site>.ndjson.gz instead of sending them '
+                                 'to Redox (see batch_order.py --dry-run)')
+    args = arg_parser.parse_args(argv)
+
+    sites_parser = _read_config(args.sites)
+    logging_pipeline = batch_order.configure_logging(sites_parser)
+    emailer, alert_handler = batch_order.start_alerts(sites_parser)
+    # Alerts name the site
+    alert_handler.addFilter(ContextFilter())
+    run_start = time.time()
+    METRICS.set('run_start_timestamp_seconds', run_start)
+    try:
+        sites = load_sites(sites_parser, args.sites, only=args.site)
+        if not sites:
+            logger.error(f'No sites in {args.sites}')
+            return 1
+        workers = args.workers or sites_parser.getint('GENERAL', 'WORKERS', fallback=1)
+        max_concurrent = sites_parser.getint('GENERAL', 'MAX_CONCURRENT_SITES', fallback=0) or len(sites)
+        if any(parser.getboolean('GENERAL', 'DEVELOPMENT', fallback=False) for parser in sites.values()):
+            # Confirmation prompts of different sites must not be mixed up
+            logger.info('Sites with DEVELOPMENT = True: running one site at a time')
+            max_concurrent = 1
+        max_concurrent = min(max_concurrent, len(sites))
+
+        # One Redox connection pool and access token for all sites
+        from redox.client import RedoxClient
+        redox_client = RedoxClient(sites_parser.get('REDOX', 'BASE_URL'),
+                                   sites_parser.get('REDOX', 'REDOX_API_KEY'),
+                                   sites_parser.get('REDOX', 'REDOX_API_SECRET'),
+                                   **batch_order.redox_client_options(sites_parser, workers=workers * max_concurrent))
+
+        site_args = dict()
+        for name in sites:
+            site_argv = ['--workers', str(workers)]
+            if args.dry_run:
+                os.makedirs(args.dry_run, exist_ok=True)
+                site_argv += ['--dry-run', os.path.join(args.dry_run, f'{name}.ndjson.gz')]
+            site_args[name] = batch_order.parse_args(site_argv)
+
+        logger.info(f'Running {len(sites)} sites, {max_concurrent} at a time: {", ".join(sites)}')
+        with ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='site') as executor:
+            futures = {name: executor.submit(run_site, name, parser, site_args[name], redox_client)
+                       for name, parser in sites.items()}
+            results = {name: future.result() for name, future in futures.items()}
+        failed = [name for name, success in results.items() if not success]
+        if failed:
+            logger.error(f'Sites failed: {", ".join(failed)}')
+        return 1 if failed else 0
+    except ValueError as e:
+        logger.error(f'Invalid sites configuration: {e}')
+        return 1
+    finally:
+        METRICS.set('run_duration_seconds', time.time() - run_start)
+        batch_order.write_metrics(sites_parser.get('METRICS', 'PROMETHEUS_FILE', fallback='') or None,
+                                  sites_parser.get('METRICS', 'JSON_FILE', fallback='') or None)
+        logging.getLogger().removeHandler(alert_handler)
+        emailer.stop()
+        logging_pipeline.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
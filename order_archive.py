@@ -0,0 +1,222 @@
+''' Dry-run archive of new order messages
+
+In a dry run, new order messages are written to an NDJSON archive instead of being sent to Redox. Each line is one
+order:
+    {"order_id": "...", "patient_id": "...", "payload": {<Redox new order message>}}
+Writes are buffered, and the archive is gzip compressed when its name ends with .gz. An index next to the archive
+(<archive>.index, tab separated: order ID, patient ID, offset, length) locates each order in the uncompressed
+stream, so single orders can be read without parsing the whole archive.
+
+Archives of two rehearsals, e.g., before and after a code change, can be compared order by order:
+    python order_archive.py diff before.ndjson.gz after.ndjson.gz
+    python order_archive.py show after.ndjson.gz COLUMBIA_ORDER_20220701_001
+'''
+from argparse import ArgumentParser
+import gzip
+import io
+import json
+import logging
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Fields that differ between runs even when the orders are the same
+DIFF_IGNORE = ('Meta.EventDateTime', 'Order.TransactionDateTime', 'Order.ID')
+
+
+def _open(path, mode, compress_level=6):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=compress_level)
+    return open(path, mode)
+
+
+class OrderArchive:
+    ''' Buffered NDJSON writer for new order messages, with an index by order ID. Thread-safe. '''
+    def __init__(self, path, compress_level=1, buffer_size=1024 * 1024):
+        '''
+        Params
+        ------
+        path: Archive file. Compressed with gzip if it ends with .gz. An existing archive is replaced.
+        compress_level: gzip compression level (1 is fastest)
+        buffer_size: Bytes buffered before writing to the archive
+        '''
+        self.path = path
+        self.index_path = f'{path}.index'
+        self.count = 0
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._file = io.BufferedWriter(_open(path, 'wb', compress_level), buffer_size)
+        self._index = io.BufferedWriter(open(self.index_path, 'wb'), 64 * 1024)
+
+    def write(self, order_id, patient_id, payload):
+        '''
+        Params
+        ------
+        order_id: Order ID
+        patient_id: Patient ID of the order
+        payload: New order message (JSON string)
+        '''
+        # The payload is already JSON, so the line is put together without parsing it again
+        line = f'{{"order_id": {json.dumps(order_id)}, "patient_id": {json.dumps(patient_id)}, ' \
+               f'"payload": {payload}}}\n'.encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._index.write(f'{order_id}\t{patient_id}\t{self._offset}\t{len(line)}\n'.encode('utf-8'))
+            self._offset += len(line)
+            self.count += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.close()
+            self._index.close()
+        logger.info(f'Dry run: {self.count} orders written to {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_index(path):
+    '''
+    Return
+    ------
+    Dict of order ID: (patient ID, offset, length) for the archive
+    '''
+    index = dict()
+    with open(f'{path}.index', 'r', encoding='utf-8') as f:
+        for line in f:
+            order_id, patient_id, offset, length = line.rstrip('\n').split('\t')
+            index[order_id] = (patient_id, int(offset), int(length))
+    return index
+
+
+def read_order(path, order_id, index=None):
+    '''
+    Params
+    ------
+    path: Archive file
+    order_id: Order ID to read
+    index: [Optional] Index from load_index, to avoid loading it again for each order
+
+    Return
+    ------
+    Archived entry (dict with order_id, patient_id, and payload), or None if the order isn't in the archive
+    '''
+    if index is None:
+        index = load_index(path)
+    if order_id not in index:
+        return None
+    _, offset, length = index[order_id]
+    with _open(path, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+
+def iter_orders(path):
+    ''' Yields the archived entries (dicts with order_id, patient_id, and payload) in the order they were written '''
+    with _open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _flatten(value, prefix='', out=None):
+    if out is None:
+        out = dict()
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(v, f'{prefix}.{k}' if prefix else k, out)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            _flatten(v, f'{prefix}.{i}' if prefix else str(i), out)
+    else:
+        out[prefix] = value
+    return out
+
+
+def diff_archives(old_path, new_path, ignore=DIFF_IGNORE):
+    '''
+    Compares the orders of two archives by patient ID
+
+    Params
+    ------
+    old_path, new_path: Archive files
+    ignore: Payload fields (dotted paths) not compared, e.g., times that differ between runs
+
+    Return
+    ------
+    Dict with the patient IDs only in the old archive ('removed') and only in the new archive ('added'), and
+    'changed': dict of patient ID: list of (field, old value, new value)
+    '''
+    ignore = set(ignore)
+
+    def _load(path):
+        return {str(x['patient_id']): {k: v for k, v in _flatten(x['payload']).items() if k not in ignore}
+                for x in iter_orders(path)}
+
+    old = _load(old_path)
+    new = _load(new_path)
+    changed = dict()
+    for patient_id in old.keys() & new.keys():
+        a, b = old[patient_id], new[patient_id]
+        if a != b:
+            changed[patient_id] = [(k, a.get(k), b.get(k)) for k in sorted(a.keys() | b.keys()) if a.get(k) != b.get(k)]
+    return {
+        'removed': sorted(old.keys() - new.keys()),
+        'added': sorted(new.keys() - old.keys()),
+        'changed': dict(sorted(changed.items())),
+    }
+
+
+def main(argv=None):
+    arg_parser = ArgumentParser(description='Inspect and compare dry-run order archives')
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    show_parser = subparsers.add_parser('show', help='Print archived orders')
+    show_parser.add_argument('archive')
+    show_parser.add_argument('order_ids', nargs='*', metavar='ORDER_ID', help='Orders to print (default: all)')
+    diff_parser = subparsers.add_parser('diff', help='Compare the orders of two archives by patient ID')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.add_argument('--ignore', nargs='*', default=list(DIFF_IGNORE), metavar='FIELD',
+                             help=f'Payload fields not compared (default: {" ".join(DIFF_IGNORE)})')
+    args = arg_parser.parse_args(argv)
+
+    if args.command == 'show':
+        if args.order_ids:
+            index = load_index(args.archive)
+            entries = [read_order(args.archive, order_id, index) for order_id in args.order_ids]
+            missing = [order_id for order_id, x in zip(args.order_ids, entries) if x is None]
+            if missing:
+                print(f'Not in the archive: {", ".join(missing)}', file=sys.stderr)
+            entries = [x for x in entries if x is not None]
+        else:
+            entries = iter_orders(args.archive)
+        for x in entries:
+            print(json.dumps(x, indent=2))
+        return 0
+
+    result = diff_archives(args.old, args.new, ignore=args.ignore)
+    for patient_id in result['removed']:
+        print(f'- {patient_id}')
+    for patient_id in result['added']:
+        print(f'+ {patient_id}')
+    for patient_id, fields in result['changed'].items():
+        print(f'~ {patient_id}')
+        for field, old_value, new_value in fields:
+            print(f'    {field}: {old_value!r} -> {new_value!r}')
+    print(f'{len(result["removed"])} removed, {len(result["added"])} added, {len(result["changed"])} changed')
+    return 1 if any(result.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+from datetime import date
+import logging
+import re
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class OrderIdAllocator:
+    ''' Hands out unique order IDs of the form <prefix><YYYYMMDD>_<NNN>
+
+    The last order number used for each day is kept in a small SQLite store. Numbers are reserved from the store
+    in blocks inside an exclusive transaction, so concurrent threads and processes sharing the store never
+    receive the same ID. Unused numbers in a reserved block are skipped, never reused. Numbering starts over
+    each day, and numbers past 999 simply get more digits (e.g., _1000).
+    '''
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS order_counters (
+            prefix TEXT NOT NULL,
+            day TEXT NOT NULL,
+            last_num INTEGER NOT NULL,
+            PRIMARY KEY (prefix, day)
+        );
+    '''
+
+    def __init__(self, prefix, path=None, block_size=1, seed=None):
+        '''
+        Params
+        ------
+        prefix: Order ID prefix, e.g., 'COLUMBIA_ORDER_'
+        path: [Optional] SQLite file for the durable store. If None, an in-memory store is used for this process only.
+        block_size: Number of order numbers reserved from the store at a time
+        seed: [Optional] Called with a day ('YYYYMMDD') the first time that day is used in the store. Returns the
+              highest order number already used that day (e.g., from REDCap).
+        '''
+        self.prefix = prefix
+        self.path = path if path else ':memory:'
+        self.block_size = max(1, block_size)
+        self.seed = seed
+        self._regex = re.compile(re.escape(prefix) + r'(\d{8})_(\d{3,})$')
+
+        self._lock = threading.Lock()
+        # isolation_level=None: transactions are managed explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.executescript(OrderIdAllocator._SCHEMA)
+        # Current block of reserved numbers: [next, end]
+        self._block_day = None
+        self._block_next = 0
+        self._block_end = -1
+
+    @staticmethod
+    def today():
+        return date.today().strftime('%Y%m%d')
+
+    @staticmethod
+    def stored_last_num(path, prefix, day):
+        '''
+        Reads the last order number used for day from a store without changing it, e.g., to seed an in-memory
+        allocator for a dry run
+
+        Return
+        ------
+        Last order number, or 0 if the store or the day doesn't exist
+        '''
+        try:
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+        except sqlite3.OperationalError:
+            return 0
+        try:
+            row = conn.execute('SELECT last_num FROM order_counters WHERE prefix = ? AND day = ?',
+                               (prefix, day)).fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+        return row[0] if row else 0
+
+    def format(self, day, num):
+        return f'{self.prefix}{day}_{num:03d}'
+
+    def parse(self, order_id):
+        '''
+        Return
+        ------
+        (day, number) for an order ID created with this prefix, otherwise None
+        '''
+        m = self._regex.match(order_id or '')
+        if m:
+            return m[1], int(m[2])
+        return None
+
+    def _has_day(self, day):
+        row = self._conn.execute('SELECT 1 FROM order_counters WHERE prefix = ? AND day = ?',
+                                 (self.prefix, day)).fetchone()
+        return row is not None
+
+    def _reserve(self, day, n):
+        ''' Reserves n numbers for day in the store. Returns the first reserved number '''
+        seed_num = None
+        if self.seed is not None and not self._has_day(day):
+            # Look up the seed outside the transaction, since it may take a while (e.g., REDCap export)
+            seed_num = self.seed(day)
+
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute('SELECT last_num FROM order_counters WHERE prefix = ? AND day = ?',
+                                     (self.prefix, day)).fetchone()
+            last_num = row[0] if row else 0
+            if seed_num is not None:
+                last_num = max(last_num, seed_num)
+            self._conn.execute('INSERT OR REPLACE INTO order_counters (prefix, day, last_num) VALUES (?, ?, ?)',
+                               (self.prefix, day, last_num + n))
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        return last_num + 1
+
+    def next_id(self):
+        '''
+        Return
+        ------
+        A new, unique order ID for today
+        '''
+        day = OrderIdAllocator.today()
+        with self._lock:
+            if day != self._block_day or self._block_next > self._block_end:
+                first = self._reserve(day, self.block_size)
+                self._block_day = day
+                self._block_next = first
+                self._block_end = first + self.block_size - 1
+            num = self._block_next
+            self._block_next += 1
+        return self.format(day, num)
+
+    def reserve_block(self, n):
+        '''
+        Reserves n consecutive order IDs for today, e.g., to hand to a worker
+
+        Return
+        ------
+        List of n order IDs
+        '''
+        day = OrderIdAllocator.today()
+        with self._lock:
+            first = self._reserve(day, n)
+        return [self.format(day, num) for num in range(first, first + n)]
+
+    def ensure_at_least(self, day, num):
+        '''
+        Makes sure future order numbers for day are above num, e.g., after checking existing orders in REDCap
+
+        Return
+        ------
+        True if the store had to be advanced
+        '''
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT last_num FROM order_counters WHERE prefix = ? AND day = ?',
+                                         (self.prefix, day)).fetchone()
+                last_num = row[0] if row else 0
+                advanced = num > last_num
+                if advanced:
+                    self._conn.execute('INSERT OR REPLACE INTO order_counters (prefix, day, last_num) VALUES (?, ?, ?)',
+                                       (self.prefix, day, num))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+            if advanced and day == self._block_day:
+                # Drop the rest of the current block, which may overlap numbers already used
+                self._block_end = -1
+        if advanced:
+            logger.warning(f'Order ID store for {self.prefix}{day} was behind. Advanced to {num}.')
+        return advanced
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,212 @@
+''' Order status polling: asks Redox about submitted orders in batches and records status changes in REDCap
+
+Each Order Query asks about up to batch_size orders. How often an order is asked about depends on its age: the first
+query waits first_query_delay_sec after the order was placed, and after that the order is asked about again after
+age_fraction of its age, between min_interval_sec and max_interval_sec. New orders, which may still be received by
+Invitae any minute, are checked often. Orders waiting weeks for results are checked about once a day.
+
+When each order was placed and last asked about is kept in a small SQLite store, so the schedule carries over
+between runs.
+'''
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+import threading
+import time
+
+from redcap_invitae import Redcap
+from redox import RedoxUnavailableError
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Redox Order.Status (lowercase) -> REDCap order status. Other statuses leave the REDCap order status unchanged.
+REDOX_ORDER_STATUS = {
+    'received': Redcap.OrderStatus.RECEIVED,
+    'in progress': Redcap.OrderStatus.RECEIVED,
+    'inprogress': Redcap.OrderStatus.RECEIVED,
+    'preliminary': Redcap.OrderStatus.RECEIVED,
+    'resulted': Redcap.OrderStatus.COMPLETED,
+    'completed': Redcap.OrderStatus.COMPLETED,
+    'final': Redcap.OrderStatus.COMPLETED,
+    'corrected': Redcap.OrderStatus.COMPLETED,
+}
+
+
+def map_redox_order_status(redox_status):
+    '''
+    Return
+    ------
+    Redcap.OrderStatus for a Redox Order.Status, or None if the status doesn't change the REDCap order status
+    '''
+    return REDOX_ORDER_STATUS.get((redox_status or '').strip().lower())
+
+
+class OrderStatusPoller:
+    ''' Decides which pending orders are due to be asked about, and asks Redox about them in batches '''
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS order_polls (
+            order_id TEXT PRIMARY KEY,
+            ordered_at REAL NOT NULL,
+            last_polled_at REAL
+        );
+    '''
+
+    def __init__(self, redcap, store_path=None, batch_size=50, first_query_delay_sec=60, min_interval_sec=900,
+                 max_interval_sec=86400, age_fraction=0.1):
+        '''
+        Params
+        ------
+        redcap: Redcap
+        store_path: [Optional] SQLite file keeping the polling schedule between runs. If None, the schedule is kept
+                    in memory for this process only.
+        batch_size: Max number of orders per Order Query
+        first_query_delay_sec: Time after an order is placed before it is first asked about
+        min_interval_sec, max_interval_sec: Bounds of the time between queries about the same order
+        age_fraction: Time between queries about an order, as a fraction of the order's age
+        '''
+        self.redcap = redcap
+        self.batch_size = max(1, batch_size)
+        self.first_query_delay_sec = first_query_delay_sec
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.age_fraction = age_fraction
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(store_path if store_path else ':memory:', check_same_thread=False, timeout=30)
+        self._conn.executescript(OrderStatusPoller._SCHEMA)
+
+    def next_poll_time(self, ordered_at, last_polled_at):
+        '''
+        Params
+        ------
+        ordered_at: Time the order was placed (Unix time)
+        last_polled_at: Time the order was last asked about (Unix time), or None
+
+        Return
+        ------
+        Time the order is next due to be asked about (Unix time)
+        '''
+        if last_polled_at is None:
+            return ordered_at + self.first_query_delay_sec
+        interval = (last_polled_at - ordered_at) * self.age_fraction
+        return last_polled_at + min(max(interval, self.min_interval_sec), self.max_interval_sec)
+
+    @staticmethod
+    def _ordered_at(record, now):
+        # REDCap only has the order date. Orders placed today are timed from when they're first seen.
+        try:
+            day = datetime.strptime(record[Redcap.FIELD_ORDER_DATE], '%Y-%m-%d')
+        except (KeyError, TypeError, ValueError):
+            return now
+        return day.timestamp() if day.date() < datetime.fromtimestamp(now).date() else now
+
+    def due(self, participants, now=None):
+        '''
+        Params
+        ------
+        participants: Participants with pending orders, from Redcap.pull_info_for_query_order
+        now: [Optional] Current time (Unix time)
+
+        Return
+        ------
+        List of the participants whose orders are due to be asked about, most overdue first
+        '''
+        now = time.time() if now is None else now
+        participants = [p for p in participants if p.get(Redcap.FIELD_ORDER_ID)]
+        with self._lock, self._conn:
+            known = {order_id: (ordered_at, last_polled_at) for order_id, ordered_at, last_polled_at
+                     in self._conn.execute('SELECT order_id, ordered_at, last_polled_at FROM order_polls')}
+            new = [(p[Redcap.FIELD_ORDER_ID], OrderStatusPoller._ordered_at(p, now)) for p in participants
+                   if p[Redcap.FIELD_ORDER_ID] not in known]
+            self._conn.executemany('INSERT INTO order_polls (order_id, ordered_at) VALUES (?, ?)', new)
+            known.update((order_id, (ordered_at, None)) for order_id, ordered_at in new)
+            # Orders that are no longer pending (e.g., completed) don't need to be kept
+            pending = set(p[Redcap.FIELD_ORDER_ID] for p in participants)
+            self._conn.executemany('DELETE FROM order_polls WHERE order_id = ?',
+                                   [(order_id,) for order_id in known if order_id not in pending])
+
+        due = []
+        for p in participants:
+            next_poll = self.next_poll_time(*known[p[Redcap.FIELD_ORDER_ID]])
+            if next_poll <= now:
+                due.append((next_poll, p))
+        due.sort(key=lambda x: x[0])
+        return [p for _, p in due]
+
+    def poll(self, redox, participants, stop_event=None, test=False):
+        '''
+        Asks Redox about the participants' orders, batch_size orders per query, and writes status changes to REDCap
+
+        Params
+        ------
+        redox: RedoxInvitaeAPI (authenticated)
+        participants: Participants whose orders are due, from due
+        stop_event: [Optional] threading.Event. Once set, no more queries are sent.
+        test: Mark the queries as test messages
+
+        Return
+        ------
+        Dict with the number of orders queried, orders whose status changed, and failed queries. If Redox becomes
+        unavailable, the remaining queries are not sent and count as failed. Their orders stay due for the next run.
+        '''
+        n_queried = n_updated = n_failed = 0
+        n_batches = (len(participants) + self.batch_size - 1) // self.batch_size
+        for batch_num, i in enumerate(range(0, len(participants), self.batch_size)):
+            if stop_event is not None and stop_event.is_set():
+                break
+            batch = participants[i:i + self.batch_size]
+            batch_orders = {p[Redcap.FIELD_ORDER_ID]: p for p in batch}
+            now = time.time()
+            with self._lock:
+                placeholders = ', '.join('?' for _ in batch_orders)
+                earliest = self._conn.execute(f'SELECT MIN(ordered_at) FROM order_polls '
+                                              f'WHERE order_id IN ({placeholders})', tuple(batch_orders)).fetchone()[0]
+            start = datetime.utcfromtimestamp(earliest if earliest is not None else now) - timedelta(days=1)
+            try:
+                orders = redox.query_orders([(p[Redcap.FIELD_LAB_ID], order_id)
+                                             for order_id, p in batch_orders.items()],
+                                            start=start, end=datetime.utcfromtimestamp(now), test=test)
+            except RedoxUnavailableError as e:
+                logger.warning(f'Order status: Redox unavailable, remaining queries left for the next run: {e}')
+                n_failed += n_batches - batch_num
+                break
+            if orders is None:
+                # Asked about again on the next run
+                n_failed += 1
+                continue
+
+            n_queried += len(batch)
+            with self._lock, self._conn:
+                self._conn.executemany('UPDATE order_polls SET last_polled_at = ? WHERE order_id = ?',
+                                       [(now, order_id) for order_id in batch_orders])
+            for order in orders:
+                p = batch_orders.get(order.ID)
+                if p is not None and self._update_status(p, order.Status):
+                    n_updated += 1
+
+        if n_queried or n_failed:
+            logger.info(f'Order status: {n_queried} orders queried, {n_updated} status changes'
+                        + (f', {n_failed} queries failed' if n_failed else ''))
+        return {'orders_queried': n_queried, 'status_changes': n_updated, 'failed_queries': n_failed}
+
+    def _update_status(self, p, redox_status):
+        new_status = map_redox_order_status(redox_status)
+        if new_status is None:
+            if redox_status:
+                logger.debug(f'Order {p[Redcap.FIELD_ORDER_ID]}: Redox status {redox_status} not mapped')
+            return False
+        # Statuses only move forward
+        if new_status.value <= p[Redcap.FIELD_ORDER_STATUS]:
+            return False
+
+        logger.info(f'Order {p[Redcap.FIELD_ORDER_ID]} for CUIMC {p[Redcap.FIELD_RECORD_ID]}: {new_status.name}')
+        METRICS.inc('order_status_changes_total', status=new_status.name.lower(), source='query')
+        form_complete = Redcap.FormComplete.COMPLETE if new_status == Redcap.OrderStatus.COMPLETED else None
+        self.redcap.update_order_status(record_id=p[Redcap.FIELD_RECORD_ID], order_status=new_status,
+                                        form_complete=form_complete)
+        p[Redcap.FIELD_ORDER_STATUS] = new_status.value
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
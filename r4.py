@@ -1,28 +1,286 @@
 import logging
 import json
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 from redcap import Project, RedcapError
-from requests import RequestException
+
+from log_setup import with_log_context
+from metrics import METRICS
 
 logger = logging.getLogger(__name__)
 
+
+class MetreeCache:
+    ''' On-disk cache of MeTree JSON files, stored by content hash
+
+    File contents are stored once under objects/<sha256>.json. refs/<record ID> points each R4 record to the hash
+    of its MeTree file, or holds MISSING_REF for records without a MeTree file. When the cache grows past max_bytes,
+    the least recently used files are removed.
+    '''
+    # Returned by get for records known to have no MeTree file
+    MISSING = object()
+    MISSING_REF = '-'
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, max_age_sec=0, missing_max_age_sec=3600):
+        '''
+        Params
+        ------
+        directory: Cache directory
+        max_bytes: Max total size of cached files
+        max_age_sec: Cached MeTree files older than this are fetched again. 0 keeps them until evicted.
+        missing_max_age_sec: Records without a MeTree file are asked about again after this long, in case the file
+                             was added since. 0 doesn't cache missing files.
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.missing_max_age_sec = missing_max_age_sec
+        self._objects_dir = os.path.join(directory, 'objects')
+        self._refs_dir = os.path.join(directory, 'refs')
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._refs_dir, exist_ok=True)
+        self._evict_lock = threading.Lock()
+        # Total size of the cached files, kept up to date by put. Recounted from the directory on eviction, since
+        # other processes may share the cache.
+        self._total_bytes = self._scan()[1]
+
+    def _ref_path(self, record_id):
+        return os.path.join(self._refs_dir, quote(str(record_id), safe=''))
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, f'{digest}.json')
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, record_id):
+        '''
+        Return
+        ------
+        Cached MeTree file contents (bytes) for the R4 record, MISSING if the record is known to have no MeTree file,
+        or None if not cached
+        '''
+        ref_path = self._ref_path(record_id)
+        try:
+            age = time.time() - os.path.getmtime(ref_path)
+            if self.max_age_sec and age > self.max_age_sec:
+                return None
+            with open(ref_path, 'r') as f:
+                digest = f.read().strip()
+            if digest == MetreeCache.MISSING_REF:
+                return MetreeCache.MISSING if age <= self.missing_max_age_sec else None
+            object_path = self._object_path(digest)
+            with open(object_path, 'rb') as f:
+                content = f.read()
+            # Mark as recently used
+            os.utime(object_path)
+        except OSError:
+            return None
+        return content
+
+    def contains(self, record_id):
+        '''
+        Checks whether get would return a cached result, without reading the MeTree file
+
+        Return
+        ------
+        True if the record's MeTree file, or the fact that it has none, is cached
+        '''
+        ref_path = self._ref_path(record_id)
+        try:
+            age = time.time() - os.path.getmtime(ref_path)
+            if self.max_age_sec and age > self.max_age_sec:
+                return False
+            with open(ref_path, 'r') as f:
+                digest = f.read().strip()
+            if digest == MetreeCache.MISSING_REF:
+                return age <= self.missing_max_age_sec
+            return os.path.exists(self._object_path(digest))
+        except OSError:
+            return False
+
+    def put(self, record_id, content):
+        '''
+        Stores the MeTree file contents (bytes) for the R4 record
+
+        Return
+        ------
+        SHA-256 of the contents
+        '''
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if os.path.exists(object_path):
+            os.utime(object_path)
+        else:
+            MetreeCache._write_atomic(object_path, content)
+            with self._evict_lock:
+                self._total_bytes += len(content)
+        MetreeCache._write_atomic(self._ref_path(record_id), digest.encode('ascii'))
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+        return digest
+
+    def put_missing(self, record_id):
+        ''' Records that the R4 record has no MeTree file (see missing_max_age_sec) '''
+        if self.missing_max_age_sec:
+            MetreeCache._write_atomic(self._ref_path(record_id), MetreeCache.MISSING_REF.encode('ascii'))
+
+    def _scan(self):
+        ''' Returns ([(mtime, size, path)] of the cached files, total size) '''
+        entries = []
+        total = 0
+        for entry in os.scandir(self._objects_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        with self._evict_lock:
+            entries, total = self._scan()
+            self._total_bytes = total
+            if total <= self.max_bytes:
+                return
+
+            # Remove least recently used first. Refs to removed files are treated as cache misses.
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._total_bytes = total
+
+
 class R4(Project):
     # REDCap variable names
     FIELD_RECORD_ID = 'record_id'  # Record ID in R4
     FIELD_METREE_JSON_FILE = 'metree_import_json_file'
 
-    def __init__(self, endpoint, api_token):
+    def __init__(self, endpoint, api_token, metree_cache=None):
+        '''
+        Params
+        ------
+        endpoint: R4 API URL
+        api_token: R4 API token
+        metree_cache: [Optional] MetreeCache for keeping MeTree files between runs
+        '''
         self.endpoint = endpoint
         self.api_token = api_token
+        self.metree_cache = metree_cache
+        # MeTree files fetched by prefetch_metree and not yet used, including None when no file is available
+        self._metree_fetched = dict()
 
         # PyCap expects endpoint to end with '/'
         if self.endpoint[-1] != '/':
             self.endpoint += '/'
-        super().__init__(self.endpoint, self.api_token)
+        super().__init__(self.endpoint, self.api_token, hooks={'response': METRICS.http_hook('r4')})
+
+    def _fetch_metree(self, record_id):
+        ''' Downloads the MeTree file from R4. Returns the file contents (bytes) or None if there is no file '''
+        with METRICS.timer('r4_metree_fetch'):
+            try:
+                file_response = self.export_file(record=record_id, field=R4.FIELD_METREE_JSON_FILE)
+            except RedcapError:
+                # No MeTree JSON file for this participant
+                logger.debug('No MeTree JSON file for this participant')
+                METRICS.inc('metree_missing_total')
+                if self.metree_cache is not None:
+                    self.metree_cache.put_missing(record_id)
+                return None
+
+        content = file_response[0]
+        if self.metree_cache is not None:
+            self.metree_cache.put(record_id, content)
+        return content
+
+    def _get_metree_content(self, record_id):
+        # Prefetched files are only kept until they are used, so memory doesn't grow with each chunk
+        content = self._metree_fetched.pop(record_id, MetreeCache.MISSING)
+        if content is not MetreeCache.MISSING:
+            return content
+        if self.metree_cache is not None:
+            content = self.metree_cache.get(record_id)
+            METRICS.inc('metree_cache_total', result='miss' if content is None else 'hit')
+            if content is MetreeCache.MISSING:
+                METRICS.inc('metree_missing_total')
+                return None
+            if content is not None:
+                return content
+        return self._fetch_metree(record_id)
+
+    def prefetch_metree(self, record_ids, max_workers=4):
+        '''
+        Downloads MeTree files for multiple records in parallel, so that get_metree_json doesn't have to wait
+        for R4. Records already in the MeTree cache are not requested.
+
+        Params
+        ------
+        record_ids: R4 record IDs
+        max_workers: Max number of concurrent R4 requests
+
+        Return
+        ------
+        Number of records requested from R4
+        '''
+        to_fetch = [x for x in dict.fromkeys(record_ids)
+                    if x not in self._metree_fetched
+                    and (self.metree_cache is None or not self.metree_cache.contains(x))]
+        if not to_fetch:
+            return 0
+
+        def _fetch(record_id):
+            try:
+                return self._fetch_metree(record_id)
+            except Exception as e:
+                # Leave it for get_metree_json to retry
+                logger.warning(f'Unable to prefetch MeTree for R4 record {record_id}: {e!r}')
+                raise
+
+        with METRICS.timer('r4_metree_prefetch'), \
+                ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='metree') as executor:
+            # Download metrics and logs keep the caller's log_context (e.g., the site)
+            futures = {record_id: executor.submit(with_log_context(_fetch), record_id) for record_id in to_fetch}
+        for record_id, future in futures.items():
+            if future.exception() is None:
+                self._metree_fetched[record_id] = future.result()
+
+        logger.debug(f'Prefetched MeTree for {len(to_fetch)} R4 records')
+        return len(to_fetch)
+
+    def clear_prefetched(self, record_ids=None):
+        '''
+        Forgets MeTree files fetched by prefetch_metree and not used, e.g., after a chunk of participants or between
+        daemon cycles. The MeTree cache is kept.
+
+        Params
+        ------
+        record_ids: [Optional] Only forget these records. By default, all records.
+        '''
+        if record_ids is None:
+            self._metree_fetched = dict()
+        else:
+            for record_id in record_ids:
+                self._metree_fetched.pop(record_id, None)
 
     def get_metree_json(self, record_id):
         """ Get MeTree JSON data file from R4
 
+        Uses files prefetched with prefetch_metree or in the MeTree cache when available.
+
         Params
         ------
         record_id: (str) record ID
@@ -31,12 +289,9 @@ class R4(Project):
         -------
         JSON data object if MeTree is available. Otherwise, None
         """
-        try:
-            file_response = self.export_file(record=record_id, field=R4.FIELD_METREE_JSON_FILE)
-        except RedcapError:
-            # No MeTree JSON file for this participant
-            logger.debug('No MeTree JSON file for this participant')
+        content = self._get_metree_content(record_id)
+        if content is None:
             return None
 
         # Convert response to JSON object
-        return json.loads(file_response[0])
+        return json.loads(content)
@@ -1,15 +1,76 @@
-from urllib.parse import urljoin
-import json
 import logging
 from enum import Enum
-from datetime import date
+import os
 import re
+import threading
+import time
 
-import requests
-from redcap import Project
+from requests import RequestException
+from redcap import Project, RedcapError
+
+from redcap_mirror import RedcapMirror
+from order_ids import OrderIdAllocator
+from log_setup import with_log_context
+from metrics import METRICS
 
 logger = logging.getLogger(__name__)
 
+
+class MappedProject:
+    ''' PyCap Project wrapper for projects whose field names differ from the Redcap.FIELD_* names
+
+    Field and form names in export requests, including [field] references in filter logic, are translated to the
+    project's names, and exported records are returned with the Redcap.FIELD_* names. Imported records are translated
+    back. Checkbox fields (<field>___<code>) are translated by their field name. Everything else is passed through.
+    '''
+    _FILTER_FIELD = re.compile(r'\[([A-Za-z0-9_]+)\]')
+
+    def __init__(self, project, field_map):
+        '''
+        Params
+        ------
+        project: PyCap Project
+        field_map: Dict of Redcap.FIELD_* (or form) name: name in the project
+        '''
+        self._project = project
+        self._to_project = dict(field_map)
+        self._from_project = {v: k for k, v in field_map.items()}
+
+    @staticmethod
+    def _rename(name, names):
+        renamed = names.get(name)
+        if renamed is not None:
+            return renamed
+        base, sep, code = name.partition('___')
+        if sep and base in names:
+            return f'{names[base]}___{code}'
+        return name
+
+    def _rename_record(self, record, names):
+        return {self._rename(k, names): v for k, v in record.items()}
+
+    def export_records(self, fields=None, forms=None, filter_logic=None, **kwargs):
+        if fields is not None:
+            fields = [self._rename(f, self._to_project) for f in fields]
+        if forms is not None:
+            forms = [self._rename(f, self._to_project) for f in forms]
+        if filter_logic:
+            filter_logic = MappedProject._FILTER_FIELD.sub(
+                lambda m: f'[{self._rename(m.group(1), self._to_project)}]', filter_logic)
+        records = self._project.export_records(fields=fields, forms=forms, filter_logic=filter_logic, **kwargs)
+        if isinstance(records, list):
+            records = [self._rename_record(r, self._from_project) for r in records]
+        return records
+
+    def import_records(self, to_import, **kwargs):
+        if isinstance(to_import, list):
+            to_import = [self._rename_record(r, self._to_project) for r in to_import]
+        return self._project.import_records(to_import, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._project, name)
+
+
 class Redcap:
     _FORM_INVITAE_ORDER = 'specimen_reminders'
 
@@ -81,6 +142,29 @@ class Redcap:
     # MeTree
     FIELD_METREE_JSON = 'metree_json'
 
+    # Fields exported for placing new orders, in addition to the Invitae Ordering instrument
+    _FIELDS_NEW_ORDER_INFO = [FIELD_RECORD_ID, FIELD_LAB_ID, FIELD_R4_RECORD_ID,
+                              FIELD_NAME_FIRST, FIELD_NAME_LAST, FIELD_DOB,
+                              FIELD_SEX, FIELD_RACE, FIELD_ASHKENAZI, FIELD_ORDER_LOG] + \
+                             FIELDS_BPHH_CURRENT + FIELDS_BPHH_PAST
+    _FIELDS_NEW_ORDER_REQUIREMENTS = [FIELD_AGE, FIELD_SAMPLE_RECEIVED, FIELD_SAMPLE_REPLACE,
+                                      FIELD_ORDER_READY, FIELD_WITHDRAWAL]
+    _FIELDS_NEW_ORDER = _FIELDS_NEW_ORDER_INFO + _FIELDS_NEW_ORDER_REQUIREMENTS
+
+    # REDCap filter logic selecting records marked as ready for order
+    _FILTER_ORDER_READY = f"[{FIELD_ORDER_READY}] = '1'"
+
+    # Default number of records requested by ID in one export
+    _EXPORT_PAGE_SIZE = 500
+
+    # Order IDs are <prefix><YYYYMMDD>_<NNN>
+    _ORDER_ID_PREFIX = 'COLUMBIA_ORDER_'
+
+    # Fields kept in the local mirror: everything needed for new orders, order queries, and order IDs
+    _FIELDS_MIRROR = _FIELDS_NEW_ORDER + [FIELD_ORDER_ID, FIELD_ORDER_DATE, FIELD_ORDER_STATUS]
+    # Pulls within this many seconds of the last mirror sync reuse it without another delta export
+    _MIRROR_MIN_SYNC_INTERVAL_SEC = 10
+
     class YesNo(Enum):
         NO = '0'
         YES  = '1'
@@ -97,21 +181,75 @@ class Redcap:
         UNVERIFIED = '1'
         COMPLETE = '2'
 
-    def __init__(self, endpoint, api_token):
+    def __init__(self, endpoint, api_token, mirror_path=None, mirror_overlap_sec=300, mirror_server_timezone=None,
+                 order_id_store=None, order_id_block_size=1, export_page_size=None, field_map=None,
+                 order_id_prefix=None, order_id_store_readonly=False):
+        '''
+        Params
+        ------
+        endpoint: REDCap API URL
+        api_token: REDCap API token
+        mirror_path: [Optional] SQLite file for a local mirror of the order-related fields. When set, records
+                     are pulled from the mirror, which is kept current with small delta exports.
+        mirror_overlap_sec: [Optional] Overlap between consecutive delta exports, to allow for clock differences
+        mirror_server_timezone: [Optional] Time zone of the REDCap server for delta exports (see RedcapMirror)
+        order_id_store: [Optional] SQLite file for keeping track of order numbers across runs. When set, REDCap is
+                        only checked for existing order IDs when the store is created or sync_order_ids is called.
+        order_id_block_size: [Optional] Number of order IDs reserved from the store at a time
+        export_page_size: [Optional] Max number of records requested in one export when exporting large sets of records
+        field_map: [Optional] Dict of Redcap.FIELD_* (or form) name: name in this project, for projects whose field
+                   names differ (see MappedProject). Records are always handled with the Redcap.FIELD_* names.
+        order_id_prefix: [Optional] Order ID prefix. Defaults to Redcap._ORDER_ID_PREFIX
+        order_id_store_readonly: [Optional] Don't use up numbers in order_id_store, e.g., in a dry run. Order IDs
+                                 are allocated in memory, after the last ones in the store and in REDCap.
+        '''
         self.endpoint = endpoint
         self.api_token = api_token
 
         # PyCap expects endpoint to end with '/'
         if self.endpoint[-1] != '/':
             self.endpoint += '/'
-        self.project = Project(self.endpoint, self.api_token)
-
-        # Templates for order ID
-        self._order_id_prefix = f'COLUMBIA_ORDER_{date.today().strftime("%Y%m%d")}_'
-        self._order_id_template = self._order_id_prefix + '{:03d}'
-        self._order_id_regex = self._order_id_prefix + '(\d{3})'
-        # For keeping track of order numbers
-        self._next_order_num = self._get_max_order_num()
+        self.project = Project(self.endpoint, self.api_token, hooks={'response': METRICS.http_hook('redcap')})
+        if field_map:
+            self.project = MappedProject(self.project, field_map)
+        self.order_id_prefix = order_id_prefix or Redcap._ORDER_ID_PREFIX
+        self.export_page_size = export_page_size or Redcap._EXPORT_PAGE_SIZE
+        # Optional batched writeback of order status updates. See enable_writeback_buffer
+        self.writeback = None
+        # Called with each order status update once it has been imported to REDCap. See add_writeback_listener
+        self._writeback_listeners = []
+
+        # Optional local mirror
+        self.mirror = None
+        self._mirror_synced_at = None
+        if mirror_path:
+            self.mirror = RedcapMirror(self.project, mirror_path,
+                                       fields=Redcap._FIELDS_MIRROR,
+                                       forms=[Redcap._FORM_INVITAE_ORDER],
+                                       field_record_id=Redcap.FIELD_RECORD_ID,
+                                       field_order_ready=Redcap.FIELD_ORDER_READY,
+                                       field_order_status=Redcap.FIELD_ORDER_STATUS,
+                                       field_order_id=Redcap.FIELD_ORDER_ID,
+                                       overlap_sec=mirror_overlap_sec,
+                                       server_timezone=mirror_server_timezone,
+                                       page_size=self.export_page_size)
+            self.add_writeback_listener(self.mirror.apply)
+
+        # Order IDs. Without a durable store, order numbers are kept in memory and today's highest order number
+        # is looked up in REDCap the first time an order ID is needed.
+        if order_id_store and order_id_store_readonly:
+            def seed(day):
+                return max(OrderIdAllocator.stored_last_num(order_id_store, self.order_id_prefix, day),
+                           self._get_max_order_num(day))
+            order_id_store = None
+        else:
+            seed = None if order_id_store else self._get_max_order_num
+        new_store = bool(order_id_store) and not os.path.exists(order_id_store)
+        self._order_ids = OrderIdAllocator(self.order_id_prefix, path=order_id_store,
+                                           block_size=order_id_block_size, seed=seed)
+        if new_store:
+            # Store was just created. Start after any order IDs already in REDCap for today.
+            self.sync_order_ids()
 
     def pull_info_for_new_order(self):
         '''
@@ -124,53 +262,140 @@ class Redcap:
         ------
         Dict of participant information required for Invitae order
         '''
+        return list(self.iter_info_for_new_order())
+
+    def iter_info_for_new_order(self):
+        '''
+        Generator version of pull_info_for_new_order. Eligible participants are yielded as each page of records
+        is exported, so memory use doesn't depend on the number of participants.
+
+        Records are exported in two phases: REDCap filters the project down to the IDs of records marked
+        ready for order, then only those records are exported with all fields needed for the order.
+        The safeguard checks are still performed locally on the exported records.
+
+        Yields
+        ------
+        Dict of participant information required for Invitae order
+        '''
+        if self.mirror is not None:
+            self._sync_mirror()
+            records = self.mirror.records_order_ready(Redcap.YesNo.YES.value)
+            yield from (r for r in records if Redcap._check_new_order_eligibility(r))
+            return
+
+        # Phase 1: IDs of records marked ready for order. The order ready flag is cleared after every
+        # order attempt, so this also leaves out records that have already been ordered.
+        record_ids = self.export_record_ids(filter_logic=Redcap._FILTER_ORDER_READY)
+
+        # Phase 2: Full export of only those records
         # Specify which forms and fields are needed from the record export
         # Get all fields from Invitae Ordering instrument and record_id and participant_lab_id
         forms = [Redcap._FORM_INVITAE_ORDER]
-        fields_info = [Redcap.FIELD_RECORD_ID, Redcap.FIELD_LAB_ID, Redcap.FIELD_R4_RECORD_ID,
-                       Redcap.FIELD_NAME_FIRST, Redcap.FIELD_NAME_LAST, Redcap.FIELD_DOB, 
-                       Redcap.FIELD_SEX, Redcap.FIELD_RACE, Redcap.FIELD_ASHKENAZI, Redcap.FIELD_ORDER_LOG] + \
-                       Redcap.FIELDS_BPHH_CURRENT + Redcap.FIELDS_BPHH_PAST
-        fields_requirements = [Redcap.FIELD_AGE, Redcap.FIELD_SAMPLE_RECEIVED, Redcap.FIELD_SAMPLE_REPLACE,
-                              Redcap.FIELD_ORDER_READY, Redcap.FIELD_WITHDRAWAL]
-        fields = fields_info + fields_requirements
+        fields = Redcap._FIELDS_NEW_ORDER
+        records = self.iter_records(fields=fields, forms=forms, record_ids=record_ids)
+        yield from (r for r in records if Redcap._check_new_order_eligibility(r))
 
-        participant_info = []
-        records = self.project.export_records(fields=fields, forms=forms)
-        for record in records:
-            if record[Redcap.FIELD_ORDER_READY] == Redcap.YesNo.YES.value:
-                # Perform various other safeguard checks before placing the order
-                # if (record[Redcap.FIELD_ORDER_STATUS] != Redcap.OrderStatus.NOT_ORDERED.value
-                #         and record[Redcap.FIELD_ORDER_STATUS]):
-                #     logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
-                #                    'but the order status must be "Not ordered yet".')
-                #     continue
-                if record[Redcap.FIELD_SAMPLE_RECEIVED] != Redcap.YesNo.YES.value:
-                    logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
-                                   'but the sample has not been received. Order not placed.')
-                    continue
-                elif record[Redcap.FIELD_SAMPLE_REPLACE] == Redcap.YesNo.YES.value:
-                    logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
-                                   'but the sample needs to be replaced. Order not placed.')
-                    continue
-                elif int(record[Redcap.FIELD_AGE]) < 18:
-                    logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
-                                   'but the participant age was under 18. Order not placed.')
-                    continue
-                elif record[Redcap.FIELD_WITHDRAWAL] == Redcap.YesNo.YES.value:
-                    logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
-                                   'but the participant has withdrawn. Order not placed.')
-                    continue
-                else:
-                    # Add participant to list of participants for ordering
-                    participant_info.append(record)
+    def iter_info_for_records(self, record_ids):
+        '''
+        Like iter_info_for_new_order, but only checks the given records, e.g., records queued by REDCap Data Entry
+        Triggers. The records are exported from REDCap even when the local mirror is enabled, so they are current.
 
-        return participant_info
+        Params
+        ------
+        record_ids: Record IDs to check
+
+        Yields
+        ------
+        Dict of participant information required for Invitae order, for each of the records that is eligible
+        '''
+        records = self.iter_records(fields=Redcap._FIELDS_NEW_ORDER, forms=[Redcap._FORM_INVITAE_ORDER],
+                                    record_ids=list(record_ids))
+        yield from (r for r in records if Redcap._check_new_order_eligibility(r))
+
+    def export_record_ids(self, filter_logic=None):
+        '''
+        Exports only the record ID field
+
+        Params
+        ------
+        filter_logic: [Optional] REDCap filter logic selecting the records
+
+        Return
+        ------
+        List of record IDs
+        '''
+        with METRICS.timer('redcap_export_ids'):
+            records = self.project.export_records(fields=[Redcap.FIELD_RECORD_ID], filter_logic=filter_logic)
+        METRICS.inc('records_total', len(records), stage='redcap_export_ids')
+        return [r[Redcap.FIELD_RECORD_ID] for r in records]
+
+    def iter_records(self, fields=None, forms=None, record_ids=None, filter_logic=None):
+        '''
+        Exports records in pages of export_page_size records, requested by record ID. Each page is parsed and
+        yielded before the next one is requested, so only one page is held in memory at a time.
+
+        Params
+        ------
+        fields: [Optional] Fields to export
+        forms: [Optional] Forms to export
+        record_ids: [Optional] IDs of the records to export. By default, all records (or those matching filter_logic)
+        filter_logic: [Optional] REDCap filter logic selecting the records, if record_ids is not given
+
+        Yields
+        ------
+        Dict of each record
+        '''
+        if record_ids is None:
+            record_ids = self.export_record_ids(filter_logic=filter_logic)
+
+        for i in range(0, len(record_ids), self.export_page_size):
+            with METRICS.timer('redcap_export'):
+                page = self.project.export_records(records=record_ids[i:i + self.export_page_size],
+                                                   fields=fields, forms=forms)
+            METRICS.inc('records_total', len(page), stage='redcap_export')
+            yield from page
+
+    @staticmethod
+    def _check_new_order_eligibility(record):
+        '''
+        Safeguard checks before placing an order for a record
+
+        Return
+        ------
+        True if the participant is marked as ready and passes all checks
+        '''
+        if record[Redcap.FIELD_ORDER_READY] != Redcap.YesNo.YES.value:
+            return False
+
+        # Perform various other safeguard checks before placing the order
+        # if (record[Redcap.FIELD_ORDER_STATUS] != Redcap.OrderStatus.NOT_ORDERED.value
+        #         and record[Redcap.FIELD_ORDER_STATUS]):
+        #     logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
+        #                    'but the order status must be "Not ordered yet".')
+        #     return False
+        if record[Redcap.FIELD_SAMPLE_RECEIVED] != Redcap.YesNo.YES.value:
+            logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
+                           'but the sample has not been received. Order not placed.')
+            return False
+        elif record[Redcap.FIELD_SAMPLE_REPLACE] == Redcap.YesNo.YES.value:
+            logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
+                           'but the sample needs to be replaced. Order not placed.')
+            return False
+        elif int(record[Redcap.FIELD_AGE]) < 18:
+            logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
+                           'but the participant age was under 18. Order not placed.')
+            return False
+        elif record[Redcap.FIELD_WITHDRAWAL] == Redcap.YesNo.YES.value:
+            logger.warning(f'CUIMC ID {record[Redcap.FIELD_RECORD_ID]} was marked for submitting order, '
+                           'but the participant has withdrawn. Order not placed.')
+            return False
+
+        return True
 
     def pull_info_for_query_order(self):
         '''
         Retrieves info of all participants whose order status should be queried:
-        participants whose order has been submitted but has not yet been completed.
+        participants whose order has been submitted but has not yet been completed, with their order IDs and dates.
 
         Return
         ------
@@ -182,57 +407,114 @@ class Redcap:
         fields = [Redcap.FIELD_RECORD_ID, Redcap.FIELD_LAB_ID,
                   Redcap.FIELD_NAME_FIRST, Redcap.FIELD_NAME_LAST,
                   Redcap.FIELD_DOB, Redcap.FIELD_SEX,
-                  Redcap.FIELD_ORDER_STATUS]
+                  Redcap.FIELD_ORDER_ID, Redcap.FIELD_ORDER_DATE, Redcap.FIELD_ORDER_STATUS]
+
+        # utils imports this module
+        from utils import map_redcap_sex_to_redox_sex
 
         participant_info = []
-        records = self.project.export_records(fields=fields, forms=forms)
+        if self.mirror is not None:
+            self._sync_mirror()
+            records = self.mirror.records_order_status_between(Redcap.OrderStatus.NOT_ORDERED.value,
+                                                               Redcap.OrderStatus.COMPLETED.value)
+        else:
+            records = self.project.export_records(fields=fields, forms=forms)
         for record in records:
             if Redcap.OrderStatus.NOT_ORDERED.value < record[Redcap.FIELD_ORDER_STATUS] < Redcap.OrderStatus.COMPLETED.value:
                 # Convert REDCap's sex values to the Redox value set
-                record[Redcap.FIELD_SEX] = Redcap.map_redcap_sex_to_redox_sex(record[Redcap.FIELD_SEX])
+                record[Redcap.FIELD_SEX] = map_redcap_sex_to_redox_sex(record[Redcap.FIELD_SEX])
                 participant_info.append(record)
 
         # For testing, return the entire records
         return participant_info
 
+    def find_orders(self, order_ids):
+        '''
+        Looks up the records of orders, e.g., orders named in messages from Redox
+
+        Params
+        ------
+        order_ids: Order IDs
+
+        Return
+        ------
+        Dict of order ID: (record ID, order status) for the order IDs found in REDCap
+        '''
+        order_ids = set(order_ids)
+        if not order_ids:
+            return dict()
+        if self.mirror is not None:
+            self._sync_mirror()
+            records = self.mirror.records_with_order_ids(order_ids)
+        else:
+            with METRICS.timer('redcap_export_orders'):
+                records = self.project.export_records(fields=[Redcap.FIELD_RECORD_ID, Redcap.FIELD_ORDER_ID,
+                                                              Redcap.FIELD_ORDER_STATUS])
+        return {r[Redcap.FIELD_ORDER_ID]: (r[Redcap.FIELD_RECORD_ID], r[Redcap.FIELD_ORDER_STATUS])
+                for r in records if r[Redcap.FIELD_ORDER_ID] in order_ids}
+
     def get_new_order_id(self):
         '''
-        Retrieves a new order ID for placing new Invitae orders.
+        Retrieves a new order ID for placing new Invitae orders. Safe to call from multiple threads.
 
         Return
         ------
         A new order ID
         '''
-        if self._next_order_num is None:
-            self._next_order_num = self._get_max_order_num()
-
-        self._next_order_num += 1
-        next_order_id = self._order_id_template.format(self._next_order_num)
+        next_order_id = self._order_ids.next_id()
         logger.debug(f'get_new_order_id: {next_order_id}')
 
         return next_order_id
 
-    def _get_max_order_num(self):
+    def sync_order_ids(self):
+        '''
+        Checks today's order IDs in REDCap and makes sure new order IDs come after them
+        '''
+        day = OrderIdAllocator.today()
+        self._order_ids.ensure_at_least(day, self._get_max_order_num(day))
+
+    def _get_max_order_num(self, day=None):
         '''
-        Gets the max order number in REDCap matching the current template
+        Gets the max order number in REDCap for order IDs created on day ('YYYYMMDD', default today)
         '''
-        records = self.project.export_records(fields=[Redcap.FIELD_ORDER_ID])
+        if day is None:
+            day = OrderIdAllocator.today()
+        prefix = f'{self.order_id_prefix}{day}_'
+
+        if self.mirror is not None:
+            self._sync_mirror()
+            order_ids = self.mirror.order_ids_with_prefix(prefix)
+        else:
+            records = self.project.export_records(fields=[Redcap.FIELD_ORDER_ID])
+            order_ids = [rec[Redcap.FIELD_ORDER_ID] for rec in records]
 
         max_order_id_num = 0
-        if records:
-            r = re.compile(self._order_id_regex)
-            for rec in records:
-                order_id = rec[Redcap.FIELD_ORDER_ID]
-                try:
-                    m = r.match(order_id)
-                    if m:
-                        order_id_num = int(m[1])
-                        max_order_id_num = max(max_order_id_num, order_id_num)
-                except ValueError:
-                    continue
+        for order_id in order_ids:
+            parsed = self._order_ids.parse(order_id)
+            if parsed and parsed[0] == day:
+                max_order_id_num = max(max_order_id_num, parsed[1])
 
         return max_order_id_num
 
+    def _sync_mirror(self):
+        now = time.monotonic()
+        if self._mirror_synced_at is None or now - self._mirror_synced_at > Redcap._MIRROR_MIN_SYNC_INTERVAL_SEC:
+            with METRICS.timer('redcap_mirror_sync'):
+                self.mirror.sync()
+            self._mirror_synced_at = now
+
+    def verify_mirror(self, repair=True):
+        '''
+        Compares the local mirror with a full export of REDCap. See RedcapMirror.verify
+
+        Return
+        ------
+        Dict with lists of differing record IDs, or None if the mirror is not enabled
+        '''
+        if self.mirror is None:
+            return None
+        return self.mirror.verify(repair=repair)
+
     def update_order_status(self, record_id, order_new=None, order_status=None, order_date=None, order_id=None, order_log=None, form_complete=None):
         '''
         Update the Invitae order status in local redcap
@@ -249,9 +531,96 @@ class Redcap:
 
         Return
         ------
-        True if successful
+        True if successful, or if the update was queued when the writeback buffer is enabled
+        '''
+        record = Redcap.build_order_status_record(record_id, order_new, order_status, order_date, order_id,
+                                                  order_log, form_complete)
+
+        if len(record) > 1:
+            if self.writeback is not None:
+                # Batched writeback. Results are available when the buffer is flushed.
+                self.writeback.add(record)
+                return True
+
+            with METRICS.timer('redcap_writeback') as t:
+                response = self.project.import_records([record])
+                if response.get('count') != 1:
+                    t.fail()
+            if response.get('count') == 1:
+                logger.info('Successfully updated local REDCap with order status')
+                self._notify_written(record)
+                return True
+            else:
+                logger.error(f'Unuccessful attempt to update local REDCap with order status: {record}. Response from update attempt: {response}')
+
+        return True
+
+    def enable_writeback_buffer(self, chunk_size=100, flush_interval_sec=30):
+        '''
+        Batch order status updates: update_order_status queues records that are imported to REDCap in chunks.
+        Call flush_order_status at the end of a batch to write out the remaining updates.
+
+        Params
+        ------
+        chunk_size: Max records per import request. A full chunk is imported right away.
+        flush_interval_sec: Max time an update waits in the buffer before it is imported
+        '''
+        if self.writeback is None:
+            self.writeback = RedcapWriteback(self.project, chunk_size=chunk_size, flush_interval_sec=flush_interval_sec,
+                                             on_imported=self._notify_written)
+        return self.writeback
+
+    def add_writeback_listener(self, listener):
+        '''
+        Params
+        ------
+        listener: Called with each order status update (dict with the record ID and updated fields) after it has
+                  been imported to REDCap, whether directly or through the writeback buffer
+        '''
+        self._writeback_listeners.append(listener)
+
+    def _notify_written(self, record):
+        for listener in self._writeback_listeners:
+            listener(record)
+
+    def write_order_status_records(self, records, chunk_size=None):
+        '''
+        Imports order status updates built with build_order_status_record in bulk, bypassing the writeback buffer
+
+        Params
+        ------
+        records: Order status updates
+        chunk_size: [Optional] Max records per import request. Defaults to export_page_size
+
+        Return
+        ------
+        Dict of record ID -> True if the update was imported
+        '''
+        writeback = RedcapWriteback(self.project, chunk_size=chunk_size or self.export_page_size, flush_interval_sec=0,
+                                    on_imported=self._notify_written)
+        results = dict()
+        for record in records:
+            results.update(writeback.add(record))
+        results.update(writeback.flush())
+        return results
+
+    def flush_order_status(self):
+        '''
+        Imports all buffered order status updates
+
+        Return
+        ------
+        Dict of record ID -> True if the update was imported, for the records imported by this flush
+        '''
+        if self.writeback is None:
+            return dict()
+        return self.writeback.flush()
+
+    @staticmethod
+    def build_order_status_record(record_id, order_new=None, order_status=None, order_date=None, order_id=None, order_log=None, form_complete=None):
+        '''
+        Order status update for one record, with only the supplied values. See update_order_status
         '''
-        # Build the updated record using only the supplied values
         record = {
             Redcap.FIELD_RECORD_ID: record_id
         }
@@ -267,13 +636,111 @@ class Redcap:
             record[Redcap.FIELD_ORDER_LOG] = order_log
         if form_complete is not None:
             record[Redcap.FIELD_ORDER_FORM_COMPLETE] = form_complete.value
+        return record
 
-        if len(record) > 1:
-            response = self.project.import_records([record])
-            if response.get('count') == 1:
-                logger.info('Successfully updated local REDCap with order status')
-                return True
+
+class RedcapWriteback:
+    ''' Buffers record updates and imports them to REDCap in chunks
+
+    Updates are flushed when the buffer reaches chunk_size records or when the oldest update has waited
+    flush_interval_sec. Multiple updates to the same record are merged into one.
+
+    REDCap rejects a whole import request when any row in it is invalid. When a chunk is rejected, it is split
+    in half and each half is retried, down to single records, so that one bad row doesn't fail the others.
+    flush returns the result of each record's update in that flush.
+    '''
+    def __init__(self, project, chunk_size=100, flush_interval_sec=30, on_imported=None):
+        '''
+        Params
+        ------
+        project: PyCap Project
+        chunk_size: Max records per import request
+        flush_interval_sec: Max time an update waits in the buffer before it is imported
+        on_imported: [Optional] Called with each record update that was successfully imported
+        '''
+        self.project = project
+        self.on_imported = on_imported
+        self.chunk_size = max(1, chunk_size)
+        self.flush_interval_sec = flush_interval_sec
+
+        self._pending = dict()  # record ID -> merged record update
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def add(self, record):
+        '''
+        Queues a record update, importing the buffer right away if it is full
+
+        Return
+        ------
+        Dict of record ID -> True if the update was imported, if the buffer was flushed. Otherwise an empty dict.
+        '''
+        record_id = record[Redcap.FIELD_RECORD_ID]
+        with self._lock:
+            if record_id in self._pending:
+                self._pending[record_id].update(record)
             else:
-                logger.error(f'Unuccessful attempt to update local REDCap with order status: {record}. Response from update attempt: {response}')
+                self._pending[record_id] = dict(record)
+            full = len(self._pending) >= self.chunk_size
+            if not full and self._timer is None and self.flush_interval_sec > 0:
+                self._timer = threading.Timer(self.flush_interval_sec, with_log_context(self.flush))
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            return self.flush()
+        return dict()
+
+    def flush(self):
+        '''
+        Imports all pending updates
 
-        return True
+        Return
+        ------
+        Dict of record ID -> True if the update was imported, for the records in this flush
+        '''
+        flush_results = dict()
+        # One flush at a time, so updates to the same record are imported in order. The buffer is taken inside the
+        # flush lock so that a flush waiting on another can't import older updates after the newer ones.
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._pending.values())
+                self._pending = dict()
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            for i in range(0, len(pending), self.chunk_size):
+                self._import(pending[i:i + self.chunk_size], flush_results)
+
+        n_failed = sum(1 for success in flush_results.values() if not success)
+        if flush_results:
+            logger.info(f'Updated {len(flush_results) - n_failed} of {len(flush_results)} records in local REDCap')
+        return flush_results
+
+    def _import(self, chunk, flush_results):
+        try:
+            with METRICS.timer('redcap_writeback'):
+                response = self.project.import_records(chunk, return_content='ids')
+        except (RedcapError, RequestException) as e:
+            if len(chunk) > 1:
+                # Find the bad record(s) by splitting the chunk
+                mid = len(chunk) // 2
+                self._import(chunk[:mid], flush_results)
+                self._import(chunk[mid:], flush_results)
+            else:
+                logger.error(f'Unuccessful attempt to update local REDCap with order status: {chunk[0]}. Error: {e}')
+                flush_results[chunk[0][Redcap.FIELD_RECORD_ID]] = False
+            return
+
+        imported_ids = set(str(x) for x in response) if isinstance(response, list) else set()
+        for record in chunk:
+            record_id = record[Redcap.FIELD_RECORD_ID]
+            success = str(record_id) in imported_ids
+            if not success:
+                logger.error(f'Unuccessful attempt to update local REDCap with order status: {record}. Response from update attempt: {response}')
+            elif self.on_imported is not None:
+                self.on_imported(record)
+            flush_results[record_id] = success
+        METRICS.inc('records_total', len(imported_ids), stage='redcap_writeback')
@@ -0,0 +1,254 @@
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import sqlite3
+import threading
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+
+class RedcapMirror:
+    ''' Local SQLite copy of the REDCap records and fields used for Invitae orders
+
+    The mirror is kept current with delta exports: each sync only requests records created or modified since
+    the previous sync (REDCap dateRangeBegin), using a watermark stored in the mirror. The watermark is stored in
+    UTC and converted to the REDCap server's time zone for each export, since REDCap compares dateRangeBegin with
+    its own clock. Records are keyed by record ID and indexed on the order ready flag, order status, and order ID.
+
+    Delta exports can't see deleted records. Use verify to compare the mirror with a full export.
+    '''
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS records (
+            record_id TEXT PRIMARY KEY,
+            order_ready TEXT,
+            order_status TEXT,
+            order_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_records_order_ready ON records(order_ready);
+        CREATE INDEX IF NOT EXISTS idx_records_order_status ON records(order_status);
+        CREATE INDEX IF NOT EXISTS idx_records_order_id ON records(order_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+    _WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+    # Meta key of the watermark (UTC)
+    _WATERMARK_KEY = 'watermark_utc'
+
+    def __init__(self, project, path, fields, forms, field_record_id, field_order_ready, field_order_status,
+                 field_order_id, overlap_sec=300, page_size=500, server_timezone=None):
+        '''
+        Params
+        ------
+        project: PyCap Project to mirror
+        path: SQLite database file
+        fields: Fields to mirror
+        forms: Forms to mirror
+        field_record_id, field_order_ready, field_order_status, field_order_id: Names of the indexed fields
+        overlap_sec: Each delta export starts this many seconds before the last sync, to allow for
+                     clock differences between this machine and the REDCap server
+        page_size: Full exports are requested in pages of this many records, so a large project is never held
+                   in memory all at once
+        server_timezone: [Optional] Time zone of the REDCap server (IANA name, e.g., America/New_York), used for
+                         dateRangeBegin. Defaults to this machine's time zone.
+        '''
+        self.project = project
+        self.path = path
+        self.fields = list(fields)
+        self.forms = list(forms)
+        self.field_record_id = field_record_id
+        self.field_order_ready = field_order_ready
+        self.field_order_status = field_order_status
+        self.field_order_id = field_order_id
+        self.overlap = timedelta(seconds=overlap_sec)
+        self.page_size = page_size
+        # Raises ZoneInfoNotFoundError (a KeyError) for unknown time zones
+        self.server_timezone = ZoneInfo(server_timezone) if server_timezone else None
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(RedcapMirror._SCHEMA)
+
+        # Mirrored fields are part of the mirror's identity. If they change, start over with a full export.
+        signature = json.dumps([sorted(self.fields), sorted(self.forms)])
+        if self._get_meta('signature') != signature:
+            with self._lock, self._conn:
+                self._conn.execute('DELETE FROM records')
+                self._conn.execute('DELETE FROM meta')
+                self._conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('signature', signature))
+
+    def _get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def _row(self, record):
+        return (record[self.field_record_id],
+                record.get(self.field_order_ready),
+                record.get(self.field_order_status),
+                record.get(self.field_order_id),
+                json.dumps(record))
+
+    def _upsert(self, records):
+        with self._lock, self._conn:
+            self._write_records(records)
+
+    def _write_records(self, records):
+        ''' Inserts or replaces records. Call with the lock held, in a transaction. '''
+        self._conn.executemany('INSERT OR REPLACE INTO records (record_id, order_ready, order_status, order_id, data) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   (self._row(r) for r in records))
+
+    def _set_watermark(self, watermark):
+        ''' Stores the watermark (aware datetime). Call with the lock held, in a transaction. '''
+        value = watermark.astimezone(timezone.utc).strftime(RedcapMirror._WATERMARK_FORMAT)
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                           (RedcapMirror._WATERMARK_KEY, value))
+
+    @property
+    def watermark(self):
+        ''' Start of the last sync (aware datetime in UTC), or None before the first sync '''
+        value = self._get_meta(RedcapMirror._WATERMARK_KEY)
+        if not value:
+            return None
+        return datetime.strptime(value, RedcapMirror._WATERMARK_FORMAT).replace(tzinfo=timezone.utc)
+
+    def _server_time(self, dt):
+        ''' dt (aware) as a naive datetime in the REDCap server's time zone, as REDCap expects for dateRangeBegin '''
+        return dt.astimezone(self.server_timezone).replace(tzinfo=None)
+
+    def sync(self):
+        '''
+        Brings the mirror up to date. The first sync is a full export. Later syncs only export records
+        changed since the previous sync.
+
+        Return
+        ------
+        Number of records received from REDCap
+        '''
+        sync_start = datetime.now(timezone.utc)
+        watermark = self.watermark
+        if watermark is None:
+            logger.info('REDCap mirror is empty. Performing full export.')
+            n_records = 0
+            for page in self._export_pages():
+                self._upsert(page)
+                n_records += len(page)
+            records = []
+        else:
+            records = self.project.export_records(fields=self.fields, forms=self.forms,
+                                                  date_begin=self._server_time(watermark - self.overlap))
+            n_records = len(records)
+
+        # The records and the new watermark are saved together, so an interrupted sync is repeated
+        with self._lock, self._conn:
+            self._write_records(records)
+            self._set_watermark(sync_start)
+        logger.debug(f'REDCap mirror synced {n_records} records')
+        return n_records
+
+    def _export_pages(self):
+        ''' Full export of the mirrored fields, in pages of page_size records '''
+        id_records = self.project.export_records(fields=[self.field_record_id])
+        record_ids = [r[self.field_record_id] for r in id_records]
+        for i in range(0, len(record_ids), self.page_size):
+            yield self.project.export_records(records=record_ids[i:i + self.page_size],
+                                              fields=self.fields, forms=self.forms)
+
+    def apply(self, update):
+        '''
+        Applies a partial record update written to REDCap by this process, so the mirror doesn't have to
+        wait for the next sync to see it. Updates for records not in the mirror are ignored.
+        '''
+        record_id = update[self.field_record_id]
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM records WHERE record_id = ?', (record_id,)).fetchone()
+        if row is None:
+            return
+        record = json.loads(row[0])
+        record.update({k: v for k, v in update.items() if k in record})
+        self._upsert([record])
+
+    def _query(self, where, params=()):
+        with self._lock:
+            rows = self._conn.execute(f'SELECT data FROM records WHERE {where} ORDER BY rowid', params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def records_order_ready(self, value):
+        ''' Records whose order ready flag equals value '''
+        return self._query('order_ready = ?', (value,))
+
+    def records_order_status_between(self, low, high):
+        ''' Records with low < order status < high (compared as strings, like the REDCap export values) '''
+        return self._query('order_status > ? AND order_status < ?', (low, high))
+
+    def records_with_order_ids(self, order_ids):
+        ''' Records whose order ID is one of order_ids '''
+        order_ids = list(order_ids)
+        records = []
+        # Stay below SQLite's limit on the number of parameters
+        for i in range(0, len(order_ids), 500):
+            chunk = order_ids[i:i + 500]
+            records += self._query(f'order_id IN ({", ".join("?" for _ in chunk)})', tuple(chunk))
+        return records
+
+    def order_ids_with_prefix(self, prefix):
+        ''' All order IDs starting with prefix '''
+        # Escape LIKE wildcards that may appear in the prefix
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        with self._lock:
+            rows = self._conn.execute("SELECT order_id FROM records WHERE order_id LIKE ? ESCAPE '\\'",
+                                      (pattern,)).fetchall()
+        return [row[0] for row in rows]
+
+    def verify(self, repair=True):
+        '''
+        Compares the mirror with a full export of the project
+
+        Params
+        ------
+        repair: Replace the mirror contents with the full export when differences are found
+
+        Return
+        ------
+        Dict with lists of record IDs: 'missing' (in REDCap, not in mirror), 'extra' (in mirror, not in REDCap),
+        and 'different' (in both, with different values)
+        '''
+        sync_start = datetime.now(timezone.utc)
+        records = self.project.export_records(fields=self.fields, forms=self.forms)
+        remote = {r[self.field_record_id]: r for r in records}
+        with self._lock:
+            rows = self._conn.execute('SELECT record_id, data FROM records').fetchall()
+        local = {record_id: json.loads(data) for record_id, data in rows}
+
+        result = {
+            'missing': [x for x in remote if x not in local],
+            'extra': [x for x in local if x not in remote],
+            'different': [x for x in remote if x in local and remote[x] != local[x]],
+        }
+        n_diff = sum(len(v) for v in result.values())
+        if n_diff:
+            logger.warning(f'REDCap mirror differs from REDCap: {len(result["missing"])} missing, '
+                           f'{len(result["extra"])} extra, {len(result["different"])} different records')
+            if repair:
+                # One transaction, so an interrupted repair leaves the mirror as it was
+                with self._lock, self._conn:
+                    self._conn.execute('DELETE FROM records')
+                    self._write_records(records)
+                    self._set_watermark(sync_start)
+                logger.info('REDCap mirror rebuilt from full export')
+        else:
+            logger.info('REDCap mirror matches REDCap')
+
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
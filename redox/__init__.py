@@ -1 +1,10 @@
-from .invitae import RedoxInvitaeAPI
+from .resilience import RedoxUnavailableError, RedoxOutcomeUnknownError
+
+
+def __getattr__(name):
+    # RedoxInvitaeAPI is imported on first use, so importing redox doesn't load requests sessions or the order models
+    if name == 'RedoxInvitaeAPI':
+        from .invitae import RedoxInvitaeAPI
+        globals()[name] = RedoxInvitaeAPI
+        return RedoxInvitaeAPI
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,394 @@
+from urllib.parse import urljoin
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from metrics import METRICS
+
+from .resilience import (
+    RedoxUnavailableError,
+    RedoxOutcomeUnknownError,
+    TokenBucket,
+    CircuitBreaker,
+    RETRYABLE_STATUS,
+    THROTTLE_STATUS,
+    parse_retry_after,
+    backoff_delay
+    )
+
+try:
+    import fcntl
+except ImportError:
+    # File locking is not available (e.g., Windows). Token cache still works for single runs.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_expires(expires):
+    ''' Parses Redox token expiration, e.g., "2017-09-19T18:59:12.000Z", to an aware datetime. None if not parseable '''
+    if not expires:
+        return None
+    try:
+        dt = datetime.fromisoformat(expires.replace('Z', '+00:00'))
+    except (ValueError, AttributeError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _valid_token(token):
+    ''' True if the token dict has an access token '''
+    return isinstance(token, dict) and isinstance(token.get('accessToken'), str) and bool(token['accessToken'])
+
+
+def _parse_token(response):
+    ''' Token dict from a Redox authentication response. None if not successful or the token is missing. '''
+    if response.status_code != 200:
+        return None
+    try:
+        token = response.json()
+    except ValueError:
+        token = None
+    return token if _valid_token(token) else None
+
+
+def _not_sent(error):
+    ''' True if a requests.ConnectionError or Timeout happened before the request was sent (no connection) '''
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying connection error
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._f = open(self.path, 'a')
+            fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._f is not None:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+
+
+class TokenCache:
+    ''' Keeps a Redox access token in a JSON file so back-to-back runs can skip authentication.
+
+    Reads and writes are guarded with an exclusive lock on a companion ".lock" file, and the cache file
+    is replaced atomically so a reader never sees a partially written token.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + '.lock'
+
+    def _locked(self):
+        return _FileLock(self._lock_path)
+
+    @staticmethod
+    def _key_id(api_key):
+        # Store a hash of the API key, not the key itself, to tell tokens for different keys apart
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def load(self, api_key):
+        '''
+        Return
+        ------
+        Dict with accessToken, expires, and refreshToken for this API key, or None if not cached
+        '''
+        with self._locked():
+            try:
+                with open(self.path, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                return None
+
+        if cached.get('key') != TokenCache._key_id(api_key):
+            return None
+        return cached.get('token')
+
+    def save(self, api_key, token):
+        with self._locked():
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'key': TokenCache._key_id(api_key), 'token': token}, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                logger.warning(f'Unable to write Redox token cache {self.path}')
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+class RedoxClient:
+    ''' Redox HTTP client built on a shared, keep-alive requests session.
+
+    Tracks the access token's expiration and refreshes it ahead of time, before any request is sent with a
+    token that is about to expire. Safe to share across threads.
+    '''
+    ENDPOINT_AUTH = 'auth/authenticate'
+    ENDPOINT_REFRESH = 'auth/refreshToken'
+
+    # Redox access tokens are valid for 24 hours. Used when the expiration can't be read from the response
+    DEFAULT_TOKEN_LIFETIME = timedelta(hours=24)
+
+    def __init__(self, api_base_url, api_key, client_secret, pool_maxsize=10, refresh_margin_sec=300,
+                 token_cache_path=None, timeout_sec=60, rate_limit_per_sec=0, rate_limit_burst=None, max_retries=3,
+                 backoff_base_sec=1.0, backoff_max_sec=60.0, circuit_failure_threshold=5, circuit_reset_sec=60):
+        '''
+        Params
+        ------
+        api_base_url: Redox API base URL
+        api_key: Redox API key
+        client_secret: Redox API secret
+        pool_maxsize: Max number of connections kept open to Redox. Should be at least the number of workers
+        refresh_margin_sec: Refresh the access token when it expires within this many seconds
+        token_cache_path: [Optional] File for caching the access token between runs
+        timeout_sec: Timeout for each request
+        rate_limit_per_sec: Max requests per second sent by post (0 = no client-side limit). Lowered automatically
+                            when Redox throttles.
+        rate_limit_burst: [Optional] Max burst of requests. Defaults to rate_limit_per_sec
+        max_retries: Retries of a post after a connection error, timeout, or temporary error response (429/5xx).
+                     Failures after which Redox may have received a new order are not retried (see post).
+        backoff_base_sec, backoff_max_sec: Retries wait a random time up to backoff_base_sec * 2^retry,
+                                           capped at backoff_max_sec (or as long as Redox asks with Retry-After)
+        circuit_failure_threshold: Consecutive failed requests after which posts are refused for circuit_reset_sec
+        circuit_reset_sec: How long posts are refused before Redox is tried again
+        '''
+        self.api_base_url = api_base_url
+        self.api_key = api_key
+        self.client_secret = client_secret
+        self.refresh_margin = timedelta(seconds=refresh_margin_sec)
+        self.timeout_sec = timeout_sec
+        self.token_cache = TokenCache(token_cache_path) if token_cache_path else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(METRICS.http_hook('redox'))
+
+        self.rate_limiter = TokenBucket(rate_limit_per_sec, rate_limit_burst) if rate_limit_per_sec > 0 else None
+        self.circuit_breaker = CircuitBreaker(circuit_failure_threshold, circuit_reset_sec)
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+
+        self._token_lock = threading.Lock()
+        self.access_token = None
+        self.refresh_token = None
+        self.expires = None
+
+    def _url(self, endpoint):
+        return urljoin(self.api_base_url, endpoint)
+
+    def _set_token(self, token):
+        self.access_token = token['accessToken']
+        self.refresh_token = token.get('refreshToken')
+        self.expires = _parse_expires(token.get('expires'))
+        if self.expires is None:
+            self.expires = datetime.now(timezone.utc) + RedoxClient.DEFAULT_TOKEN_LIFETIME
+            token['expires'] = self.expires.isoformat()
+
+    def _token_fresh(self):
+        return (self.access_token is not None and self.expires is not None
+                and datetime.now(timezone.utc) + self.refresh_margin < self.expires)
+
+    def _request_token(self):
+        ''' Requests a token from Redox, using the refresh token when available. Returns the token dict or None '''
+        if self.refresh_token:
+            response = self.session.post(self._url(RedoxClient.ENDPOINT_REFRESH),
+                                         json={'apiKey': self.api_key, 'refreshToken': self.refresh_token},
+                                         timeout=self.timeout_sec)
+            token = _parse_token(response)
+            if token is not None:
+                logger.debug('Redox access token refreshed')
+                return token
+            logger.debug(f'Redox token refresh failed ({response.status_code}). Re-authenticating.')
+
+        response = self.session.post(self._url(RedoxClient.ENDPOINT_AUTH),
+                                     json={'apiKey': self.api_key, 'secret': self.client_secret},
+                                     timeout=self.timeout_sec)
+        token = _parse_token(response)
+        if token is not None:
+            logger.debug('Redox authenticated')
+            return token
+
+        logger.error(f'Failed to receive Redox access token. Response: {response.status_code} - {response.text}. ')
+        return None
+
+    def authenticate(self, force=False):
+        '''
+        Makes sure a fresh access token is available, from memory, the token cache, or Redox
+
+        Params
+        ------
+        force: Request a new token from Redox even if the current one is still fresh
+
+        Return
+        ------
+        True if a fresh access token is available
+        '''
+        with self._token_lock:
+            if not force and self._token_fresh():
+                return True
+
+            if not force and self.token_cache is not None:
+                cached = self.token_cache.load(self.api_key)
+                if _valid_token(cached):
+                    self._set_token(cached)
+                    if self._token_fresh():
+                        logger.debug('Using cached Redox access token')
+                        return True
+
+            if force:
+                self.refresh_token = None
+            with METRICS.timer('redox_auth') as t:
+                token = self._request_token()
+                if token is None:
+                    t.fail()
+            if token is None:
+                self.access_token = None
+                return False
+
+            self._set_token(token)
+            if self.token_cache is not None:
+                self.token_cache.save(self.api_key, token)
+            return True
+
+    def post(self, endpoint, data, idempotent=False):
+        '''
+        POSTs JSON data to a Redox endpoint with a fresh access token. If Redox rejects the token (401),
+        re-authenticates once and resends.
+
+        Requests wait for the rate limiter. Failures where the message didn't reach Redox (connection not made,
+        authentication failed, 429, 503 with Retry-After) are retried with jittered exponential backoff, honoring
+        Retry-After. Read timeouts, dropped connections, and other 5xx responses are only retried for idempotent
+        messages (e.g., queries): Redox may have received the message.
+
+        Params
+        ------
+        endpoint: Redox endpoint relative to the base URL
+        data: (str) JSON message
+        idempotent: True if sending the message twice is harmless
+
+        Return
+        ------
+        requests.Response. Other error responses (e.g., 400) are returned for the caller to handle.
+
+        Raises
+        ------
+        RedoxUnavailableError: Redox is unavailable: retries were exhausted or the circuit breaker is open.
+                               The message was not received and can be sent again later.
+        RedoxOutcomeUnknownError: Not idempotent, and the message may have been received by Redox
+        '''
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow():
+                METRICS.inc('redox_retries_total', reason='circuit_open')
+                raise RedoxUnavailableError('Redox requests paused after repeated failures (circuit open)')
+            retry_after = None
+            try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                response = self._post_authenticated(endpoint, data)
+            except RedoxUnavailableError as e:
+                # No access token, so the message wasn't sent
+                self.circuit_breaker.record_failure()
+                reason = 'auth'
+                error = str(e)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.circuit_breaker.record_failure()
+                reason = type(e).__name__
+                error = f'{reason}: {e}'
+                if not idempotent and not _not_sent(e):
+                    METRICS.inc('redox_outcome_unknown_total', reason=reason)
+                    raise RedoxOutcomeUnknownError(f'No response from Redox ({error})') from e
+            except BaseException:
+                # Anything else (e.g., a broken response body) still ends the attempt. Without this, a half-open
+                # circuit would keep waiting for the trial request to finish.
+                self.circuit_breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    self.circuit_breaker.record_success()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.recover()
+                    return response
+
+                reason = str(response.status_code)
+                error = f'{response.status_code} - {response.text}'
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if response.status_code in THROTTLE_STATUS and self.rate_limiter is not None:
+                    self.rate_limiter.throttle(retry_after)
+                if response.status_code == 429:
+                    # Redox is up, just busy
+                    self.circuit_breaker.record_success()
+                else:
+                    self.circuit_breaker.record_failure()
+                # 429, and 503 with Retry-After, mean the message was turned away
+                turned_away = response.status_code == 429 or (response.status_code == 503 and retry_after is not None)
+                if not idempotent and not turned_away:
+                    METRICS.inc('redox_outcome_unknown_total', reason=reason)
+                    raise RedoxOutcomeUnknownError(f'Redox responded {error}')
+
+            if attempt < self.max_retries:
+                delay = max(retry_after or 0, backoff_delay(attempt, self.backoff_base_sec, self.backoff_max_sec))
+                logger.info(f'Redox request failed ({error}). Retrying in {delay:.1f}s '
+                               f'({attempt + 1} of {self.max_retries}).')
+                METRICS.inc('redox_retries_total', reason=reason)
+                time.sleep(delay)
+
+        raise RedoxUnavailableError(f'Redox request failed after {self.max_retries + 1} attempts. Last error: {error}')
+
+    def _post_authenticated(self, endpoint, data):
+        '''
+        One POST, re-authenticating and resending once if Redox rejects the access token (401)
+
+        Raises
+        ------
+        RedoxUnavailableError: No access token could be obtained, so nothing was sent
+        '''
+        response = None
+        for attempt in range(2):
+            try:
+                authenticated = self.authenticate(force=(attempt > 0))
+            except requests.RequestException as e:
+                raise RedoxUnavailableError(f'Unable to authenticate with Redox: {e}') from e
+            if not authenticated:
+                if response is not None:
+                    return response
+                raise RedoxUnavailableError('Unable to authenticate with Redox')
+
+            response = self.session.post(self._url(endpoint),
+                                         headers={
+                                             'Content-Type': 'application/json',
+                                             'Authorization': f'Bearer {self.access_token}'
+                                         },
+                                         data=data,
+                                         timeout=self.timeout_sec)
+            if response.status_code != 401:
+                break
+            logger.warning('Redox rejected the access token. Re-authenticating.')
+
+        return response
+
+    def close(self):
+        self.session.close()
@@ -1,42 +1,95 @@
-from urllib.parse import urljoin
 import requests
+import json
 import logging
-from importlib import resources
+import threading
+import time
 from datetime import datetime
 
-from .model.order_new import Model as OrderNew
-from .model.order_query import Model as OrderQuery
-from .model.order_queryresponse import Model as QueryResponse
-from . import json_templates
+from pydantic import ValidationError
+
+from metrics import METRICS
+
+from .client import RedoxClient
+from .templates import TemplateCache, TemplateSkeleton
 
 SEND_REDOX = False
 
 logger = logging.getLogger(__name__)
 
+# New order template is parsed and validated once per process. Each order gets a copy of only the parts it fills in.
+# The order model (redox.model.order_new) is imported with the first order.
+_new_order_template = TemplateCache('new_order_template.json', 'order_new')
+_NEW_ORDER_WRITABLE = ('Meta', 'Patient.Identifiers.0', 'Patient.Demographics', 'Order.ClinicalInfo')
+# Plain-dict version of the template. put_new_order only validates and fills in the fields below.
+_new_order_skeleton = TemplateSkeleton(_new_order_template, {
+    'Meta': ('EventDateTime', 'Test'),
+    'Patient.Identifiers.0': ('ID',),
+    'Patient.Demographics': ('FirstName', 'LastName', 'DOB', 'Sex', 'Race'),
+    'Order': ('ID', 'TransactionDateTime'),
+}, lists=['Order.ClinicalInfo'])
+
+# Order Query template. The query and response models (redox.model.order_query, order_queryresponse) are imported
+# with the first query.
+_order_query_template = TemplateCache('query_order_template.json', 'order_query')
+
+# Serializes interactive confirmation prompts when orders are placed from multiple threads
+_prompt_lock = threading.Lock()
+
+
+def _redox_datetime(dt):
+    ''' ISO 8601 in UTC with milliseconds, e.g., 2022-07-01T12:00:00.123Z '''
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f'{dt.microsecond // 1000:03d}Z'
+
+
 class RedoxInvitaeAPI:
     ENDPOINT_AUTH = 'auth/authenticate'
     ENDPOINT_ENDPOINT = 'endpoint'
 
-    def __init__(self, api_base_url, api_key, client_secret):
+    def __init__(self, api_base_url, api_key, client_secret, client=None, archive=None, destinations=None,
+                 facility_code=None, **client_options):
+        '''
+        Params
+        ------
+        api_base_url: Redox API base URL
+        api_key: Redox API key
+        client_secret: Redox API secret
+        client: [Optional] RedoxClient to share a connection pool and access token with other APIs
+        archive: [Optional] order_archive.OrderArchive. Dry run: new orders are written to the archive instead of
+                 being logged and sent to Redox
+        destinations: [Optional] Redox destinations of the messages (list of dicts with ID and Name), e.g., for
+                      each site. Defaults to Meta.Destinations of the templates
+        facility_code: [Optional] Meta.FacilityCode of new orders. Defaults to the new order template's
+        client_options: [Optional] Options passed to RedoxClient when client is not provided 
+                        (e.g., pool_maxsize, refresh_margin_sec, token_cache_path)
+        '''
         self.api_base_url = api_base_url
         self.api_key = api_key
         self.client_secret = client_secret
+        self.archive = archive
+        # Meta fields that replace the templates'
+        self._meta = dict()
+        if destinations:
+            self._meta['Destinations'] = [{'ID': d['ID'], 'Name': d['Name']} for d in destinations]
+        if facility_code:
+            self._meta['FacilityCode'] = facility_code
+        if client is None:
+            client = RedoxClient(api_base_url, api_key, client_secret, **client_options)
+        self.client = client
+
+    @property
+    def access_token(self):
+        return self.client.access_token
+
+    @property
+    def available(self):
+        ''' False while requests to Redox are paused after repeated failures (see CircuitBreaker) '''
+        return not self.client.circuit_breaker.is_open
 
     def authenticate(self):
-        url = urljoin(self.api_base_url, RedoxInvitaeAPI.ENDPOINT_AUTH)
-        query = {
-            "apiKey": self.api_key,
-            "secret": self.client_secret
-        }
-        response = requests.post(url, json=query)
-
-        if response.status_code == 200:
-            logger.debug('Redox authenticated')
-            response_json = response.json()
-            self.access_token = response_json['accessToken']
-            return True
-        else:
-            logger.error(f'Failed to receive Redox access token. Response: {response.status_code} - {response.text}. ')
+        try:
+            return self.client.authenticate()
+        except requests.RequestException as e:
+            logger.error(f'Failed to receive Redox access token: {e}')
             return False
 
     def put_new_order(self,
@@ -46,54 +99,49 @@ class RedoxInvitaeAPI:
                       prim_ind, is_ind_aff, pat_hist,
                       has_fam_hist, fam_hist,
                       test=False):
+        '''
+        Builds a new order message and sends it to Redox (when SEND_REDOX is True). In a dry run (archive set),
+        the message is written to the archive instead.
+
+        Return
+        ------
+        (True, JSON message) if the order was sent, or (False, error message) if Redox rejected it or the order
+        information is invalid
+
+        Raises
+        ------
+        RedoxUnavailableError: Redox could not be reached or kept responding with temporary errors.
+                               The order was not placed and can be retried later.
+        RedoxOutcomeUnknownError: The order was sent, but Redox didn't confirm it (e.g., read timeout or 5xx).
+                                  It may have been placed, so it must not be sent again until checked.
+        '''
         logger.info(f'New order: {patient_id}')
+        build_start = time.perf_counter()
 
-        template = resources.read_text(json_templates, 'new_order_template.json')
-        message = OrderNew.parse_raw(template)
-        
         # Invitae expects microseconds expressed to 3 digits
-        datetime_iso = datetime.utcnow().isoformat()[:-3] + 'Z'
-
-        # Fill in Meta
-        message.Meta.EventDateTime = datetime_iso
-        message.Meta.Test = test
-
-        # Fill in Patient
-        patient = message.Patient
-        patient.Identifiers[0].ID = patient_id
-        demogs = patient.Demographics
-        demogs.FirstName = patient_name_first
-        demogs.LastName = patient_name_last
-        demogs.DOB = patient_dob
-        demogs.Sex = patient_sex
-        demogs.Race = patient_redox_race
-
-        # Fill in Order
-        order = message.Order
-        order.ID = order_id
-        order.TransactionDateTime = datetime_iso
-
-        # Fill in ClinicalInfo
-        clinical_info = order.ClinicalInfo
-        # primary indication
-        clinical_info.append({
-            "Code": "prim_ind",
-            "Description": "Primary Indication",
-            "Value": prim_ind
-        })
-        # individual affected or symptomatic
-        clinical_info.append({
-            "Code": "is_ind_aff",
-            "Description": "Is the patient affected or symptomatic?",
-            "Value": is_ind_aff
-        })
+        datetime_iso = _redox_datetime(datetime.utcnow())
+
+        clinical_info = [
+            # primary indication
+            {
+                "Code": "prim_ind",
+                "Description": "Primary Indication",
+                "Value": prim_ind
+            },
+            # individual affected or symptomatic
+            {
+                "Code": "is_ind_aff",
+                "Description": "Is the patient affected or symptomatic?",
+                "Value": is_ind_aff
+            }
+        ]
         # patient history
         if pat_hist:
             clinical_info.append({
                 "Code": "pat_hist",
                 "Description": "Describe patient history, incl. age of diagnosis",
                 "Value": pat_hist
-           })
+            })
         # has family history
         clinical_info.append({
             "Code": "has_fam_hist",
@@ -106,33 +154,61 @@ class RedoxInvitaeAPI:
                 "Code": "fam_hist",
                 "Description": "Describe family history, incl. age(s) of diagnosis",
                 "Value": fam_hist
-           })
+            })
         # patient ancestry
         if patient_invitae_ancestry:
             clinical_info.append({
                 "Code": "pat_anc",
                 "Description": "Patient Ancestry",
                 "Value": '|'.join(patient_invitae_ancestry)
-           })
+            })
+
+        # Fill in the validated template. Only the values filled in here are validated.
+        try:
+            message = _new_order_skeleton.build({
+                'Meta': {'EventDateTime': datetime_iso, 'Test': test},
+                'Patient.Identifiers.0': {'ID': patient_id},
+                'Patient.Demographics': {'FirstName': patient_name_first, 'LastName': patient_name_last,
+                                         'DOB': patient_dob, 'Sex': patient_sex, 'Race': patient_redox_race},
+                'Order': {'ID': order_id, 'TransactionDateTime': datetime_iso},
+            }, items={'Order.ClinicalInfo': clinical_info})
+        except ValidationError as e:
+            error_msg = f'New order not sent for ID {patient_id}. Invalid order information: {e}'
+            logger.error(error_msg)
+            return False, error_msg
 
-        # Create the JSON message        
-        j = message.json(exclude_unset=True)
+        if self._meta:
+            # Meta is a copy for this message (see TemplateSkeleton.build)
+            message['Meta'].update(self._meta)
+        # Create the JSON message (same output as the model's json(exclude_unset=True)). The standard library encoder
+        # is used because faster encoders such as orjson only write compact separators, so messages would no longer
+        # be byte-identical. Encoding takes tens of microseconds, next to the Redox round trip.
+        j = json.dumps(message)
+        METRICS.record('redox_build', time.perf_counter() - build_start)
+        if self.archive is not None:
+            # Dry run. The message is only kept in the archive, not in the logs.
+            self.archive.write(order_id, patient_id, j)
+            return True, j
         logger.debug(j)
 
         if SEND_REDOX:
             send_it = True
             if test:
                 # In test mode, confirm that order should be sent
-                send_it = input(f'Send order for {patient_name_first} {patient_name_last}? Enter "yes" to continue: ') == 'yes'
+                with _prompt_lock:
+                    send_it = input(f'Send order for {patient_name_first} {patient_name_last}? Enter "yes" to continue: ') == 'yes'
             if send_it:
                 # Send new order        
-                url = urljoin(self.api_base_url, RedoxInvitaeAPI.ENDPOINT_ENDPOINT)
-                response = requests.post(url,
-                                        headers={
-                                            'Content-Type': 'application/json',
-                                            'Authorization': f'Bearer {self.access_token}'
-                                        },
-                                        data=j)
+                with METRICS.timer('redox_post') as t:
+                    try:
+                        response = self.client.post(RedoxInvitaeAPI.ENDPOINT_ENDPOINT, data=j)
+                    except requests.RequestException as e:
+                        t.fail()
+                        error_msg = f'New order unsuccessful for ID {patient_id}. Request error: {e}'
+                        logger.error(error_msg)
+                        return False, error_msg
+                    if response.status_code != 200:
+                        t.fail()
 
                 if response.status_code == 200:
                     response_json = response.json()
@@ -152,45 +228,87 @@ class RedoxInvitaeAPI:
             # Pretend successfully sent order
             return True, j
 
+    def query_orders(self, orders, start=None, end=None, test=False):
+        '''
+        Asks Redox about many orders with one Order Query message
+
+        Params
+        ------
+        orders: List of (patient ID, order ID). Order ID can be None to ask about all orders of the patient.
+        start, end: [Optional] datetime (UTC) range of the orders asked about (StartDateTime, EndDateTime)
+        test: Mark the query as a test message
+
+        Return
+        ------
+        List of orders in the response (redox.model.order_queryresponse.Order), or None if the query failed.
+        When SEND_REDOX is False or in a dry run, nothing is sent and the list is empty.
+
+        Raises
+        ------
+        RedoxUnavailableError: Redox could not be reached or kept responding with temporary errors
+        '''
+        # Fill in the query template and validate it with the Order Query model
+        query = _order_query_template.prototype().dict(exclude_unset=True)
+        query['Meta']['EventDateTime'] = _redox_datetime(datetime.utcnow())
+        query['Meta']['Test'] = test
+        if 'Destinations' in self._meta:
+            query['Meta']['Destinations'] = self._meta['Destinations']
+        identifier = query['Patients'][0]['Identifiers'][0]
+        patient_ids = list(dict.fromkeys(patient_id for patient_id, _ in orders))
+        query['Patients'] = [{'Identifiers': [dict(identifier, ID=patient_id)]} for patient_id in patient_ids]
+        order_ids = [order_id for _, order_id in orders if order_id]
+        if order_ids:
+            query['OrderIDs'] = order_ids
+        if start is not None:
+            query['StartDateTime'] = _redox_datetime(start)
+        if end is not None:
+            query['EndDateTime'] = _redox_datetime(end)
+        try:
+            j = _order_query_template.model.parse_obj(query).json(exclude_unset=True)
+        except ValidationError as e:
+            logger.error(f'Order query not sent. Invalid query: {e}')
+            return None
+        logger.debug(f'Order query for {len(patient_ids)} patients, {len(order_ids)} orders')
+
+        if not SEND_REDOX or self.archive is not None:
+            logger.debug('SEND_REDOX set to False, order query was not sent to Redox')
+            return []
+
+        with METRICS.timer('redox_query') as t:
+            try:
+                # Asking again is harmless, so timeouts and 5xx responses are retried
+                response = self.client.post(RedoxInvitaeAPI.ENDPOINT_ENDPOINT, data=j, idempotent=True)
+            except requests.RequestException as e:
+                t.fail()
+                logger.error(f'Order query unsuccessful. Request error: {e}')
+                return None
+            if response.status_code != 200:
+                t.fail()
+                logger.error(f'Order query unsuccessful. Response: {response.status_code} - {response.text}')
+                return None
+
+        # The order models are large, so they are only imported when orders are queried
+        from .model.order_queryresponse import Model as OrderQueryResponse
+        try:
+            response_json = response.json()
+            if RedoxInvitaeAPI.check_response(response_json):
+                logger.error('Order query unsuccessful.')
+                return None
+            return OrderQueryResponse.parse_obj(response_json).Orders or []
+        except (ValueError, ValidationError) as e:
+            logger.error(f'Order query unsuccessful. Unexpected response: {e}')
+            return None
+
     def query_order(self, patient_id):
-        # logger.info(f'Query order: {patient_id}')
-
-        # # TODO: determine what information is required for Order Query
-        # template = resources.read_text(json_templates, 'query_order_template.json')
-        # order = OrderQuery.parse_raw(template)
-        # order.Patients[0].Identifiers[0].ID = patient_id  # put order for new patients.
-
-        # # Send order query
-        # url = urljoin(self.api_base_url, RedoxInvitaeAPI.ENDPOINT_ENDPOINT)
-        # j = order.json(exclude_unset=True)
-        # logger.debug(json.dumps(j))
-        # if SEND_REDOX:
-        #     response = requests.post(url,
-        #                             headers={
-        #                                 'Content-Type': 'application/json',
-        #                                 'Authorization': f'Bearer {self.access_token}'
-        #                             },
-        #                             data=j)
-
-        #     # TODO: need to find out what's in the returned data
-        #     if response.status_code == 200:
-        #         response_json = response.json()
-        #         if RedoxInvitaeAPI.check_response(response_json):
-        #             logger.error(f'Query order unsuccessful for ID {patient_id}.')
-        #             return None
-        #         else:
-        #             logger.info(f'Query order successful for ID {patient_id}')
-        #             return response_json
-        #     else:
-        #         logger.error(f'Query order unsuccessful for ID {patient_id}. Response: {response.status_code} - {response.text}')
-        #         return None
-        # else:
-        #     logger.debug('In development mode, order query was not sent to Redox')
-        #     # Pretend successfully queried order
-        #     return dict()
-
-        # Invitae doesn't currently support this. Leaving the above code there in case it's implemented in future.
-        raise NotImplementedError
+        '''
+        Asks Redox about all orders of one patient. See query_orders
+
+        Return
+        ------
+        List of orders in the response, or None if the query failed
+        '''
+        logger.info(f'Query order: {patient_id}')
+        return self.query_orders([(patient_id, None)])
 
     @staticmethod
     def check_response(response):
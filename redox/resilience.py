@@ -0,0 +1,178 @@
+''' Rate limiting, retry backoff, and circuit breaking for Redox requests '''
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Responses worth retrying: throttling and temporary server-side problems
+RETRYABLE_STATUS = frozenset([429, 500, 502, 503, 504])
+# Responses that mean Redox wants clients to slow down
+THROTTLE_STATUS = frozenset([429, 503])
+
+
+class RedoxUnavailableError(Exception):
+    ''' Redox could not be reached or kept responding with temporary errors. Safe to retry later. '''
+
+
+class RedoxOutcomeUnknownError(Exception):
+    ''' A message may have reached Redox, but no usable response came back (e.g., read timeout or 5xx). Resending a
+    new order could place it twice, so check whether Invitae received it first. '''
+
+
+def parse_retry_after(value):
+    '''
+    Params
+    ------
+    value: Retry-After header value, either seconds or an HTTP date
+
+    Return
+    ------
+    Seconds to wait, or None if value is missing or can't be parsed
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, base_sec=1.0, max_sec=60.0, rng=random):
+    ''' Exponential backoff with full jitter: random delay up to base_sec * 2^attempt, capped at max_sec '''
+    return rng.uniform(0, min(max_sec, base_sec * (2 ** attempt)))
+
+
+class TokenBucket:
+    ''' Client-side rate limiter shared by all threads sending to Redox
+
+    Allows rate requests per second on average, with bursts of up to capacity requests. When Redox throttles
+    (429/503), the rate is halved (down to min_rate) and, if Redox sent Retry-After, no requests are let through
+    until then. Each successful request raises the rate back toward the configured rate.
+    '''
+    def __init__(self, rate, capacity=None, min_rate=None):
+        '''
+        Params
+        ------
+        rate: Configured requests per second
+        capacity: Max burst size. Defaults to rate (at least 1)
+        min_rate: Lowest rate after throttling. Defaults to 5% of rate
+        '''
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = min_rate if min_rate is not None else self.max_rate * 0.05
+        self.capacity = float(capacity) if capacity else max(1.0, self.max_rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        ''' Waits until a request may be sent '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, retry_after_sec=None):
+        ''' Slows down after a throttling response '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            if retry_after_sec:
+                self._blocked_until = max(self._blocked_until, now + retry_after_sec)
+        logger.warning(f'Redox is throttling requests. Rate limit lowered to {self.rate:.2f}/s'
+                       + (f', pausing {retry_after_sec:.1f}s' if retry_after_sec else ''))
+
+    def recover(self):
+        ''' Speeds back up after a successful request '''
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class CircuitBreaker:
+    ''' Stops sending to Redox during an outage
+
+    After failure_threshold consecutive failures the circuit opens and requests are refused right away. After
+    reset_timeout_sec, one trial request is let through (half open): success closes the circuit, failure opens it
+    again for another reset_timeout_sec.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout_sec=60):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout_sec = reset_timeout_sec
+        self.state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        ''' True while requests are being refused '''
+        with self._lock:
+            return (self.state == CircuitBreaker.OPEN
+                    and time.monotonic() - self._opened_at < self.reset_timeout_sec)
+
+    def allow(self):
+        ''' True if a request may be sent now '''
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout_sec:
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self._trial_in_flight = False
+            # Half open: one trial request at a time
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info('Redox is responding again. Circuit closed.')
+            self.state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.state == CircuitBreaker.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logger.error(f'Redox failed {self._failures} times in a row. Pausing requests for '
+                                 f'{self.reset_timeout_sec}s.')
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
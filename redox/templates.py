@@ -0,0 +1,299 @@
+import functools
+import importlib
+import logging
+import os
+import threading
+from importlib import resources
+
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.fields import SHAPE_SINGLETON
+
+from . import json_templates
+
+logger = logging.getLogger(__name__)
+
+
+def _shallow_copy(value):
+    ''' Copies a model or list one level deep, without re-validation. Anything else is immutable and returned as is '''
+    if isinstance(value, BaseModel):
+        copy = value.__class__.__new__(value.__class__)
+        object.__setattr__(copy, '__dict__', dict(value.__dict__))
+        object.__setattr__(copy, '__fields_set__', set(value.__fields_set__))
+        return copy
+    elif isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _deep_copy(value):
+    ''' Copies a validated model tree without re-validation. Much faster than BaseModel.copy(deep=True) '''
+    if isinstance(value, BaseModel):
+        copy = value.__class__.__new__(value.__class__)
+        object.__setattr__(copy, '__dict__', {k: _deep_copy(v) for k, v in value.__dict__.items()})
+        object.__setattr__(copy, '__fields_set__', set(value.__fields_set__))
+        return copy
+    elif isinstance(value, list):
+        return [_deep_copy(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _deep_copy(v) for k, v in value.items()}
+    return value
+
+
+class TemplateCache:
+    ''' Loads and validates a JSON message template once, then hands out copies for individual messages.
+
+    The template file is re-read only when its modification time changes, so edits to the template
+    (e.g., Meta.Destinations) are still picked up by long-running processes.
+    '''
+    def __init__(self, filename, model):
+        '''
+        Params
+        ------
+        filename: Name of the template file in redox/json_templates
+        model: pydantic model class used to parse and validate the template, or the name of the module in
+               redox.model defining it as Model. Model modules are large, so they are imported on first use.
+        '''
+        self.filename = filename
+        self._model = model
+        self._lock = threading.Lock()
+        self._prototype = None
+        self._mtime = None
+        self._path = None
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            self._model = importlib.import_module(f'{__package__}.model.{self._model}').Model
+        return self._model
+
+    def _template_mtime(self):
+        if self._path is None:
+            self._path = resources.files(json_templates).joinpath(self.filename)
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except (OSError, TypeError):
+            # Template isn't a regular file (e.g., packaged in a zip). It can't change while running.
+            return None
+
+    def prototype(self):
+        '''
+        Return
+        ------
+        The validated template, shared by all callers. Must not be modified. Use new() for a modifiable copy.
+        '''
+        mtime = self._template_mtime()
+        with self._lock:
+            if self._prototype is None or mtime != self._mtime:
+                if self._prototype is not None:
+                    logger.info(f'{self.filename} changed. Reloading template.')
+                template = resources.files(json_templates).joinpath(self.filename).read_text()
+                self._prototype = self.model.parse_raw(template)
+                self._mtime = mtime
+            return self._prototype
+
+    def new(self, *writable):
+        '''
+        Creates a copy of the validated template for a single message.
+
+        Params
+        ------
+        writable: [Optional] Dotted paths to the parts of the message that will be modified,
+                  e.g., 'Patient.Demographics', 'Patient.Identifiers.0', 'Order.ClinicalInfo'.
+                  Only the models and lists along these paths are copied (copy-on-write). Everything
+                  else is shared with the template and must not be modified.
+                  If no paths are given, the whole template is copied.
+
+        Return
+        ------
+        A copy of the validated template
+        '''
+        prototype = self.prototype()
+        if not writable:
+            return _deep_copy(prototype)
+
+        message = _shallow_copy(prototype)
+        copied = {id(message)}
+        for path in writable:
+            parent = message
+            for name in path.split('.'):
+                if isinstance(parent, list):
+                    key = int(name)
+                    child = parent[key]
+                else:
+                    key = name
+                    child = parent.__dict__[name]
+
+                if id(child) not in copied and isinstance(child, (BaseModel, list)):
+                    child = _shallow_copy(child)
+                    copied.add(id(child))
+                    if isinstance(parent, list):
+                        parent[key] = child
+                    else:
+                        parent.__dict__[key] = child
+                parent = child
+
+        return message
+
+
+
+def _get_path(value, path):
+    for name in path.split('.') if path else []:
+        if isinstance(value, list):
+            value = value[int(name)]
+        elif isinstance(value, dict):
+            value = value[name]
+        else:
+            value = getattr(value, name)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _simple_fields(model):
+    '''
+    Return
+    ------
+    Dict of field name: type for fields of model whose validation doesn't change a value of exactly that type
+    (plain str, bool, int, and float fields without custom validators or string constraints)
+    '''
+    config = model.__config__
+    if (config.anystr_strip_whitespace or config.anystr_lower or getattr(config, 'anystr_upper', False)
+            or config.min_anystr_length or config.max_anystr_length is not None):
+        return dict()
+    return {name: field.type_ for name, field in model.__fields__.items()
+            if field.type_ in (str, bool, int, float) and field.shape == SHAPE_SINGLETON and not field.sub_fields
+            and not field.class_validators and not field.pre_validators and not field.post_validators}
+
+
+def validate_fields(model, values):
+    '''
+    Validates values for some of the fields of a pydantic model, with the fields' own validators
+
+    Params
+    ------
+    model: pydantic model class
+    values: Dict of field name: value
+
+    Return
+    ------
+    Dict of validated (possibly converted) values
+
+    Raises
+    ------
+    pydantic.ValidationError if any value is invalid or isn't a field of model
+    '''
+    simple = _simple_fields(model)
+    validated = dict()
+    errors = []
+    for name, value in values.items():
+        if simple.get(name) is type(value):
+            # Already of the field's type, which its validator would return unchanged
+            validated[name] = value
+            continue
+        field = model.__fields__.get(name)
+        if field is None:
+            errors.append(ErrorWrapper(ValueError(f'not a field of {model.__name__}'), loc=name))
+            continue
+        value, error = field.validate(value, validated, loc=name, cls=model)
+        if error:
+            errors.append(error)
+        validated[name] = value
+    if errors:
+        raise ValidationError(errors, model)
+    return validated
+
+
+class TemplateSkeleton:
+    ''' Plain-dict copy of a validated template, for building messages without creating pydantic models
+
+    The template is parsed and validated once by a TemplateCache. For each message, only the variable fields are
+    filled in, and only those values are validated, with the model fields' own validators. As with
+    BaseModel.json(exclude_unset=True), keys are in model field order and only fields set in the template or
+    filled in are included, so json.dumps of the message is byte-identical to the model's JSON.
+    '''
+    def __init__(self, template_cache, variable, lists=()):
+        '''
+        Params
+        ------
+        template_cache: TemplateCache of the template
+        variable: Dict of dotted path to a model in the template (e.g., 'Patient.Demographics'): names of the
+                  fields filled in for each message
+        lists: Dotted paths of list fields that items are appended to for each message, e.g., 'Order.ClinicalInfo'
+        '''
+        self.template_cache = template_cache
+        self.variable = {path: tuple(names) for path, names in variable.items()}
+        self.lists = tuple(lists)
+        self._lock = threading.Lock()
+        self._prototype = None
+        self._state = None
+
+    def _build(self, prototype):
+        skeleton = prototype.dict(exclude_unset=True)
+        # Models of the variable paths and of the list items
+        models = dict()
+        # Field names of each container with variable fields, in model order
+        key_order = dict()
+        fields = {path: set(names) for path, names in self.variable.items()}
+        for path in self.lists:
+            parent_path, _, name = path.rpartition('.')
+            fields.setdefault(parent_path, set()).add(name)
+            # Item model, e.g., ClinicalInfoItem for List[ClinicalInfoItem]
+            models[path] = _get_path(prototype, parent_path).__fields__[name].type_
+        for path, names in fields.items():
+            model = _get_path(prototype, path).__class__
+            static = _get_path(skeleton, path)
+            models.setdefault(path, model)
+            key_order[path] = tuple(name for name in model.__fields__ if name in static or name in names)
+        return skeleton, models, key_order
+
+    def build(self, values, items=None):
+        '''
+        Params
+        ------
+        values: Dict of path in variable: dict of field name: value
+        items: [Optional] Dict of path in lists: list of dicts appended to the list. Each item is validated
+               against the list's item model, and its keys are kept in the order given.
+
+        Return
+        ------
+        Message as nested dicts and lists. Parts that weren't filled in are shared with the skeleton, so the
+        message must not be modified.
+
+        Raises
+        ------
+        pydantic.ValidationError if a value is invalid
+        '''
+        prototype = self.template_cache.prototype()
+        with self._lock:
+            if prototype is not self._prototype:
+                # First message, or the template file changed
+                self._state = self._build(prototype)
+                self._prototype = prototype
+            skeleton, models, key_order = self._state
+
+        updates = {path: validate_fields(models[path], path_values) for path, path_values in values.items()}
+        for path, path_items in (items or dict()).items():
+            parent_path, _, name = path.rpartition('.')
+            static = _get_path(skeleton, parent_path).get(name) or []
+            update = updates.setdefault(parent_path, dict())
+            update[name] = list(static) + [validate_fields(models[path], item) for item in path_items]
+
+        # Copy-on-write: copy only the containers along the updated paths
+        message = dict(skeleton)
+        copied = {id(message)}
+        for path in sorted(updates, key=len):
+            parent = message
+            for name in path.split('.') if path else []:
+                key = int(name) if isinstance(parent, list) else name
+                child = parent[key]
+                if id(child) not in copied:
+                    child = list(child) if isinstance(child, list) else dict(child)
+                    copied.add(id(child))
+                    parent[key] = child
+                parent = child
+            update = updates[path]
+            ordered = {name: update[name] if name in update else parent[name]
+                       for name in key_order[path] if name in update or name in parent}
+            parent.clear()
+            parent.update(ordered)
+        return message
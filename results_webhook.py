@@ -0,0 +1,382 @@
+''' Receiver for Order and Results messages pushed by Redox
+
+Invitae doesn't answer order status queries, but Redox can push Order and Results messages to a destination URL.
+The receiver validates each message against the Order Query response model (redox.model.order_queryresponse), keeps
+only the order IDs and statuses in a durable SQLite queue, and answers right away. A ResultsReconciler applies the
+queued status changes to REDCap in batches: messages arriving close together are combined, each order's latest
+status wins, and all changes are imported with one REDCap import per batch.
+
+Redox verifies a destination by POSTing {"verification-token": ..., "challenge": ...}. The receiver answers with the
+challenge when the token matches. Later messages carry the token in the verification-token header, and messages
+without it are rejected.
+'''
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+
+from redcap_invitae import Redcap
+from order_status import map_redox_order_status
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsQueue:
+    ''' Durable queue of order status messages, kept in SQLite until they have been applied to REDCap. Thread-safe. '''
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            received_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        );
+    '''
+
+    def __init__(self, path=None, max_attempts=5):
+        '''
+        Params
+        ------
+        path: [Optional] SQLite file. If None, messages are only kept in memory and are lost if the process stops.
+        max_attempts: Messages whose REDCap update failed this many times are set aside (see failed)
+        '''
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path if path else ':memory:', check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(ResultsQueue._SCHEMA)
+
+    def put(self, message):
+        '''
+        Params
+        ------
+        message: Dict with DataModel, EventType, and Orders (list of dicts with ID and Status)
+        '''
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO messages (message, received_at) VALUES (?, ?)',
+                               (json.dumps(message), datetime.now().isoformat(timespec='seconds')))
+
+    def peek(self, limit):
+        '''
+        Return
+        ------
+        List of up to limit (sequence number, message) of the oldest queued messages. They stay queued until ack.
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT seq, message FROM messages WHERE failed = 0 ORDER BY seq LIMIT ?',
+                                      (limit,)).fetchall()
+        return [(seq, json.loads(message)) for seq, message in rows]
+
+    def ack(self, seqs):
+        ''' Removes applied messages '''
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM messages WHERE seq = ?', [(seq,) for seq in seqs])
+
+    def retry_later(self, seqs):
+        '''
+        Counts a failed attempt to apply the messages. Messages that reached max_attempts are set aside.
+
+        Return
+        ------
+        Number of messages set aside
+        '''
+        with self._lock, self._conn:
+            self._conn.executemany('UPDATE messages SET attempts = attempts + 1 WHERE seq = ?', [(seq,) for seq in seqs])
+            cursor = self._conn.execute('UPDATE messages SET failed = 1 WHERE failed = 0 AND attempts >= ?',
+                                        (self.max_attempts,))
+        return cursor.rowcount
+
+    def failed(self):
+        '''
+        Return
+        ------
+        List of (sequence number, message, time received) of messages set aside after repeated failures
+        '''
+        with self._lock:
+            rows = self._conn.execute('SELECT seq, message, received_at FROM messages WHERE failed = 1 ORDER BY seq'
+                                      ).fetchall()
+        return [(seq, json.loads(message), received_at) for seq, message, received_at in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM messages WHERE failed = 0').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_message(body):
+    '''
+    Validates a message pushed by Redox and keeps only what's needed to update order statuses
+
+    Params
+    ------
+    body: Message (JSON string or bytes). Messages with a single Order are treated like those with a list of Orders.
+
+    Return
+    ------
+    Dict with DataModel, EventType, and Orders (list of dicts with ID and Status)
+
+    Raises
+    ------
+    ValueError: The message isn't valid JSON, doesn't match the model, or has no orders with IDs
+    '''
+    # The order models (and pydantic) are large, so they are only imported when the first message is received
+    from pydantic import ValidationError
+    from redox.model.order_queryresponse import Model as OrderQueryResponse
+
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError('Message is not a JSON object')
+    if 'Orders' not in data and isinstance(data.get('Order'), dict):
+        data = {'Meta': data.get('Meta'), 'Orders': [data['Order']]}
+    try:
+        message = OrderQueryResponse.parse_obj(data)
+    except ValidationError as e:
+        raise ValueError(f'Message does not match the order model: {e}') from e
+    orders = [{'ID': order.ID, 'Status': order.Status} for order in message.Orders or [] if order.ID]
+    if not orders:
+        raise ValueError('Message has no orders with IDs')
+    return {'DataModel': message.Meta.DataModel, 'EventType': message.Meta.EventType, 'Orders': orders}
+
+
+class WebhookServer:
+    ''' HTTP server receiving messages from Redox and adding them to a ResultsQueue '''
+    def __init__(self, queue, host='127.0.0.1', port=0, verification_token=None, on_message=None):
+        '''
+        Params
+        ------
+        queue: ResultsQueue
+        host, port: Address to listen on. Port 0 picks a free port.
+        verification_token: Verification token of the Redox destination. Messages without it are rejected.
+        on_message: [Optional] Called after a message is queued, e.g., ResultsReconciler.wake
+        '''
+        self.queue = queue
+        self.verification_token = verification_token
+        self.on_message = on_message
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def _token_valid(self, token):
+        if not self.verification_token:
+            return True
+        return hmac.compare_digest((token or '').encode('utf-8'), self.verification_token.encode('utf-8'))
+
+    def handle(self, headers, body):
+        '''
+        Params
+        ------
+        headers: Request headers (mapping with case-insensitive get, e.g., email.message.Message)
+        body: Request body (bytes)
+
+        Return
+        ------
+        (HTTP status code, response body)
+        '''
+        # Destination verification
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and 'challenge' in data and 'Meta' not in data:
+            if not self._token_valid(data.get('verification-token')):
+                METRICS.inc('webhook_messages_total', result='unauthorized')
+                logger.warning('Redox destination verification rejected: wrong verification token')
+                return 403, ''
+            logger.info('Redox destination verified')
+            return 200, str(data['challenge'])
+
+        if not self._token_valid(headers.get('verification-token')):
+            METRICS.inc('webhook_messages_total', result='unauthorized')
+            logger.warning('Redox message rejected: missing or wrong verification token')
+            return 403, ''
+        try:
+            message = parse_message(body)
+        except ValueError as e:
+            METRICS.inc('webhook_messages_total', result='invalid')
+            logger.warning(f'Invalid message from Redox: {e}')
+            return 400, ''
+
+        self.queue.put(message)
+        METRICS.inc('webhook_messages_total', result='queued')
+        logger.debug(f'Queued Redox {message["DataModel"]}.{message["EventType"]} message for '
+                     f'{len(message["Orders"])} orders')
+        if self.on_message is not None:
+            self.on_message()
+        return 200, ''
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        host, port = self.address
+        logger.info(f'Redox results webhook listening on http://{host}:{port}/')
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class ResultsReconciler:
+    ''' Applies queued order status messages to REDCap in batches, in a background thread '''
+    def __init__(self, queue, redcap, batch_size=500, coalesce_sec=5):
+        '''
+        Params
+        ------
+        queue: ResultsQueue
+        redcap: Redcap
+        batch_size: Max messages applied together
+        coalesce_sec: Time to wait after a message arrives for more messages to apply with it
+        '''
+        self.queue = queue
+        self.redcap = redcap
+        self.batch_size = max(1, batch_size)
+        self.coalesce_sec = coalesce_sec
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def apply_batch(self):
+        '''
+        Applies up to batch_size queued messages. For each order, the most advanced status in the batch is written
+        to REDCap, if it's ahead of the order's status in REDCap.
+
+        Return
+        ------
+        Dict with the number of messages applied, status changes written, and messages left for a retry
+        '''
+        batch = self.queue.peek(self.batch_size)
+        if not batch:
+            return {'messages': 0, 'status_changes': 0, 'retry': 0}
+
+        transitions = dict()  # order ID: most advanced status
+        seqs_by_order = dict()  # order ID: messages naming it
+        for seq, message in batch:
+            for order in message['Orders']:
+                seqs_by_order.setdefault(order['ID'], []).append(seq)
+                status = map_redox_order_status(order['Status'])
+                if status is not None and (order['ID'] not in transitions
+                                           or status.value > transitions[order['ID']].value):
+                    transitions[order['ID']] = status
+
+        found = self.redcap.find_orders(transitions)
+        updates = dict()  # record ID: (order ID, update)
+        for order_id, status in transitions.items():
+            if order_id not in found:
+                logger.warning(f'Redox sent a status for order {order_id}, which is not in REDCap')
+                continue
+            record_id, current = found[order_id]
+            # Statuses only move forward
+            if status.value > (current or ''):
+                form_complete = Redcap.FormComplete.COMPLETE if status == Redcap.OrderStatus.COMPLETED else None
+                updates[record_id] = (order_id, Redcap.build_order_status_record(
+                    record_id, order_status=status, form_complete=form_complete))
+
+        results = self.redcap.write_order_status_records([u for _, u in updates.values()]) if updates else dict()
+        failed_orders = set()
+        for record_id, (order_id, update) in updates.items():
+            if results.get(record_id):
+                status = Redcap.OrderStatus(update[Redcap.FIELD_ORDER_STATUS])
+                logger.info(f'Order {order_id} for CUIMC {record_id}: {status.name}')
+                METRICS.inc('order_status_changes_total', status=status.name.lower(), source='webhook')
+            else:
+                failed_orders.add(order_id)
+
+        retry = set(seq for order_id in failed_orders for seq in seqs_by_order[order_id])
+        self.queue.ack([seq for seq, _ in batch if seq not in retry])
+        if retry:
+            n_set_aside = self.queue.retry_later(retry)
+            logger.error(f'Unable to write {len(failed_orders)} order status changes to REDCap. '
+                         f'{len(retry)} messages will be retried.')
+            if n_set_aside:
+                logger.error(f'{n_set_aside} Redox messages set aside after repeated REDCap failures')
+        return {'messages': len(batch) - len(retry), 'status_changes': len(updates) - len(failed_orders),
+                'retry': len(retry)}
+
+    def apply_pending(self):
+        '''
+        Applies all queued messages, batch by batch. Stops at a batch with failures, which are retried later.
+
+        Return
+        ------
+        Dict with the number of messages applied and status changes written
+        '''
+        n_messages = n_changes = 0
+        while True:
+            result = self.apply_batch()
+            n_messages += result['messages']
+            n_changes += result['status_changes']
+            if result['retry'] or result['messages'] < self.batch_size:
+                break
+        return {'messages': n_messages, 'status_changes': n_changes}
+
+    def wake(self):
+        ''' Applies queued messages after coalesce_sec '''
+        self._wake_event.set()
+
+    def _run(self):
+        # Messages left from before a restart
+        self._wake_event.set()
+        while not self._stop_event.is_set():
+            self._wake_event.wait()
+            if self._stop_event.is_set():
+                break
+            # Give related messages a chance to arrive, so they're written to REDCap together
+            if self._stop_event.wait(self.coalesce_sec):
+                break
+            self._wake_event.clear()
+            try:
+                with METRICS.timer('webhook_apply'):
+                    self.apply_pending()
+            except Exception:
+                logger.exception('Unable to apply Redox messages to REDCap. They will be retried.')
+                # Try again after a while rather than waiting for the next message
+                self._stop_event.wait(max(self.coalesce_sec, 30))
+                self._wake_event.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='webhook-apply', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stops the background thread. Queued messages are kept for the next start. '''
+        self._stop_event.set()
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _make_handler(receiver):
+    class Handler(BaseHTTPRequestHandler):
+        MAX_BODY_BYTES = 10 * 1024 * 1024
+
+        def log_message(self, format, *args):
+            logger.debug(f'Results webhook: {self.address_string()} {format % args}')
+
+        def _send(self, status, body):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > Handler.MAX_BODY_BYTES:
+                return self._send(413, '')
+            self._send(*receiver.handle(self.headers, self.rfile.read(length)))
+    return Handler
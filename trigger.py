@@ -0,0 +1,143 @@
+''' Receiver for REDCap Data Entry Trigger requests
+
+REDCap can notify a URL each time a record is saved in a form or survey (Project Setup > Additional customizations >
+Data Entry Trigger). The request is a form-encoded POST with fields including project_id, instrument, and record.
+The receiver queues the record ID so the daemon can check just that record, instead of waiting for the next
+full sweep of the project.
+
+To keep other hosts from queueing records, configure a token and add it to the Data Entry Trigger URL, e.g.,
+https://orders.example.org:8081/?token=<token>
+'''
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class TriggerQueue:
+    ''' Thread-safe queue of record IDs. A record queued again before it is taken is only kept once. '''
+    def __init__(self):
+        self._records = dict()  # Insertion ordered set
+        self._lock = threading.Lock()
+
+    def put(self, record_id):
+        with self._lock:
+            self._records[record_id] = None
+
+    def drain(self):
+        '''
+        Return
+        ------
+        List of all queued record IDs, in the order they were first queued. The queue is emptied.
+        '''
+        with self._lock:
+            records = list(self._records)
+            self._records = dict()
+        return records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+
+class TriggerServer:
+    ''' HTTP server receiving Data Entry Trigger requests and adding their record IDs to a TriggerQueue '''
+    def __init__(self, queue, host='127.0.0.1', port=0, token=None, project_id=None, on_trigger=None):
+        '''
+        Params
+        ------
+        queue: TriggerQueue
+        host, port: Address to listen on. Port 0 picks a free port.
+        token: [Optional] Requests without this token in the URL query (token=...) are rejected
+        project_id: [Optional] Requests for other REDCap projects are ignored
+        on_trigger: [Optional] Called after a record is queued, e.g., OrderDaemon.wake
+        '''
+        self.queue = queue
+        self.token = token
+        self.project_id = str(project_id) if project_id else None
+        self.on_trigger = on_trigger
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def handle(self, query, form):
+        '''
+        Params
+        ------
+        query: Dict of URL query parameters (lists of values)
+        form: Dict of POSTed fields (lists of values)
+
+        Return
+        ------
+        HTTP status code
+        '''
+        if self.token:
+            token = (query.get('token') or [''])[0]
+            if not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+                METRICS.inc('triggers_total', result='unauthorized')
+                logger.warning('Data Entry Trigger request rejected: missing or wrong token')
+                return 403
+
+        record_id = (form.get('record') or [''])[0].strip()
+        if not record_id:
+            METRICS.inc('triggers_total', result='invalid')
+            return 400
+        project_id = (form.get('project_id') or [''])[0]
+        if self.project_id and project_id != self.project_id:
+            METRICS.inc('triggers_total', result='ignored')
+            logger.debug(f'Ignored Data Entry Trigger for project {project_id}')
+            return 200
+
+        self.queue.put(record_id)
+        METRICS.inc('triggers_total', result='queued')
+        logger.debug(f'Data Entry Trigger queued CUIMC {record_id} '
+                     f'(instrument {(form.get("instrument") or [""])[0]})')
+        if self.on_trigger is not None:
+            self.on_trigger()
+        return 200
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='trigger', daemon=True)
+        self._thread.start()
+        host, port = self.address
+        logger.info(f'Data Entry Trigger receiver listening on http://{host}:{port}/')
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _make_handler(receiver):
+    class Handler(BaseHTTPRequestHandler):
+        # Data Entry Trigger requests are small, so anything large is not one
+        MAX_BODY_BYTES = 64 * 1024
+
+        def log_message(self, format, *args):
+            logger.debug(f'Trigger receiver: {self.address_string()} {format % args}')
+
+        def _send(self, status):
+            body = b'' if status == 200 else f'{status}\n'.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > Handler.MAX_BODY_BYTES:
+                return self._send(413)
+            body = self.rfile.read(length).decode('utf-8', errors='replace')
+            query = parse_qs(urlsplit(self.path).query)
+            self._send(receiver.handle(query, parse_qs(body)))
+    return Handler
@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from itertools import chain
+from operator import itemgetter
 import json
 import logging
 
@@ -9,6 +11,77 @@ logger = logging.getLogger(__name__)
 
 CHECKBOX_POSITIVE_VALUES = ['1', 'checked']
 
+# eMERGE race_at_enrollment -> Redox Patient.Demographics.Race
+_REDOX_RACE_MAPPINGS = {
+    'race_at_enrollment___1': 'American Indian or Alaska Native',
+    'race_at_enrollment___2': 'Asian',
+    'race_at_enrollment___3': 'Black or African American',
+    'race_at_enrollment___4': 'Other Race',
+    'race_at_enrollment___5': 'Other Race',
+    'race_at_enrollment___6': 'Native Hawaiian or Other Pacific Islander',
+    'race_at_enrollment___7': 'White',
+    'race_at_enrollment___8': 'Other Race',
+    'race_at_enrollment___9': 'Prefer not to answer',
+}
+_REDOX_RACE_NO_MATCH = 'Unknown'
+_REDOX_RACE_MULTIPLE = 'Other Race'
+
+# eMERGE race_at_enrollment -> Invitae ancestry
+_INVITAE_ANCESTRY_MAPPINGS = {
+    'race_at_enrollment___1': 'Native American',
+    'race_at_enrollment___2': 'Asian',
+    'race_at_enrollment___3': 'Black/African-American',
+    'race_at_enrollment___4': 'Hispanic',
+    # 'race_at_enrollment___5': None,  # No good mapping from "Middle Eastern or North African" to Invitae ancestry options
+    'race_at_enrollment___6': 'Pacific Islander',
+    'race_at_enrollment___7': 'White/Caucasian',
+    'race_at_enrollment___8': 'Other',
+    'race_at_enrollment___9': 'Unknown',        
+}
+_VAR_ASHKENAZI = 'ashkenazi_jewish_ancestors'
+_INVITAE_ASHKENAZI = 'Ashkenazi Jewish'
+
+# Personal health history conditions -> Invitae primary indication, in order of priority
+_PRIMARY_INDICATION_MAPPINGS = OrderedDict([
+    ('prostate_cancer', 'Prostate Cancer'),
+    ('pancreatic_cancer', 'Pancreatic Cancer'),
+    ('breast_cancer', 'Other Cancer'),
+    ('ovarian_cancer', 'Other Cancer'),
+    ('colorectal_cancer', 'Other Cancer'),
+    ('atrial_fibrillation', 'Cardiology: Arrhythmia'),
+    ('coronary_heart_disease', 'Cardiology: Other'),
+    ('heart_failure', 'Cardiology: Other'),
+])
+_PRIMARY_INDICATION_OTHER = 'Other'
+
+# Personal health history conditions -> description for patient history
+_PATIENT_HISTORY_MAPPINGS = {
+    Redcap.FIELD_BPHH_HYPERTENSION: 'hypertension',
+    Redcap.FIELD_BPHH_HYPERLIPID: 'hypercholesterolemia',
+    Redcap.FIELD_BPHH_T1DM: 'type 1 diabetes',
+    Redcap.FIELD_BPHH_T2DM: 'type 2 diabetes',
+    Redcap.FIELD_BPHH_KD: 'weak or failing kidneys or kidney disease',
+    Redcap.FIELD_BPHH_ASTHMA: 'asthma',
+    Redcap.FIELD_BPHH_OBESITY: 'obesity',
+    Redcap.FIELD_BPHH_SLEEPAPNEA: 'sleep apnea',
+    Redcap.FIELD_BPHH_CHD: 'coronary heart disease',
+    Redcap.FIELD_BPHH_HF: 'heart failure',
+    Redcap.FIELD_BPHH_AFIB: 'atrial fibrillation',
+    Redcap.FIELD_BPHH_BRCA: 'breast cancer',
+    Redcap.FIELD_BPHH_OVCA: 'ovarian cancer',
+    Redcap.FIELD_BPHH_PRCA: 'prostate cancer',
+    Redcap.FIELD_BPHH_PACA: 'pancreatic cancer',
+    Redcap.FIELD_BPHH_COCA: 'colorectal cancer'
+}
+
+# Checkbox variables for current (e.g., 'asthma___1') and past (e.g., 'asthma_2___1') conditions
+_CHECKBOX_SUFFIX = '___1'
+_PAST_MODIFIER = '_2'
+_PRIMARY_INDICATION_CHECKBOXES = [(base + _CHECKBOX_SUFFIX, base + _PAST_MODIFIER + _CHECKBOX_SUFFIX, indication)
+                                  for base, indication in _PRIMARY_INDICATION_MAPPINGS.items()]
+_PATIENT_HISTORY_CHECKBOXES = [(base + _CHECKBOX_SUFFIX, base + _PAST_MODIFIER + _CHECKBOX_SUFFIX, description)
+                               for base, description in _PATIENT_HISTORY_MAPPINGS.items()]
+
 
 def convert_emerge_race_to_redox_race(participant_data):
     """ Converts eMERGE race_at_enrollment to Redox Patient.Demographics.race values
@@ -26,22 +99,8 @@ def convert_emerge_race_to_redox_race(participant_data):
     -------
     (String) First matching race. If no match found, return 'Unknown'
     """
-    mappings = {
-        'race_at_enrollment___1': 'American Indian or Alaska Native',
-        'race_at_enrollment___2': 'Asian',
-        'race_at_enrollment___3': 'Black or African American',
-        'race_at_enrollment___4': 'Other Race',
-        'race_at_enrollment___5': 'Other Race',
-        'race_at_enrollment___6': 'Native Hawaiian or Other Pacific Islander',
-        'race_at_enrollment___7': 'White',
-        'race_at_enrollment___8': 'Other Race',
-        'race_at_enrollment___9': 'Prefer not to answer',
-    }
-    no_match_race = 'Unknown'
-    multiple_race = 'Other Race'
-
     redox_races = []
-    for race_variable, redox_race in mappings.items():
+    for race_variable, redox_race in _REDOX_RACE_MAPPINGS.items():
         if race_variable in participant_data:
             race_value = participant_data[race_variable].lower()
             if race_value == '1' or race_value == 'checked':
@@ -49,11 +108,11 @@ def convert_emerge_race_to_redox_race(participant_data):
 
     n_races = len(redox_races)
     if n_races == 0:
-        return no_match_race
+        return _REDOX_RACE_NO_MATCH
     elif n_races == 1:
         return redox_races[0]
     else:
-        return multiple_race
+        return _REDOX_RACE_MULTIPLE
 
 
 def convert_emerge_race_to_invitae_ancestry(participant_data):
@@ -71,32 +130,18 @@ def convert_emerge_race_to_invitae_ancestry(participant_data):
     -------
     List of matching ancestry options
     """
-    race_mappings = {
-        'race_at_enrollment___1': 'Native American',
-        'race_at_enrollment___2': 'Asian',
-        'race_at_enrollment___3': 'Black/African-American',
-        'race_at_enrollment___4': 'Hispanic',
-        # 'race_at_enrollment___5': None,  # No good mapping from "Middle Eastern or North African" to Invitae ancestry options
-        'race_at_enrollment___6': 'Pacific Islander',
-        'race_at_enrollment___7': 'White/Caucasian',
-        'race_at_enrollment___8': 'Other',
-        'race_at_enrollment___9': 'Unknown',        
-    }
-    var_ashkenazi = 'ashkenazi_jewish_ancestors'
-    invitae_ashkenazi = 'Ashkenazi Jewish'
-
     ancestries = []
 
     # R4:race_at_enrollment
-    for race_variable, invitae_ancestry in race_mappings.items():
+    for race_variable, invitae_ancestry in _INVITAE_ANCESTRY_MAPPINGS.items():
         if race_variable in participant_data:
             race_value = participant_data[race_variable].lower()
             if race_value in ('1', 'checked'):
                 ancestries.append(invitae_ancestry)
 
     # R4: ashkenazi_jewish_ancestors
-    if participant_data.get(var_ashkenazi, '').lower() in ('1', 'yes'):
-        ancestries.append(invitae_ashkenazi)
+    if participant_data.get(_VAR_ASHKENAZI, '').lower() in ('1', 'yes'):
+        ancestries.append(_INVITAE_ASHKENAZI)
 
     return ancestries
 
@@ -141,30 +186,17 @@ def get_invitae_primary_indication(record):
     -------
     (String) First relevant primary indication. For healthy participants or no match found, return 'Other'
     """
-    mappings = OrderedDict([
-        ('prostate_cancer', 'Prostate Cancer'),
-        ('pancreatic_cancer', 'Pancreatic Cancer'),
-        ('breast_cancer', 'Other Cancer'),
-        ('ovarian_cancer', 'Other Cancer'),
-        ('colorectal_cancer', 'Other Cancer'),
-        ('atrial_fibrillation', 'Cardiology: Arrhythmia'),
-        ('coronary_heart_disease', 'Cardiology: Other'),
-        ('heart_failure', 'Cardiology: Other'),
-    ])    
-    checkbox_suffix = '___1'
-    past_modifier = '_2'
-    
-    for emerge_variable_base, invitae_indication in mappings.items():
+    for current_variable, past_variable, invitae_indication in _PRIMARY_INDICATION_CHECKBOXES:
         # check if this participant has the condition: 
         # 1) currently 
-        if record[emerge_variable_base + checkbox_suffix].lower() in CHECKBOX_POSITIVE_VALUES:
+        if record[current_variable].lower() in CHECKBOX_POSITIVE_VALUES:
             return invitae_indication
         # 2) past
-        if record[emerge_variable_base + past_modifier + checkbox_suffix].lower() in CHECKBOX_POSITIVE_VALUES:
+        if record[past_variable].lower() in CHECKBOX_POSITIVE_VALUES:
             return invitae_indication
         
     # Use 'Other' for all other scenarios
-    return 'Other'
+    return _PRIMARY_INDICATION_OTHER
 
 
 def describe_patient_history(record):
@@ -182,38 +214,21 @@ def describe_patient_history(record):
     -------
     (String) Written description of current and past conditions.
     """
-    mappings = {
-        Redcap.FIELD_BPHH_HYPERTENSION: 'hypertension',
-        Redcap.FIELD_BPHH_HYPERLIPID: 'hypercholesterolemia',
-        Redcap.FIELD_BPHH_T1DM: 'type 1 diabetes',
-        Redcap.FIELD_BPHH_T2DM: 'type 2 diabetes',
-        Redcap.FIELD_BPHH_KD: 'weak or failing kidneys or kidney disease',
-        Redcap.FIELD_BPHH_ASTHMA: 'asthma',
-        Redcap.FIELD_BPHH_OBESITY: 'obesity',
-        Redcap.FIELD_BPHH_SLEEPAPNEA: 'sleep apnea',
-        Redcap.FIELD_BPHH_CHD: 'coronary heart disease',
-        Redcap.FIELD_BPHH_HF: 'heart failure',
-        Redcap.FIELD_BPHH_AFIB: 'atrial fibrillation',
-        Redcap.FIELD_BPHH_BRCA: 'breast cancer',
-        Redcap.FIELD_BPHH_OVCA: 'ovarian cancer',
-        Redcap.FIELD_BPHH_PRCA: 'prostate cancer',
-        Redcap.FIELD_BPHH_PACA: 'pancreatic cancer',
-        Redcap.FIELD_BPHH_COCA: 'colorectal cancer'
-    }
-    checkbox_suffix = '___1'
-    past_modifier = '_2'
-    
     current_conditions = list()
     past_conditions = list()
-    for emerge_variable_base, description in mappings.items():
+    for current_variable, past_variable, description in _PATIENT_HISTORY_CHECKBOXES:
         # check if this participant has the condition: 
         # 1) currently 
-        if record[emerge_variable_base + checkbox_suffix].lower() in CHECKBOX_POSITIVE_VALUES:
+        if record[current_variable].lower() in CHECKBOX_POSITIVE_VALUES:
             current_conditions.append(description)
         # 2) past
-        if record[emerge_variable_base + past_modifier + checkbox_suffix].lower() in CHECKBOX_POSITIVE_VALUES:
+        if record[past_variable].lower() in CHECKBOX_POSITIVE_VALUES:
             past_conditions.append(description)
         
+    return _format_patient_history(current_conditions, past_conditions)
+
+
+def _format_patient_history(current_conditions, past_conditions):
     condition_strings = list()
     if current_conditions:
         condition_strings.append(f"Current conditions: {', '.join(current_conditions)}.")
@@ -222,6 +237,120 @@ def describe_patient_history(record):
     return ' '.join(condition_strings)
 
 
+class _PositiveValueLookup(dict):
+    """ Maps checkbox values to True if positive. Each distinct value is only lower-cased and checked once """
+    def __init__(self, positive_values):
+        super().__init__()
+        self.positive_values = positive_values
+
+    def __missing__(self, value):
+        positive = self[value] = value.lower() in self.positive_values
+        return positive
+
+
+def _checkbox_matrix(records, variables, positive_values, missing=None):
+    """ Loads checkbox variables for all records into a boolean matrix (records x variables)
+
+    Values are compared case-insensitively with positive_values. If missing is None, every record must have 
+    every variable (KeyError otherwise). Otherwise, missing variables are treated as having the value missing.
+    """
+    import numpy as np
+    n, k = len(records), len(variables)
+    if n == 0:
+        return np.zeros((n, k), dtype=bool)
+
+    getter = itemgetter(*variables) if k > 1 else (lambda r: (r[variables[0]],))
+    try:
+        rows = list(map(getter, records))
+    except KeyError:
+        if missing is None:
+            raise
+        rows = [tuple(r.get(v, missing) for v in variables) for r in records]
+
+    lookup = _PositiveValueLookup(positive_values)
+    values = np.fromiter(map(lookup.__getitem__, chain.from_iterable(rows)), dtype=bool, count=n * k)
+    return values.reshape(n, k)
+
+
+def _unique_rows(matrix):
+    """ Groups identical rows of a boolean matrix (up to 64 columns)
+
+    Returns
+    -------
+    tuple: (boolean matrix of the unique rows, list with the index of each original row's unique row)
+    """
+    import numpy as np
+    weights = np.left_shift(np.uint64(1), np.arange(matrix.shape[1], dtype=np.uint64))
+    keys = matrix.astype(np.uint64) @ weights
+    _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return matrix[first_index], inverse.reshape(-1).tolist()
+
+
+def derive_aoe_batch(records):
+    """ Derives Redox race, Invitae ancestry, primary indication, and patient history for many records at once
+
+    Gives the same results as calling convert_emerge_race_to_redox_race, convert_emerge_race_to_invitae_ancestry,
+    get_invitae_primary_indication, and describe_patient_history for each record. The checkbox fields for the 
+    whole cohort are loaded into boolean matrices once. Each distinct combination of checked boxes is only 
+    converted to text once, however many participants share it.
+
+    Params
+    ------
+    records: List of dicts of participant data, as for the per-record functions. Every record must contain 
+             the current and past personal health history checkbox fields.
+
+    Returns
+    -------
+    tuple: (list of Redox races, list of lists of Invitae ancestries, list of primary indications, 
+            list of patient history descriptions), in the same order as records
+    """
+    # numpy is only needed when there are orders to place, so it isn't imported with this module
+    import numpy as np
+    n = len(records)
+    if n == 0:
+        return [], [], [], []
+
+    # Redox race: the only race checked, 'Other Race' when several are checked, 'Unknown' when none are
+    race_variables = list(_REDOX_RACE_MAPPINGS)
+    race = _checkbox_matrix(records, race_variables, ['1', 'checked'], missing='')
+    n_races = race.sum(axis=1)
+    race_names = np.array(list(_REDOX_RACE_MAPPINGS.values()), dtype=object)
+    redox_races = np.where(n_races == 0, _REDOX_RACE_NO_MATCH,
+                           np.where(n_races == 1, race_names[race.argmax(axis=1)], _REDOX_RACE_MULTIPLE)).tolist()
+
+    # Invitae ancestry: race ancestries in mapping order, then Ashkenazi Jewish
+    ancestry_columns = [race_variables.index(v) for v in _INVITAE_ANCESTRY_MAPPINGS]
+    ashkenazi = _checkbox_matrix(records, [_VAR_ASHKENAZI], ['1', 'yes'], missing='')
+    ancestry = np.concatenate([race[:, ancestry_columns], ashkenazi], axis=1)
+    ancestry_names = list(_INVITAE_ANCESTRY_MAPPINGS.values()) + [_INVITAE_ASHKENAZI]
+    patterns, inverse = _unique_rows(ancestry)
+    pattern_ancestries = [[name for name, checked in zip(ancestry_names, row) if checked] for row in patterns.tolist()]
+    invitae_ancestries = [list(pattern_ancestries[i]) for i in inverse]
+
+    # Current and past personal health history conditions
+    n_conditions = len(_PATIENT_HISTORY_CHECKBOXES)
+    history_variables = [c for c, _, _ in _PATIENT_HISTORY_CHECKBOXES] + [p for _, p, _ in _PATIENT_HISTORY_CHECKBOXES]
+    history = _checkbox_matrix(records, history_variables, CHECKBOX_POSITIVE_VALUES)
+
+    # Primary indication: first condition in priority order that is current or past
+    current = history[:, [history_variables.index(c) for c, _, _ in _PRIMARY_INDICATION_CHECKBOXES]]
+    past = history[:, [history_variables.index(p) for _, p, _ in _PRIMARY_INDICATION_CHECKBOXES]]
+    has_condition = current | past
+    indication_names = np.array([x for _, _, x in _PRIMARY_INDICATION_CHECKBOXES], dtype=object)
+    primary_indications = np.where(has_condition.any(axis=1), indication_names[has_condition.argmax(axis=1)],
+                                   _PRIMARY_INDICATION_OTHER).tolist()
+
+    # Patient history: description of each distinct combination of current and past conditions
+    descriptions = [d for _, _, d in _PATIENT_HISTORY_CHECKBOXES]
+    patterns, inverse = _unique_rows(history)
+    pattern_histories = [_format_patient_history([d for d, x in zip(descriptions, row[:n_conditions]) if x],
+                                                 [d for d, x in zip(descriptions, row[n_conditions:]) if x])
+                         for row in patterns.tolist()]
+    patient_histories = [pattern_histories[i] for i in inverse]
+
+    return redox_races, invitae_ancestries, primary_indications, patient_histories
+
+
 def generate_family_history(metree):
     """ Creates a description of family history for Invitae Order
 